@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark batched against per-channel spectrogram calculation
+
+Simulates a tab of many channels with the same sample rate and FFT
+parameters (e.g. a SEI or PEM overview), and times
+`gwsumm.data.fftengine.batch_spectrogram` against calling
+`TimeSeries.spectrogram` for each channel in turn.
+"""
+
+from __future__ import (division, print_function)
+
+import argparse
+import time
+
+import numpy
+
+from gwpy.timeseries import TimeSeries
+
+from gwsumm.data.fftengine import batch_spectrogram
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('-n', '--num-channels', type=int, default=60,
+                    help='number of channels, default: %(default)s')
+parser.add_argument('-r', '--sample-rate', type=float, default=256,
+                    help='sample rate (Hz), default: %(default)s')
+parser.add_argument('-d', '--duration', type=float, default=3600,
+                    help='duration (seconds), default: %(default)s')
+parser.add_argument('-s', '--stride', type=float, default=60,
+                    help='spectrogram stride (seconds), default: %(default)s')
+parser.add_argument('-f', '--fftlength', type=float, default=8,
+                    help='FFT length (seconds), default: %(default)s')
+parser.add_argument('-o', '--overlap', type=float, default=4,
+                    help='FFT overlap (seconds), default: %(default)s')
+parser.add_argument('-R', '--repeat', type=int, default=3,
+                    help='number of repeats, best time is reported, '
+                         'default: %(default)s')
+args = parser.parse_args()
+
+serieslist = [
+    TimeSeries(numpy.random.normal(size=int(args.duration *
+                                            args.sample_rate)),
+               sample_rate=args.sample_rate, epoch=0, unit='m',
+               name='X1:TEST-CHANNEL_%d' % i)
+    for i in range(args.num_channels)]
+
+
+def per_channel():
+    return [ts.spectrogram(args.stride, fftlength=args.fftlength,
+                           overlap=args.overlap, method='welch',
+                           window='hanning') for ts in serieslist]
+
+
+def batched():
+    return batch_spectrogram(serieslist, args.stride, args.fftlength,
+                             overlap=args.overlap, window='hanning')
+
+
+def best_time(func):
+    times = []
+    for i in range(args.repeat):
+        t0 = time.time()
+        out = func()
+        times.append(time.time() - t0)
+    return min(times), out
+
+
+print("%d channels, %d seconds at %d Hz, stride=%s, fftlength=%s, "
+      "overlap=%s" % (args.num_channels, args.duration, args.sample_rate,
+                      args.stride, args.fftlength, args.overlap))
+tloop, ref = best_time(per_channel)
+print("per-channel: %.3f s" % tloop)
+tbatch, new = best_time(batched)
+print("batched:     %.3f s  [%.1fx]" % (tbatch, tloop / tbatch))
+diff = max(numpy.abs(a.value - b.value).max() / numpy.abs(a.value).max()
+           for a, b in zip(ref, new))
+print("maximum relative difference: %.3g" % diff)
@@ -36,6 +36,7 @@ from gwpy.segments import (SegmentList, Segment, DataQualityFlag)
 from . import (globalv, mode)
 from .data import (get_channel, add_timeseries, add_spectrogram,
                    add_coherence_component_spectrogram)
+from .data.histogram import SpectralHistogram
 from .triggers import (GWRecArray, add_triggers)
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
@@ -71,6 +72,11 @@ def write_data_archive(outfile, timeseries=True, spectrogram=True,
                     # ignore trigger rate TimeSeries
                     if re_rate.search(str(c)):
                         continue
+                    # don't archive trends calculated from raw data, so
+                    # the next run reads the real trend frames
+                    synthetic = globalv.SYNTHETIC_TRENDS.get(c, None)
+                    if synthetic:
+                        tslist = exclude_segments(tslist, synthetic)
                     # loop over time-series
                     for ts in tslist:
                         # ignore fast channels who weren't used
@@ -113,6 +119,26 @@ def write_data_archive(outfile, timeseries=True, spectrogram=True,
                                 spec.write(group, name=name, format='hdf')
                             except ValueError as e:
                                 warnings.warn(str(e))
+                # record samples left over after the last spectrogram
+                # stride, so the next run can continue from them
+                group = h5file.create_group('spectrogram-tails')
+                for key, tail in globalv.SPECTROGRAM_TAILS.iteritems():
+                    try:
+                        tail.write(group, name=key, format='hdf')
+                    except ValueError as e:
+                        warnings.warn(str(e))
+                # and the final state of each streaming filter, so the
+                # next run continues filtering without a new transient
+                group = h5file.create_group('filter-states')
+                for key, (end, zf) in globalv.FILTER_STATES.iteritems():
+                    dset = group.create_dataset(key, data=zf)
+                    dset.attrs['end'] = end
+
+            # record histograms used for percentile spectra
+            if spectrogram:
+                group = h5file.create_group('spectral-histograms')
+                for name, hist in globalv.SPECTRAL_HISTOGRAMS.iteritems():
+                    hist.write(group, name)
 
             # record all segment data
             if segments:
@@ -194,6 +220,47 @@ def read_data_archive(sourcefile):
                 spec.channel = get_channel(spec.channel)
                 add_(spec, key=key)
 
+        # read spectrogram tails
+        try:
+            group = h5file['spectrogram-tails']
+        except KeyError:
+            group = dict()
+        for key, dataset in group.iteritems():
+            globalv.SPECTROGRAM_TAILS[key] = TimeSeries.read(dataset,
+                                                             format='hdf')
+
+        # read streaming filter states
+        try:
+            group = h5file['filter-states']
+        except KeyError:
+            group = dict()
+        for key, dataset in group.iteritems():
+            globalv.FILTER_STATES[key] = (float(dataset.attrs['end']),
+                                          dataset[()])
+
+        # read histograms for percentile spectra, merging with those from
+        # other archives
+        try:
+            group = h5file['spectral-histograms']
+        except KeyError:
+            group = dict()
+        for name in group:
+            hist = SpectralHistogram.read(group[name])
+            try:
+                current = globalv.SPECTRAL_HISTOGRAMS[name]
+            except KeyError:
+                globalv.SPECTRAL_HISTOGRAMS[name] = hist
+                continue
+            # a longer archive may include all of the days read so far
+            if current.count and hist.covers(current.segments):
+                globalv.SPECTRAL_HISTOGRAMS[name] = hist
+                continue
+            try:
+                current.merge(hist)
+            except ValueError as e:
+                warnings.warn('Cannot merge spectral histogram %r: %s'
+                              % (name, str(e)))
+
         # read all segments
         try:
             group = h5file['segments']
@@ -251,6 +318,30 @@ def find_daily_archives(start, end, ifo, tag, basedir=os.curdir):
 
 # -- utility methods --------------------------------------------------------
 
+def exclude_segments(serieslist, segments):
+    """Crop the given segments out of a list of series
+
+    Parameters
+    ----------
+    serieslist : `list` of `~gwpy.timeseries.TimeSeries`
+        the input data
+
+    segments : `~gwpy.segments.SegmentList`
+        the GPS intervals to remove
+
+    Returns
+    -------
+    cropped : `list` of `~gwpy.timeseries.TimeSeries`
+        views of the input data outside of ``segments``
+    """
+    out = []
+    for ts in serieslist:
+        for seg in SegmentList([Segment(*ts.span)]) - segments:
+            if abs(seg) >= ts.dt.value:
+                out.append(ts.crop(*seg, copy=False))
+    return out
+
+
 def archive_recarray(table, key, parent, compression='gzip'):
     """Add a recarray to the given HDF5 group
     """
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""File caches indexed by GPS time
+
+A month of raw frames is tens of thousands of `CacheEntry` objects, and
+`Cache.sieve` walks every one of them for each requested segment. The
+`IndexedCache` keeps its entries sorted by start time, with parallel
+`numpy` arrays of start and end times, so that sieving by segment is a
+pair of binary searches, and the coverage of the cache is calculated
+with array operations.
+
+Large LAL-format cache files can be read with :meth:`read_cache`, which
+parses the GPS columns of the whole file as arrays, and only creates
+`CacheEntry` objects for those lines that overlap the segment of
+interest. A binary index of the GPS columns and line offsets can be
+stored alongside the cache file, so that later reads skip the parsing
+altogether.
+"""
+
+import os
+
+import numpy
+
+from glue.lal import (Cache, CacheEntry)
+
+from gwpy.segments import (Segment, SegmentList)
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['IndexedCache', 'read_cache']
+
+INDEX_SUFFIX = '.idx.npz'
+
+
+class IndexedCache(Cache):
+    """A `~glue.lal.Cache` with a GPS interval index
+
+    The index is built the first time it is needed, and invalidated by
+    any mutation of the cache.
+    """
+    def _reset_index(self):
+        self._starts = None
+
+    def _build_index(self):
+        list.sort(self, key=lambda e: e.segment[0])
+        n = len(self)
+        self._starts = numpy.empty(n, dtype=float)
+        self._ends = numpy.empty(n, dtype=float)
+        for i, entry in enumerate(self):
+            self._starts[i], self._ends[i] = entry.segment
+        # running maximum of end times, so we can bisect for the first
+        # entry that could overlap a given start time
+        self._maxends = numpy.maximum.accumulate(self._ends)
+
+    @property
+    def index(self):
+        """The ``(starts, ends)`` GPS index of this cache
+        """
+        if getattr(self, '_starts', None) is None:
+            self._build_index()
+        return self._starts, self._ends
+
+    # -- queries --------------------------------
+
+    def find(self, segment):
+        """Return the positions of all entries that overlap a segment
+        """
+        starts, ends = self.index
+        start, end = map(float, segment)
+        lo = numpy.searchsorted(self._maxends, start, side='right')
+        hi = numpy.searchsorted(starts, end, side='left')
+        if hi <= lo:
+            return numpy.array([], dtype=int)
+        return lo + numpy.nonzero(ends[lo:hi] > start)[0]
+
+    def sieve(self, ifos=None, description=None, segment=None,
+              segmentlist=None, exact_match=False):
+        """Return the entries in this cache matching the given criteria
+
+        This is a drop-in replacement for `~glue.lal.Cache.sieve`, with
+        the ``segment`` selection using the GPS index.
+        """
+        if ifos is not None or description is not None:
+            new = type(self)(Cache.sieve(self, ifos=ifos,
+                                         description=description,
+                                         exact_match=exact_match))
+        else:
+            new = self
+        if segment is not None:
+            new = type(self)(new[i] for i in new.find(segment))
+        if segmentlist is not None:
+            idx = set()
+            for seg in segmentlist:
+                idx.update(new.find(seg))
+            new = type(self)(new[i] for i in sorted(idx))
+        if new is self:
+            new = type(self)(self)
+        return new
+
+    def segments(self):
+        """Return the (coalesced) `SegmentList` covered by this cache
+
+        Entries that overlap or touch are merged into a single segment.
+        """
+        starts, ends = self.index
+        if not len(starts):
+            return SegmentList()
+        # a new segment starts wherever an entry starts after the
+        # maximum end time of all previous entries
+        breaks = numpy.nonzero(starts[1:] > self._maxends[:-1])[0] + 1
+        first = numpy.concatenate(([0], breaks))
+        last = numpy.concatenate((breaks - 1, [len(starts) - 1]))
+        return SegmentList(Segment(s, e) for (s, e) in
+                           zip(starts[first], self._maxends[last]))
+
+    # -- mutation invalidates the index ---------
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, key, value)
+        self._reset_index()
+
+    def __delitem__(self, key):
+        list.__delitem__(self, key)
+        self._reset_index()
+
+    def __setslice__(self, i, j, sequence):
+        list.__setslice__(self, i, j, sequence)
+        self._reset_index()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._reset_index()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, item):
+        list.append(self, item)
+        self._reset_index()
+
+    def extend(self, items):
+        list.extend(self, items)
+        self._reset_index()
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._reset_index()
+
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        self._reset_index()
+        return item
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._reset_index()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._reset_index()
+
+    def reverse(self):
+        list.reverse(self)
+        self._reset_index()
+
+
+# -- cache file I/O -----------------------------------------------------------
+
+def _index_cache_file(content):
+    """Parse the GPS columns and line positions of a LAL-format cache
+
+    Returns
+    -------
+    starts, ends, offsets, lengths : `numpy.ndarray`
+        the GPS start and end time of each entry, and the byte offset
+        and length of the line defining it
+
+    Raises
+    ------
+    ValueError
+        if the content isn't a simple five-column LAL-format cache
+    """
+    buf = numpy.frombuffer(content, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(buf == ord('\n'))
+    offsets = numpy.concatenate(([0], newlines + 1))
+    lengths = numpy.concatenate((newlines, [len(buf)])) - offsets
+    # ignore empty lines (including after the final newline)
+    keep = lengths > 0
+    offsets = offsets[keep]
+    lengths = lengths[keep]
+    columns = content.split()
+    if len(columns) != 5 * len(offsets):
+        raise ValueError("Cannot parse cache with columnar reader")
+    starts = numpy.array(columns[2::5], dtype=float)
+    ends = starts + numpy.array(columns[3::5], dtype=float)
+    return starts, ends, offsets, lengths
+
+
+def read_cache(filename, segment=None, index=False):
+    """Read a LAL-format cache file, optionally only for a given segment
+
+    Parameters
+    ----------
+    filename : `str`
+        path of cache file to read
+
+    segment : `~gwpy.segments.Segment`, optional
+        the ``[start, end)`` GPS interval of interest, only entries that
+        overlap this interval are returned
+
+    index : `bool`, optional
+        write a binary index of the file (``<filename>.idx.npz``) for
+        faster reading next time; an up-to-date index is always used
+        if it exists, regardless of this option
+
+    Returns
+    -------
+    cache : `IndexedCache`
+        the cache of entries read from the file
+    """
+    stat = os.stat(filename)
+    idxfile = filename + INDEX_SUFFIX
+    arrays = None
+    # read index if it is up-to-date
+    if os.path.isfile(idxfile) and os.path.getmtime(idxfile) >= stat.st_mtime:
+        try:
+            with open(idxfile, 'rb') as f:
+                npz = numpy.load(f)
+                if int(npz['size']) == stat.st_size:
+                    arrays = tuple(npz[key] for key in
+                                   ('starts', 'ends', 'offsets', 'lengths'))
+        except (IOError, KeyError, ValueError):
+            arrays = None
+    content = None
+    if arrays is None:
+        with open(filename, 'rb') as f:
+            content = f.read()
+        try:
+            arrays = _index_cache_file(content)
+        except ValueError:  # not a simple cache, fall back to glue
+            cache = IndexedCache(Cache.fromfile(content.splitlines()))
+            if segment is not None:
+                cache = cache.sieve(segment=segment)
+            return cache
+        if index:
+            try:
+                with open(idxfile, 'wb') as f:
+                    numpy.savez(f, size=stat.st_size,
+                                **dict(zip(('starts', 'ends', 'offsets',
+                                            'lengths'), arrays)))
+            except IOError:
+                pass
+    starts, ends, offsets, lengths = arrays
+    # find overlapping entries
+    if segment is None:
+        keep = numpy.arange(starts.size)
+    else:
+        start, end = map(float, segment)
+        keep = numpy.flatnonzero((starts < end) & (ends > start))
+    if not keep.size:
+        return IndexedCache()
+    # read only the lines we need
+    out = IndexedCache()
+    with open(filename, 'rb') as f:
+        if content is None and keep.size < starts.size:
+            for i in keep:
+                f.seek(offsets[i])
+                out.append(CacheEntry(f.read(lengths[i])))
+            return out
+        if content is None:
+            content = f.read()
+    for i in keep:
+        out.append(CacheEntry(content[offsets[i]:offsets[i]+lengths[i]]))
+    return out
@@ -43,7 +43,12 @@ from gwpy.spectrogram import SpectrogramList
 from .. import globalv
 from ..utils import (vprint, count_free_cores, safe_eval)
 from ..channels import get_channel
-from .utils import (use_segmentlist, get_fftparams, make_globalv_key)
+from .utils import (use_segmentlist, get_fftparams, make_globalv_key,
+                    pin_channels)
+from .store import get_indexed_list
+from .fftengine import prepare_fft
+from .filters import apply_power_response
+from . import memory
 from .timeseries import (get_timeseries, get_timeseries_dict)
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
@@ -72,6 +77,7 @@ def get_coherence_spectrogram(channel_pair, segments, config=None,
 
 
 @use_segmentlist
+@pin_channels
 def _get_coherence_spectrogram(channel_pair, segments, config=None,
                                cache=None, query=True, nds=None,
                                return_=True, frametype=None, multiprocess=True,
@@ -110,7 +116,7 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
         nproc = multiprocess
 
     # if there are no existing spectrogram, initialize as a list
-    globalv.SPECTROGRAMS.setdefault(key, SpectrogramList())
+    stored = get_indexed_list(globalv.SPECTROGRAMS, key, SpectrogramList)
 
     # XXX HACK: use dummy timeseries to find lower sampling rate
     if len(segments) > 0:
@@ -137,7 +143,7 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
 
     # initialize component lists if they don't exist yet
     for ck in ckeys:
-        globalv.COHERENCE_COMPONENTS.setdefault(ck, SpectrogramList())
+        get_indexed_list(globalv.COHERENCE_COMPONENTS, ck, SpectrogramList)
 
     # get data if query=True or if there are new segments
     query &= abs(new) != 0
@@ -147,6 +153,10 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
         # the intersecting segments will be calculated when needed
         intersection = None
 
+        # use the shared FFT plan and window for all components
+        prepare_fft((fftparams['fftlength'] or stride) * sampling,
+                    fftparams.get('window'))
+
         # loop over components needed to calculate coherence
         for comp in components:
 
@@ -240,9 +250,11 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
                                                    **fftparams)
 
                     if filter_:
-                        specgram = (specgram**(1/2.)).filter(*filter_,
-                                                             inplace=True) ** 2
+                        apply_power_response(specgram, filter_,
+                                             channel1.ndsname)
                     add_coherence_component_spectrogram(specgram, key=ckey)
+                    memory.set_derived(make_globalv_key(channel1),
+                                       make_globalv_key(channel2))
 
                     vprint('.')
 
@@ -255,8 +267,8 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
                 _get_from_list(globalv.COHERENCE_COMPONENTS[ck], seg) for
                 ck in ckeys]
             csg = abs(cxy)**2 / cxx / cyy
-            globalv.SPECTROGRAMS[key].append(csg)
-            globalv.SPECTROGRAMS[key].coalesce()
+            stored.add(csg)
+            memory.record('SPECTROGRAMS', key)
 
     if not return_:
         return
@@ -268,8 +280,10 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
         for comp in components:
             index = components.index(comp)
             ckey = ckeys[index]
-            for specgram in globalv.COHERENCE_COMPONENTS[ckey]:
-                for seg in segments:
+            memory.touch('COHERENCE_COMPONENTS', ckey)
+            for seg in segments:
+                for specgram in globalv.COHERENCE_COMPONENTS[ckey].overlaps(
+                        seg):
                     if abs(seg) < specgram.dt.value:
                         continue
                     if specgram.span.intersects(seg):
@@ -284,9 +298,10 @@ def _get_coherence_spectrogram(channel_pair, segments, config=None,
     else:
 
         # return list of coherence spectrograms
+        memory.touch('SPECTROGRAMS', key)
         out = SpectrogramList()
-        for specgram in globalv.SPECTROGRAMS[key]:
-            for seg in segments:
+        for seg in segments:
+            for specgram in stored.overlaps(seg):
                 if abs(seg) < specgram.dt.value:
                     continue
                 if specgram.span.intersects(seg):
@@ -388,10 +403,9 @@ def add_coherence_component_spectrogram(specgram, key=None, coalesce=True):
     """
     if key is None:
         key = specgram.name or str(specgram.channel)
-    globalv.COHERENCE_COMPONENTS.setdefault(key, SpectrogramList())
-    globalv.COHERENCE_COMPONENTS[key].append(specgram)
-    if coalesce:
-        globalv.COHERENCE_COMPONENTS[key].coalesce()
+    get_indexed_list(globalv.COHERENCE_COMPONENTS, key, SpectrogramList).add(
+        specgram, coalesce=coalesce)
+    memory.record('COHERENCE_COMPONENTS', key)
 
 
 @use_segmentlist
@@ -447,7 +461,7 @@ def _get_from_list(serieslist, segment):
     Should only be used in situations where the existence of the target
     data within the list is guaranteed
     """
-    for series in serieslist:
+    for series in serieslist.overlaps(segment):
         if segment in series.span:
             return series.crop(segment)
     raise ValueError("Cannot crop series for segment %d from list"
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local cache of datafind query results
+
+Each query to the datafind server records which GPS interval was
+searched, and which frame files were found, so that repeated queries for
+overlapping intervals only ask the server about the parts that haven't
+been searched already. The parts of an interval that ended well before
+`globalv.NOW` (the live window) and for which files were found are
+considered closed, and are only searched again once they are older than
+the maximum age. Everything else, i.e. intervals close to the live edge
+and gaps in the data, which may yet be filled by files that arrive late,
+are searched again after a short time-to-live. Files that are no longer
+covered by any searched interval are dropped from the cache.
+
+The files found for each query type are held in an
+`~gwsumm.data.cache.IndexedCache`, so each lookup is a binary search.
+
+The cache can be saved between invocations via the ``[datafind]`` section
+of the configuration, in which case it is written once, when the job
+exits::
+
+   [datafind]
+   cache-file = /scratch/gwsumm/datafind.pkl
+   cache-ttl = 60
+   cache-max-age = 604800
+   cache-live-window = 3600
+"""
+
+import atexit
+import cPickle
+import os
+import threading
+import time
+
+from glue.lal import CacheEntry
+
+from gwpy.segments import (Segment, SegmentList)
+
+from .. import globalv
+from ..config import (NoSectionError, NoOptionError)
+from .cache import IndexedCache
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['DatafindCache', 'get_datafind_cache']
+
+# default time (seconds) before NOW after which intervals can be closed
+LIVE_WINDOW = 3600
+
+# default maximum age (seconds) of results for closed intervals
+MAX_AGE = 7 * 86400
+
+# version of the on-disk format
+FORMAT_VERSION = 2
+
+_DATAFIND_CACHE = {}
+
+
+class DatafindCache(object):
+    """Record of datafind query results, keyed by query type
+
+    Parameters
+    ----------
+    ttl : `float`, optional
+        time-to-live (seconds) of results for intervals near the live edge
+
+    maxage : `float`, optional
+        time-to-live (seconds) of results for closed intervals
+
+    livewindow : `float`, optional
+        time (seconds) before `globalv.NOW` after which intervals for
+        which files were found are considered closed
+
+    filename : `str`, optional
+        path of file in which to store the cache between invocations
+    """
+    def __init__(self, ttl=60, maxage=MAX_AGE, livewindow=LIVE_WINDOW,
+                 filename=None):
+        self.ttl = ttl
+        self.maxage = maxage
+        self.livewindow = livewindow
+        self.filename = filename
+        self._lock = threading.RLock()
+        # key -> [(start, end, expiry), ...]
+        self._searched = {}
+        # key -> IndexedCache, or list of cache lines not yet parsed
+        self._files = {}
+        self._dirty = False
+        if filename and os.path.isfile(filename):
+            self.load()
+
+    # -- I/O ------------------------------------
+
+    def load(self):
+        """Read the cache from its file
+
+        Files written in an older format are ignored.
+        """
+        with open(self.filename, 'rb') as f:
+            try:
+                data = cPickle.load(f)
+            except (EOFError, cPickle.UnpicklingError):
+                data = {}
+        with self._lock:
+            if (not isinstance(data, dict) or
+                    data.get('version') != FORMAT_VERSION):
+                self._searched, self._files = {}, {}
+                return
+            self._searched = data['searched']
+            # cache lines are only parsed when a key is first used
+            self._files = data['files']
+            for key in list(self._searched):
+                self._prune(key)
+
+    def save(self):
+        """Write the cache to its file, if configured and changed
+        """
+        if not self.filename or not self._dirty:
+            return
+        tmp = '%s.tmp%d' % (self.filename, os.getpid())
+        with self._lock:
+            files = dict((key, map(str, val) if
+                          isinstance(val, IndexedCache) else val) for
+                         (key, val) in self._files.iteritems())
+            data = {'version': FORMAT_VERSION, 'searched': self._searched,
+                    'files': files}
+            with open(tmp, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.filename)
+            self._dirty = False
+
+    # -- internals ------------------------------
+
+    def _cache(self, key):
+        """Return the `IndexedCache` of files for ``key``
+        """
+        files = self._files.get(key, None)
+        if not isinstance(files, IndexedCache):
+            files = self._files[key] = IndexedCache(
+                map(CacheEntry, files or []))
+        return files
+
+    def _prune(self, key, now=None):
+        """Drop expired intervals for ``key``, and the files only they cover
+        """
+        if now is None:
+            now = time.time()
+        searched = self._searched.get(key, [])
+        current = [s for s in searched if s[2] > now]
+        if len(current) == len(searched):
+            return
+        self._dirty = True
+        if not current:
+            self._searched.pop(key, None)
+            self._files.pop(key, None)
+            return
+        self._searched[key] = current
+        cache = self._cache(key)
+        keep = set()
+        for (start, end, _) in current:
+            keep.update(cache.find((start, end)))
+        self._files[key] = IndexedCache(cache[i] for i in sorted(keep))
+
+    # -- query ----------------------------------
+
+    def missing(self, key, start, end):
+        """Return the parts of ``[start, end)`` not yet searched for ``key``
+
+        Returns
+        -------
+        segments : `~gwpy.segments.SegmentList`
+            the list of segments that should be queried
+        """
+        with self._lock:
+            self._prune(key)
+            covered = SegmentList(Segment(a, b) for (a, b, _) in
+                                  self._searched.get(key, []))
+        return SegmentList([Segment(start, end)]) - covered.coalesce()
+
+    def update(self, key, start, end, cache):
+        """Record the result of a query for ``key`` over ``[start, end)``
+
+        Only the parts of the interval covered by the files found, and
+        outside of the live window, are closed; the rest are searched
+        again after `ttl` seconds, in case files arrive late.
+        """
+        now = time.time()
+        span = SegmentList([Segment(start, end)])
+        found = SegmentList(Segment(float(ce.segment[0]),
+                                    float(ce.segment[1])) for
+                            ce in cache).coalesce()
+        edge = globalv.NOW - self.livewindow
+        if edge > start:
+            closed = found & SegmentList([Segment(start, min(end, edge))])
+        else:
+            closed = SegmentList()
+        searched = ([(seg[0], seg[1], now + self.maxage) for
+                     seg in closed] +
+                    [(seg[0], seg[1], now + self.ttl) for
+                     seg in span - closed])
+        with self._lock:
+            self._prune(key, now=now)
+            self._searched.setdefault(key, []).extend(searched)
+            files = self._cache(key)
+            # files spanning the edge of a previous query are found twice
+            new = []
+            for ce in cache:
+                if not any(files[i].url == ce.url for i in
+                           files.find(ce.segment)):
+                    new.append(ce)
+            files.extend(new)
+            self._dirty = True
+
+    def get(self, key, start, end):
+        """Return the cache of all known files overlapping ``[start, end)``
+        """
+        with self._lock:
+            return self._cache(key).sieve(segment=Segment(start, end))
+
+    def find(self, key, start, end, query):
+        """Find files for ``[start, end)``, only querying for new intervals
+
+        Parameters
+        ----------
+        key : `tuple`
+            the unique identifier of this query type, e.g.
+            `(host, ifo, frametype, urltype, match)`
+
+        start : `int`
+            GPS start time of the query
+
+        end : `int`
+            GPS end time of the query
+
+        query : `callable`
+            method to call as ``query(start, end)`` to search the server
+            for a new interval, should return `None` if the query failed
+
+        Returns
+        -------
+        cache : `~gwsumm.data.cache.IndexedCache`
+            a list of files overlapping ``[start, end)``, sorted by
+            start time
+        """
+        for seg in self.missing(key, start, end):
+            result = query(int(seg[0]), int(seg[1]))
+            if result is None:  # query failed, don't record
+                continue
+            self.update(key, seg[0], seg[1], result)
+        return self.get(key, start, end)
+
+
+def get_datafind_cache(config):
+    """Return the `DatafindCache` for this job
+
+    Parameters
+    ----------
+    config : `~gwsumm.config.GWSummConfigParser`
+        the job configuration, with an optional ``[datafind]`` section
+
+    Returns
+    -------
+    cache : `DatafindCache`
+        the (shared) datafind cache
+    """
+    try:
+        filename = os.path.abspath(os.path.expanduser(
+            config.get('datafind', 'cache-file')))
+    except (NoSectionError, NoOptionError):
+        filename = None
+    try:
+        return _DATAFIND_CACHE[filename]
+    except KeyError:
+        pass
+    try:
+        ttl = config.getfloat('datafind', 'cache-ttl')
+    except (NoSectionError, NoOptionError):
+        ttl = 60
+    try:
+        maxage = config.getfloat('datafind', 'cache-max-age')
+    except (NoSectionError, NoOptionError):
+        maxage = MAX_AGE
+    try:
+        livewindow = config.getfloat('datafind', 'cache-live-window')
+    except (NoSectionError, NoOptionError):
+        livewindow = LIVE_WINDOW
+    dfcache = _DATAFIND_CACHE[filename] = DatafindCache(
+        ttl=ttl, maxage=maxage, livewindow=livewindow, filename=filename)
+    if filename:
+        atexit.register(dfcache.save)
+    return dfcache
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Multi-resolution min/max/mean envelopes of time-series data
+
+Drawing a full-rate `TimeSeries` into a figure a few thousand pixels
+wide wastes almost all of the effort; each pixel column only shows the
+extent of the data it covers. An `EnvelopePyramid` reduces a series
+by successive factors of `FACTOR`, recording the minimum, maximum and
+mean of each bin, so that a plot can draw the coarsest level that still
+resolves its pixel width.
+
+Pyramids requested with a ``key`` are cached for repeated plots of the
+same data, with the least-recently used dropped once the cache holds
+more than `CACHE_SIZE` bytes.
+"""
+
+from __future__ import division
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['EnvelopePyramid', 'get_envelope']
+
+# reduction factor between successive levels
+FACTOR = 4
+
+# maximum number of bytes held by cached pyramids
+CACHE_SIZE = 256 * 1024 ** 2
+
+# (key, x0, size) -> EnvelopePyramid, from least- to most-recently used
+_PYRAMIDS = OrderedDict()
+
+
+class EnvelopePyramid(object):
+    """Min/max/mean envelope of a data series at multiple resolutions
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`
+        the input data
+
+    factor : `int`, optional
+        reduction factor between successive levels
+    """
+    def __init__(self, series, factor=FACTOR):
+        self.x0 = series.x0.value
+        self.dt = series.dx.value
+        self.size = series.size
+        self.factor = factor
+        # each level is (binsize, min, max, sum, count)
+        self.levels = []
+        data = numpy.asarray(series.value)
+        if data.size < 2:
+            return
+        # reduce the first level straight from the stored array, to avoid
+        # a full-size copy (and count array) of the data
+        idx = numpy.arange(0, data.size, factor)
+        level = (factor,
+                 numpy.minimum.reduceat(data, idx),
+                 numpy.maximum.reduceat(data, idx),
+                 numpy.add.reduceat(data, idx, dtype=float),
+                 numpy.diff(numpy.append(idx, data.size)))
+        self.levels.append(level)
+        while level[1].size > 1:
+            level = self._reduce(level, factor)
+            self.levels.append(level)
+
+    @property
+    def nbytes(self):
+        """The number of bytes held by all levels of this pyramid
+        """
+        return sum(a.nbytes for level in self.levels for a in level[1:])
+
+    @staticmethod
+    def _reduce(level, factor):
+        binsize, min_, max_, sum_, count = level
+        idx = numpy.arange(0, min_.size, factor)
+        return (binsize * factor,
+                numpy.minimum.reduceat(min_, idx),
+                numpy.maximum.reduceat(max_, idx),
+                numpy.add.reduceat(sum_, idx),
+                numpy.add.reduceat(count, idx))
+
+    def get_level(self, nbins):
+        """Return the coarsest envelope with at least ``nbins`` bins
+
+        Parameters
+        ----------
+        nbins : `int`
+            the minimum number of bins required
+
+        Returns
+        -------
+        times : `numpy.ndarray`
+            the central time of each bin
+
+        min : `numpy.ndarray`
+            the minimum of each bin
+
+        max : `numpy.ndarray`
+            the maximum of each bin
+
+        mean : `numpy.ndarray`
+            the mean of each bin
+
+        Raises
+        ------
+        ValueError
+            if the raw data have fewer than ``FACTOR * nbins`` samples,
+            in which case they should be drawn directly
+        """
+        chosen = None
+        for level in self.levels:
+            if level[1].size < nbins:
+                break
+            chosen = level
+        if chosen is None:
+            raise ValueError("Data are too short to decimate for %d bins"
+                             % nbins)
+        binsize, min_, max_, sum_, count = chosen
+        times = self.x0 + (numpy.arange(min_.size) * binsize +
+                           count / 2.) * self.dt
+        return times, min_, max_, sum_ / count
+
+
+def get_envelope(series, key=None):
+    """Return the `EnvelopePyramid` for a series, building it if needed
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`
+        the input data
+
+    key : `str`, optional
+        the `globalv.DATA` key for these data, used to cache the pyramid
+        for repeated plots of the same data
+
+    Returns
+    -------
+    pyramid : `EnvelopePyramid`
+        the envelope pyramid for this series
+    """
+    if key is None:
+        return EnvelopePyramid(series)
+    id_ = (key, float(series.x0.value), series.size)
+    try:
+        pyramid = _PYRAMIDS.pop(id_)
+    except KeyError:
+        # forget pyramids for older versions of these data
+        for old in [k for k in _PYRAMIDS if k[0] == key and
+                    k[1] == id_[1]]:
+            _PYRAMIDS.pop(old)
+        pyramid = EnvelopePyramid(series)
+    _PYRAMIDS[id_] = pyramid
+    # drop least-recently used pyramids beyond the cache size
+    total = sum(p.nbytes for p in _PYRAMIDS.itervalues())
+    while total > CACHE_SIZE and len(_PYRAMIDS) > 1:
+        total -= _PYRAMIDS.popitem(last=False)[1].nbytes
+    return pyramid
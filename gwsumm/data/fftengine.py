@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Batched Welch spectrograms, and a shared FFT plan and window registry
+
+Tabs of environmental or seismic channels typically request spectrograms
+for tens of channels with the same sample rate and FFT parameters.
+Rather than calling `~gwpy.timeseries.TimeSeries.spectrogram` once per
+channel, :meth:`batch_spectrogram` stacks the data for all channels into
+a single 2-D array and calculates the windowed FFTs for every channel,
+stride and FFT segment in one vectorised `numpy.fft.rfft` call, using a
+single window.
+
+Each stride of each spectrogram is the Welch average of the one-sided
+power spectral densities of the windowed FFT segments within that
+stride. The window, and whether each segment is mean-subtracted first,
+follow the ``'welch'`` method used by
+`~gwpy.timeseries.TimeSeries.spectrogram` (see `welch_convention`), so
+a batched spectrogram is the same as one calculated per channel.
+
+Windows and FFT plans are prepared once per ``(length, window, dtype)``
+and shared by every spectrogram in the process (see `prepare_fft`),
+ideally ahead of time by `warm_up` so that worker processes inherit
+them. FFTW plans created by LAL can be persisted between runs as wisdom
+files, see `import_wisdom` and `export_wisdom`.
+"""
+
+from __future__ import division
+
+import os.path
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import get_window
+
+from astropy import units
+
+from gwpy.spectrogram import Spectrogram
+try:
+    from gwpy.frequencyseries import lal_ as lalpsd
+except ImportError:
+    from gwpy.spectrum import lal_ as lalpsd
+try:
+    from gwpy.frequencyseries.registry import get_method as get_psd_method
+except ImportError:
+    from gwpy.spectrum.registry import get_method as get_psd_method
+
+from ..channels import get_channel
+from ..utils import vprint
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['batch_spectrogram', 'welch_convention', 'get_fft_window',
+           'prepare_fft', 'warm_up', 'import_wisdom', 'export_wisdom']
+
+DEFAULT_WINDOW = 'hanning'
+
+# maximum number of samples to transform in a single call
+BLOCK_SIZE = 2 ** 24
+
+# windows, keyed by (length, window, dtype)
+WINDOWS = {}
+
+# (length, window, dtype) keys for which LAL FFT plans have been prepared
+PLANS = set()
+
+
+# -- plan and window registry -------------------------------------------------
+
+def _registry_key(length, window, dtype):
+    if window is None:
+        window = DEFAULT_WINDOW
+    if isinstance(window, list):
+        window = tuple(window)
+    return int(round(length)), window, numpy.dtype(dtype).name
+
+
+def get_fft_window(length, window=None, dtype=numpy.float64):
+    """Return the (shared, read-only) window of the given length
+
+    Parameters
+    ----------
+    length : `int`
+        number of samples in the window
+
+    window : `str`, `tuple`, `numpy.ndarray`, optional
+        the window name (or name and parameter) as understood by
+        `scipy.signal.get_window`, default: `DEFAULT_WINDOW`, arrays
+        are returned unchanged
+
+    dtype : `type`, optional
+        the data type of the window
+
+    Returns
+    -------
+    window : `numpy.ndarray`
+        the window array
+    """
+    if isinstance(window, numpy.ndarray):
+        return window
+    key = _registry_key(length, window, dtype)
+    try:
+        return WINDOWS[key]
+    except KeyError:
+        win = WINDOWS[key] = get_window(key[1], key[0]).astype(key[2])
+        win.flags.writeable = False
+        return win
+
+
+def prepare_fft(length, window=None, dtype=numpy.float64):
+    """Prepare the window and FFT plan for transforms of the given length
+
+    The LAL FFT plan and window are created (at the current
+    ``LAL_FFTPLAN_LEVEL``) in the same cache used by
+    `~gwpy.timeseries.TimeSeries.spectrogram`, so are only created once
+    per process.
+
+    Returns
+    -------
+    window : `numpy.ndarray`
+        the window array, see `get_fft_window`
+    """
+    win = get_fft_window(length, window, dtype)
+    if isinstance(window, numpy.ndarray):
+        return win
+    key = _registry_key(length, window, dtype)
+    if key not in PLANS:
+        PLANS.add(key)
+        try:
+            lalpsd.generate_fft_plan(key[0], dtype=key[2])
+            lalpsd.generate_window(key[0], window=key[1], dtype=key[2])
+        except ImportError:  # no LAL, nothing else to prepare
+            pass
+        except (AttributeError, TypeError, ValueError, RuntimeError):
+            # window not known to LAL, gwpy will fall back as normal
+            pass
+    return win
+
+
+def warm_up(channels, **defaults):
+    """Prepare windows and FFT plans for all of the given channels
+
+    This should be called once, before spawning any worker processes.
+    Channels whose sample rate isn't yet known are skipped, their plans
+    will be prepared on first use.
+
+    Parameters
+    ----------
+    channels : `list` of `~gwpy.detector.Channel`
+        the channels to prepare
+
+    **defaults
+        default FFT parameters, as given in the ``[fft]`` section of the
+        configuration
+
+    Returns
+    -------
+    n : `int`
+        the number of distinct ``(length, window)`` pairs prepared
+    """
+    keys = set()
+    for channel in channels:
+        channel = get_channel(channel)
+        rate = getattr(channel, 'sample_rate', None)
+        fftlength = getattr(channel, 'fftlength', defaults.get('fftlength'))
+        if rate is None or fftlength is None:
+            continue
+        window = getattr(channel, 'window', defaults.get('window'))
+        rate = getattr(rate, 'value', rate)
+        try:
+            keys.add(_registry_key(round(float(fftlength) * rate), window,
+                                   numpy.float64))
+        except TypeError:  # unhashable window
+            continue
+    for length, window, dtype in sorted(keys):
+        prepare_fft(length, window, dtype)
+    return len(keys)
+
+
+def import_wisdom(filename):
+    """Import FFTW wisdom for LAL FFT plans from the given file
+
+    Returns
+    -------
+    imported : `bool`
+        `True` if the wisdom was read, otherwise `False`
+    """
+    if not os.path.isfile(filename):
+        return False
+    try:
+        import lal
+        lal.ImportFFTWWisdomFromFilename(filename)
+    except (ImportError, AttributeError, RuntimeError) as e:
+        vprint("    Failed to import FFTW wisdom from %s: %s\n"
+               % (filename, str(e)))
+        return False
+    return True
+
+
+def export_wisdom(filename):
+    """Export the FFTW wisdom for all LAL FFT plans to the given file
+
+    Returns
+    -------
+    exported : `bool`
+        `True` if the wisdom was written, otherwise `False`
+    """
+    try:
+        import lal
+        lal.ExportFFTWWisdomToFilename(filename)
+    except (ImportError, AttributeError, RuntimeError) as e:
+        vprint("    Failed to export FFTW wisdom to %s: %s\n"
+               % (filename, str(e)))
+        return False
+    return True
+
+
+# -- batched spectrograms -----------------------------------------------------
+
+def _uses_lal_welch():
+    """Returns `True` if the ``'welch'`` PSD method is provided by LAL
+    """
+    try:
+        method = get_psd_method('welch')
+    except (KeyError, ValueError):
+        return False
+    return method.__module__.rsplit('.', 1)[-1] == 'lal_'
+
+
+def welch_convention(nfft, window=None, dtype=numpy.float64):
+    """Return the window and detrending used by the ``'welch'`` method
+
+    LAL's Welch average windows each FFT segment as given, using LAL's
+    own (symmetric) windows, whereas `scipy.signal.welch` subtracts the
+    mean of each segment, and uses the periodic window from
+    `scipy.signal.get_window`.
+
+    Parameters
+    ----------
+    nfft : `int`
+        number of samples per FFT
+
+    window : `str`, `numpy.ndarray`, optional
+        the window, default: `DEFAULT_WINDOW`
+
+    dtype : `type`, optional
+        the data type of the window
+
+    Returns
+    -------
+    window : `numpy.ndarray`
+        the window to apply to each FFT segment
+
+    detrend : `bool`
+        `True` if the mean of each segment should be subtracted before
+        windowing
+    """
+    if isinstance(window, numpy.ndarray):
+        return window, not _uses_lal_welch()
+    if _uses_lal_welch():
+        key = _registry_key(nfft, window, dtype)
+        try:
+            lalwin = lalpsd.generate_window(key[0], window=key[1],
+                                            dtype=key[2])
+        except (ImportError, AttributeError, TypeError, ValueError,
+                RuntimeError):
+            pass  # window not known to LAL, gwpy falls back to scipy
+        else:
+            return numpy.asarray(lalwin.data.data), False
+    return get_fft_window(nfft, window, dtype), True
+
+
+def _welch_strides(data, nstride, nfft, noverlap, window, detrend=True):
+    """Calculate Welch PSDs for each stride of each row of ``data``
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        2-D ``(nchannels, nsamples)`` array, where ``nsamples`` is an
+        integer multiple of ``nstride``
+
+    nstride : `int`
+        number of samples per stride
+
+    nfft : `int`
+        number of samples per FFT
+
+    noverlap : `int`
+        number of samples of overlap between FFTs
+
+    window : `numpy.ndarray`
+        the window to apply to each FFT segment
+
+    detrend : `bool`, optional
+        subtract the mean of each FFT segment before windowing
+
+    Returns
+    -------
+    psd : `numpy.ndarray`
+        3-D ``(nchannels, nstrides, nfreqs)`` array of un-normalised
+        Welch averages
+    """
+    nchan, nsamp = data.shape
+    nstep = nfft - noverlap
+    nseg = 1 + (nstride - nfft) // nstep
+    nrows = nsamp // nstride
+    data = numpy.ascontiguousarray(data, dtype=numpy.float64)
+    s0, s1 = data.strides
+    # (channel, stride, segment, sample) view of the input, no copy
+    segments = as_strided(data, shape=(nchan, nrows, nseg, nfft),
+                          strides=(s0, nstride * s1, nstep * s1, s1))
+    if detrend:
+        segments = segments - segments.mean(axis=-1)[..., None]
+    segments = segments * window
+    power = numpy.fft.rfft(segments, axis=-1)
+    power = power.real ** 2 + power.imag ** 2
+    return power.mean(axis=2)
+
+
+def batch_spectrogram(serieslist, stride, fftlength, overlap=0,
+                      window=None, nrows=None):
+    """Calculate Welch spectrograms for many series in a single pass
+
+    Parameters
+    ----------
+    serieslist : `list` of `~gwpy.timeseries.TimeSeries`
+        the input series, all of which must have the same start time,
+        sample rate and length
+
+    stride : `float`
+        number of seconds per spectrogram row
+
+    fftlength : `float`
+        number of seconds per FFT
+
+    overlap : `float`, optional
+        number of seconds of overlap between FFTs, default: `0`
+
+    window : `str`, `numpy.ndarray`, optional
+        window function to apply to each FFT, default: `DEFAULT_WINDOW`
+
+    nrows : `int`, optional
+        number of spectrogram rows to calculate, defaults to as many
+        complete strides as are contained in the data
+
+    Returns
+    -------
+    spectrograms : `list` of `~gwpy.spectrogram.Spectrogram`
+        one power spectral density spectrogram per input series
+
+    Raises
+    ------
+    ValueError
+        if the input series do not share the same time samples
+    """
+    first = serieslist[0]
+    rate = first.sample_rate.value
+    for ts in serieslist[1:]:
+        if (ts.size != first.size or ts.sample_rate.value != rate or
+                ts.x0 != first.x0):
+            raise ValueError("Cannot batch series with different time "
+                             "samples")
+    nstride = int(round(stride * rate))
+    nfft = int(round(fftlength * rate))
+    noverlap = int(round((overlap or 0) * rate))
+    if nrows is None:
+        nrows = first.size // nstride
+    window, detrend = welch_convention(nfft, window)
+    # one-sided PSD normalisation, as scipy.signal.welch
+    scale = numpy.ones(nfft // 2 + 1) * 2 / (rate * (window ** 2).sum())
+    scale[0] /= 2
+    if not nfft % 2:
+        scale[-1] /= 2
+
+    data = numpy.vstack([numpy.asarray(ts.value[:nrows * nstride]) for
+                         ts in serieslist])
+    out = numpy.empty((len(serieslist), nrows, scale.size))
+    # transform blocks of strides at a time to limit memory use
+    block = max(1, BLOCK_SIZE // (len(serieslist) * nstride))
+    for i in range(0, nrows, block):
+        j = min(i + block, nrows)
+        out[:, i:j] = _welch_strides(data[:, i * nstride:j * nstride],
+                                     nstride, nfft, noverlap, window,
+                                     detrend=detrend)
+    out *= scale
+
+    spectrograms = []
+    for ts, psd in zip(serieslist, out):
+        if ts.unit is None:
+            unit = None
+        else:
+            unit = ts.unit ** 2 / units.Hertz
+        spectrograms.append(Spectrogram(
+            psd, epoch=ts.x0.value, dt=stride, f0=0, df=1 / fftlength,
+            unit=unit, name=ts.name, channel=ts.channel))
+    return spectrograms
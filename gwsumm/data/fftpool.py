@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of worker processes for spectrograms shared for the whole job
+
+Each row of a spectrogram depends only on the data within its own stride,
+so the data for every (channel, segment) request can be cut at stride
+boundaries into jobs of similar size. A `SpectrogramScheduler` fans those
+jobs out over a shared `multiprocessing.Pool`, then stitches the rows
+back together and hands each spectrogram to its callback, in the order
+the requests were made.
+
+The pool is only started by the first request that needs it, so jobs
+without spectrograms never start it. Since the pool runs helper threads,
+it should be shut down with :meth:`close_process_pool` before any other
+processes are forked (e.g. to read data, or to make plots), it is
+started again by the next request.
+
+Many short segments (e.g. lock stretches) or many channels therefore use
+all of the available cores, where previously only a single long segment
+could be parallelised.
+"""
+
+from __future__ import division
+
+import atexit
+from math import ceil
+from multiprocessing import Pool
+
+import numpy
+
+from astropy import units
+
+from gwpy.timeseries import TimeSeries
+from gwpy.spectrogram import Spectrogram
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['SpectrogramScheduler', 'get_process_pool', 'close_process_pool']
+
+# number of jobs to aim for per process, to balance the load
+JOBS_PER_PROCESS = 4
+
+# the shared pool, and its size
+_POOL = {}
+
+
+def get_process_pool(nproc):
+    """Return the shared pool of worker processes
+
+    The pool is created with ``nproc`` processes on the first call, and
+    later calls return the same pool, whatever its size, until it is
+    shut down with :meth:`close_process_pool`.
+    """
+    if 'pool' in _POOL:
+        return _POOL['pool']
+    _POOL['pool'] = Pool(nproc)
+    _POOL['size'] = nproc
+    return _POOL['pool']
+
+
+def close_process_pool():
+    """Shut down the shared pool of worker processes, if it exists
+    """
+    pool = _POOL.pop('pool', None)
+    _POOL.pop('size', None)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+atexit.register(close_process_pool)
+
+
+def _spectrogram_job(args):
+    """Calculate the spectrogram rows for a single job
+
+    This is the function run by the worker processes, so only takes
+    and returns simple (picklable) objects.
+    """
+    data, epoch, rate, unit, stride, fftparams = args
+    ts = TimeSeries(data, epoch=epoch, sample_rate=rate, unit=unit)
+    try:
+        specgram = ts.spectrogram(stride, nproc=1, **fftparams)
+    except ZeroDivisionError:
+        if stride == 0:
+            raise ZeroDivisionError("Spectrogram stride is 0")
+        elif fftparams.get('fftlength', None) == 0:
+            raise ZeroDivisionError("FFT length is 0")
+        raise
+    except ValueError as e:
+        # calculate in counts, the unit is resolved by the caller
+        if 'has no unit' in str(e):
+            ts._unit = units.Unit('count')
+            specgram = ts.spectrogram(stride, nproc=1, **fftparams)
+        else:
+            raise
+    return (numpy.asarray(specgram.value), specgram.f0.value,
+            specgram.df.value, specgram.unit)
+
+
+class SpectrogramScheduler(object):
+    """Calculate many spectrograms concurrently in a shared process pool
+
+    Parameters
+    ----------
+    nproc : `int`, optional
+        number of processes to use, default: `1` (calculate serially
+        in this process)
+
+    Examples
+    --------
+    >>> scheduler = SpectrogramScheduler(nproc=8)
+    >>> for ts in serieslist:
+    ...     scheduler.add(ts, 60, {'fftlength': 8, 'overlap': 4}, store)
+    >>> scheduler.run()
+    """
+    def __init__(self, nproc=1):
+        self.nproc = max(int(nproc or 1), 1)
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, ts, stride, fftparams, callback):
+        """Request a spectrogram
+
+        Parameters
+        ----------
+        ts : `~gwpy.timeseries.TimeSeries`
+            the input data
+
+        stride : `float`
+            number of seconds per spectrogram row
+
+        fftparams : `dict`
+            other keyword arguments for
+            `~gwpy.timeseries.TimeSeries.spectrogram`
+
+        callback : `callable`
+            function to call with the new
+            `~gwpy.spectrogram.Spectrogram`, once calculated
+        """
+        self.requests.append((ts, float(stride), dict(fftparams), callback))
+
+    def jobs(self):
+        """Split the requests into jobs at stride boundaries
+
+        Returns
+        -------
+        jobs : `list` of `tuple`
+            ``(request index, job arguments)`` for each job, in order
+        """
+        nrows = [ts.size // int(round(stride * ts.sample_rate.value)) for
+                 (ts, stride, _, _) in self.requests]
+        target = max(1, int(ceil(sum(nrows) /
+                                 (self.nproc * JOBS_PER_PROCESS))))
+        jobs = []
+        for i, ((ts, stride, fftparams, _), n) in enumerate(
+                zip(self.requests, nrows)):
+            rate = ts.sample_rate.value
+            nstride = int(round(stride * rate))
+            epoch = ts.x0.value
+            for j in range(0, max(n, 1), target):
+                # the last job takes any remaining (overlap) samples
+                end = None if j + target >= n else (j + target) * nstride
+                data = numpy.asarray(ts.value[j * nstride:end])
+                jobs.append((i, (data, epoch + j * stride, rate, ts.unit,
+                                 stride, fftparams)))
+        return jobs
+
+    def run(self):
+        """Calculate all requested spectrograms
+
+        Each callback is called as soon as all of the rows for its
+        request have been calculated, in the order the requests were
+        made.
+        """
+        if not self.requests:
+            return
+        jobs = self.jobs()
+        args = [job[1] for job in jobs]
+        if self.nproc > 1 and len(jobs) > 1:
+            results = get_process_pool(self.nproc).imap(_spectrogram_job,
+                                                        args)
+        else:
+            results = (_spectrogram_job(arg) for arg in args)
+
+        rows = []
+        current = jobs[0][0]
+        for (i, _), result in zip(jobs, results):
+            if i != current:
+                self._finish(current, rows)
+                current, rows = i, []
+            rows.append(result)
+        self._finish(current, rows)
+        self.requests = []
+
+    def _finish(self, i, rows):
+        ts, stride, _, callback = self.requests[i]
+        # the unit depends on the method, e.g. Rayleigh spectrograms
+        # are dimensionless
+        f0, df, unit = rows[0][1:]
+        if ts.unit is None:
+            unit = None
+        specgram = Spectrogram(
+            numpy.concatenate([r[0] for r in rows]), epoch=ts.x0.value,
+            dt=stride, f0=f0, df=df, unit=unit, name=ts.name,
+            channel=ts.channel)
+        callback(specgram)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming time-domain filters, and cached frequency responses, for
+channel data
+
+Each ZPK filter is converted into second-order sections once per
+(channel, sample rate), and the final filter state is recorded after each
+call, so that data contiguous with the previous call continue the filter
+rather than restarting it (and paying a new edge transient). The state is
+kept in `globalv.FILTER_STATES`, which is archived with the spectrogram
+tails, so an incremental run continues the filter from the previous run.
+
+The ``frequency_response`` of a channel is applied to spectrograms as a
+multiplicative mask of the power response ``|H(f)|^2``, evaluated once
+per (channel, frequency grid).
+"""
+
+from __future__ import division
+
+import threading
+
+import numpy
+from scipy import signal
+
+from .. import globalv
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['StreamingFilter', 'get_filter', 'apply_filter', 'reset_filter',
+           'get_power_response', 'apply_power_response']
+
+# (key, sample rate) -> StreamingFilter
+_FILTERS = {}
+# guards globalv.FILTER_STATES against concurrent reader threads
+_STATE_LOCK = threading.Lock()
+# (key, f0, df, nfreq) -> |H(f)|^2
+_RESPONSES = {}
+
+
+class StreamingFilter(object):
+    """A ZPK filter designed for repeated application to contiguous data
+
+    Parameters
+    ----------
+    zeros : `list`
+        the filter zeros
+
+    poles : `list`
+        the filter poles
+
+    gain : `float`
+        the filter gain
+
+    Notes
+    -----
+    The filter is applied as `scipy.signal.lfilter` would apply the
+    transfer function ``zpk2tf(zeros, poles, gain)``, matching
+    `~gwpy.timeseries.TimeSeries.filter`, but using second-order sections
+    where available for numerical stability.
+    """
+    def __init__(self, zeros, poles, gain):
+        self.zpk = (zeros, poles, gain)
+        try:
+            self.sos = signal.zpk2sos(zeros, poles, gain)
+        except AttributeError:  # scipy < 0.16
+            self.sos = None
+            self.b, self.a = signal.zpk2tf(zeros, poles, gain)
+
+    def initial_state(self):
+        """Return the (at-rest) initial state of this filter
+        """
+        if self.sos is not None:
+            return numpy.zeros((self.sos.shape[0], 2))
+        return numpy.zeros(max(len(self.a), len(self.b)) - 1)
+
+    def __call__(self, data, zi=None):
+        """Filter the given array
+
+        Parameters
+        ----------
+        data : `numpy.ndarray`
+            the input data
+
+        zi : `numpy.ndarray`, optional
+            the initial filter state, defaults to at-rest
+
+        Returns
+        -------
+        out : `numpy.ndarray`
+            the filtered data
+
+        zf : `numpy.ndarray`
+            the final filter state
+        """
+        if zi is None:
+            zi = self.initial_state()
+        if self.sos is not None:
+            return signal.sosfilt(self.sos, data, zi=zi)
+        return signal.lfilter(self.b, self.a, data, zi=zi)
+
+
+def get_filter(key, zpk, sample_rate):
+    """Return the `StreamingFilter` for the given key and sample rate
+
+    The filter is only designed the first time it is requested.
+    """
+    try:
+        return _FILTERS[(key, sample_rate)]
+    except KeyError:
+        _FILTERS[(key, sample_rate)] = StreamingFilter(*zpk)
+        return _FILTERS[(key, sample_rate)]
+
+
+def reset_filter(key):
+    """Forget the filter state for the given key
+    """
+    with _STATE_LOCK:
+        globalv.FILTER_STATES.pop(key, None)
+
+
+def apply_filter(series, zpk, key):
+    """Filter a series, continuing from the previous call for this key
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`
+        the input data
+
+    zpk : `tuple`
+        ``(zeros, poles, gain)`` filter definition
+
+    key : `str`
+        unique identifier of the data stream, normally the
+        `globalv.DATA` key for the channel
+
+    Returns
+    -------
+    filtered : `~gwpy.timeseries.TimeSeries`
+        a new series containing the filtered data
+
+    Notes
+    -----
+    If ``series`` starts exactly where the last series filtered for this
+    ``key`` ended (to within half a sample), the filter continues from the
+    previous final state, otherwise it starts from rest.
+    """
+    dt = series.dt.value
+    filt = get_filter(key, zpk, 1 / dt)
+    start, end = map(float, series.span)
+    with _STATE_LOCK:
+        try:
+            lastend, zi = globalv.FILTER_STATES[key]
+        except KeyError:
+            zi = None
+        else:
+            if abs(start - lastend) >= dt / 2.:
+                zi = None
+    out, zf = filt(series.value, zi=zi)
+    with _STATE_LOCK:
+        globalv.FILTER_STATES[key] = (end, zf)
+    filtered = out.view(type(series))
+    filtered.__array_finalize__(series)
+    return filtered
+
+
+# -- frequency-domain responses -----------------------------------------------
+
+def _parse_analog_filter(filt):
+    """Return the ``(b, a)`` transfer function for an analog filter
+    definition, as accepted by `~gwpy.spectrogram.Spectrogram.filter`
+    """
+    if len(filt) == 1 and isinstance(filt[0], signal.lti):
+        return filt[0].num, filt[0].den
+    elif len(filt) == 2:
+        return filt
+    elif len(filt) == 3:
+        return signal.zpk2tf(*filt)
+    elif len(filt) == 4:
+        return signal.ss2tf(*filt)
+    raise ValueError("Cannot interpret filter arguments, please give "
+                     "either a signal.lti object, or a tuple in zpk or "
+                     "ba format")
+
+
+def get_power_response(key, filt, f0, df, nfreq):
+    """Return the power response ``|H(f)|^2`` of an analog filter
+
+    The response is only evaluated the first time it is requested for
+    each frequency grid.
+
+    Parameters
+    ----------
+    key : `str`
+        unique identifier for the filter, normally the channel name
+
+    filt : `tuple`
+        the filter definition, see
+        `~gwpy.spectrogram.Spectrogram.filter`
+
+    f0 : `float`
+        the first frequency (Hz)
+
+    df : `float`
+        the frequency spacing (Hz)
+
+    nfreq : `int`
+        the number of frequencies
+
+    Returns
+    -------
+    response : `numpy.ndarray`
+        the (read-only) power response at each frequency
+    """
+    rkey = (key, float(f0), float(df), int(nfreq))
+    try:
+        return _RESPONSES[rkey]
+    except KeyError:
+        b, a = _parse_analog_filter(filt)
+        freqs = f0 + numpy.arange(nfreq) * df
+        if freqs[0] == 0:
+            freqs[0] = 1e-100
+        response = numpy.nan_to_num(abs(signal.freqs(b, a, freqs)[1])) ** 2
+        response.flags.writeable = False
+        _RESPONSES[rkey] = response
+        return response
+
+
+def apply_power_response(specgram, filt, key):
+    """Apply the power response of an analog filter to a spectrogram
+
+    This is equivalent to ``(specgram ** (1/2.)).filter(*filt) ** 2``,
+    but with a single in-place multiply.
+
+    Parameters
+    ----------
+    specgram : `~gwpy.spectrogram.Spectrogram`
+        the spectrogram to modify (in-place)
+
+    filt : `tuple`
+        the filter definition, see
+        `~gwpy.spectrogram.Spectrogram.filter`
+
+    key : `str`
+        unique identifier for the filter, normally the channel name
+
+    Returns
+    -------
+    specgram : `~gwpy.spectrogram.Spectrogram`
+        the input spectrogram, modified in-place
+    """
+    response = get_power_response(key, filt, specgram.f0.value,
+                                  specgram.df.value, specgram.shape[1])
+    specgram.value[:] *= response
+    return specgram
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Mergeable per-frequency histograms of spectrogram amplitudes
+
+Percentile spectra over long spans would otherwise require joining
+every spectrogram into one (potentially many GB) array. Instead, a
+`SpectralHistogram` counts the ``log10`` amplitude of each spectrogram
+row in fixed-width bins, separately for each frequency, updated one
+spectrogram at a time. Histograms with the same frequencies can be
+summed, e.g. across daily archives, and percentiles are interpolated
+within bins from the cumulative counts.
+
+All histograms share a global grid of bins of width `RESOLUTION` (in
+``log10`` units); each frequency holds a window of (initially) `NBINS`
+bins centred on the median of the first data it sees. The window is
+widened, up to `MAXBINS` bins, whenever later data (or a merged
+histogram) fall outside of it, values that still don't fit are counted
+as under- or overflow.
+"""
+
+from __future__ import division
+
+import warnings
+
+import numpy
+
+from astropy import units
+
+from gwpy.segments import (Segment, SegmentList)
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['SpectralHistogram']
+
+# width of each bin in log10(amplitude)
+RESOLUTION = 0.01
+
+# number of bins held for each frequency
+NBINS = 400
+
+# maximum number of bins each frequency's window can be widened to
+MAXBINS = 2000
+
+# global bin index for zero (or negative) amplitudes
+UNDERFLOW = numpy.iinfo(numpy.int32).min
+
+
+class SpectralHistogram(object):
+    """Per-frequency histogram of the amplitudes of a set of spectrograms
+
+    Parameters
+    ----------
+    f0 : `float`
+        frequency (Hz) of the first bin
+
+    df : `float`
+        frequency spacing (Hz)
+
+    nfreq : `int`
+        number of frequency bins
+
+    unit : `~astropy.units.Unit`, optional
+        unit of the spectrogram data
+
+    resolution : `float`, optional
+        bin width, in ``log10`` units
+
+    nbins : `int`, optional
+        number of amplitude bins held (initially) for each frequency
+
+    maxbins : `int`, optional
+        maximum number of amplitude bins for each frequency, when
+        widening the window to hold new data
+    """
+    def __init__(self, f0, df, nfreq, unit=None, resolution=RESOLUTION,
+                 nbins=NBINS, maxbins=MAXBINS):
+        self.f0 = float(f0)
+        self.df = float(df)
+        self.nfreq = int(nfreq)
+        self.unit = unit
+        self.resolution = float(resolution)
+        self.nbins = int(nbins)
+        self.maxbins = max(int(maxbins), self.nbins)
+        # index (on the global grid) of the first bin for each frequency
+        self.offset = None
+        self.counts = numpy.zeros((self.nfreq, self.nbins), dtype=numpy.uint32)
+        self.under = numpy.zeros(self.nfreq, dtype=numpy.uint64)
+        self.over = numpy.zeros(self.nfreq, dtype=numpy.uint64)
+        self.segments = SegmentList()
+
+    @classmethod
+    def from_spectrogram(cls, specgram, **kwargs):
+        """Create a new, empty, histogram for data like ``specgram``
+        """
+        return cls(specgram.f0.value, specgram.df.value, specgram.shape[1],
+                   unit=specgram.unit, **kwargs)
+
+    @property
+    def frequencies(self):
+        """Array of frequencies (Hz) for this histogram
+        """
+        return self.f0 + numpy.arange(self.nfreq) * self.df
+
+    @property
+    def count(self):
+        """The number of spectra recorded in this histogram
+        """
+        if self.offset is None:
+            return 0
+        return int(self.under[0] + self.over[0] +
+                   self.counts[0].sum(dtype=numpy.uint64))
+
+    @property
+    def dropped(self):
+        """The number of amplitudes recorded outside the binned window
+        """
+        if self.offset is None:
+            return 0
+        return int(self.under.sum() + self.over.sum())
+
+    def limits(self):
+        """Return the range of amplitudes recorded in the binned window
+
+        Returns
+        -------
+        low, high : `float`
+            the lower edge of the lowest, and the upper edge of the
+            highest, non-empty bin over all frequencies
+
+        Raises
+        ------
+        ValueError
+            if no amplitudes have been recorded in the window
+        """
+        occupied = self.counts > 0
+        rows = occupied.any(axis=1)
+        if self.offset is None or not rows.any():
+            raise ValueError("Cannot calculate limits of empty histogram")
+        first = occupied.argmax(axis=1)
+        last = self.nbins - occupied[:, ::-1].argmax(axis=1)
+        offset = self.offset[rows]
+        return (10 ** ((offset + first[rows]).min() * self.resolution),
+                10 ** ((offset + last[rows]).max() * self.resolution))
+
+    def _check_compatible(self, f0, df, nfreq):
+        if (nfreq != self.nfreq or not numpy.isclose(f0, self.f0) or
+                not numpy.isclose(df, self.df)):
+            raise ValueError("Cannot combine spectral data with different "
+                             "frequencies")
+
+    def _widen(self, index):
+        """Widen the window of bins to include the given global indices
+
+        The window for each frequency always includes the bins already
+        held, and grows by the same number of bins for every frequency,
+        up to `maxbins` in total.
+
+        Parameters
+        ----------
+        index : `numpy.ndarray`
+            ``(nfreq, N)`` array of global bin indices, `UNDERFLOW` is
+            ignored
+        """
+        valid = index != UNDERFLOW
+        if not valid.any():
+            return
+        low = numpy.minimum(self.offset, numpy.where(
+            valid, index, self.offset[:, None]).min(axis=1))
+        high = numpy.maximum(self.offset + self.nbins, numpy.where(
+            valid, index + 1, self.offset[:, None]).max(axis=1))
+        nbins = max(self.nbins, min(int((high - low).max()), self.maxbins))
+        # centre the requested range, but keep the existing bins
+        start = numpy.clip((low + high - nbins) // 2,
+                           self.offset + self.nbins - nbins, self.offset)
+        if nbins == self.nbins and (start == self.offset).all():
+            return
+        counts = numpy.zeros((self.nfreq, nbins), dtype=self.counts.dtype)
+        cols = (self.offset - start)[:, None] + numpy.arange(self.nbins)
+        counts[numpy.arange(self.nfreq)[:, None], cols] = self.counts
+        self.counts = counts
+        self.offset = start
+        self.nbins = nbins
+
+    def _add(self, index, weights=None):
+        """Add counts at the given global bin indices
+
+        Parameters
+        ----------
+        index : `numpy.ndarray`
+            ``(nfreq, N)`` array of global bin indices
+
+        weights : `numpy.ndarray`, optional
+            ``(nfreq, N)`` array of counts for each index, defaults to one
+        """
+        if weights is None:
+            weights = numpy.ones(index.shape, dtype=numpy.uint64)
+        rel = index - self.offset[:, None]
+        under = rel < 0
+        over = rel >= self.nbins
+        inside = ~(under | over)
+        self.under += (weights * under).sum(axis=1, dtype=numpy.uint64)
+        self.over += (weights * over).sum(axis=1, dtype=numpy.uint64)
+        freq = numpy.arange(self.nfreq)[:, None].repeat(index.shape[1], axis=1)
+        flat = freq[inside] * self.nbins + rel[inside]
+        self.counts += numpy.bincount(
+            flat, weights=weights[inside], minlength=self.counts.size).reshape(
+                self.counts.shape).astype(numpy.uint32)
+
+    def update(self, specgram, segment=None):
+        """Add the rows of a spectrogram to this histogram
+
+        Parameters
+        ----------
+        specgram : `~gwpy.spectrogram.Spectrogram`
+            the new data
+
+        segment : `~gwpy.segments.Segment`, optional
+            the GPS span covered by ``specgram``, defaults to its
+            `~gwpy.spectrogram.Spectrogram.span`
+        """
+        self._check_compatible(specgram.f0.value, specgram.df.value,
+                               specgram.shape[1])
+        if not specgram.shape[0]:
+            return
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            logv = numpy.log10(numpy.asarray(specgram.value, dtype=float))
+        # non-positive (and NaN) values are counted as underflow
+        index = numpy.full(logv.shape, UNDERFLOW, dtype=numpy.int64)
+        finite = numpy.isfinite(logv)
+        index[finite] = numpy.floor(logv[finite] /
+                                    self.resolution).astype(numpy.int64)
+        if self.offset is None:
+            masked = numpy.ma.masked_array(index, mask=~finite)
+            centre = numpy.ma.median(masked, axis=0).filled(0)
+            self.offset = centre.astype(numpy.int64) - self.nbins // 2
+        self._widen(index.T)
+        self._add(index.T)
+        if segment is None:
+            segment = specgram.span
+        self.segments.append(Segment(*map(float, segment)))
+        self.segments.coalesce()
+
+    def covers(self, segments):
+        """Returns `True` if all of the given segments have been recorded
+        """
+        return not abs(SegmentList(segments) - self.segments)
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one
+
+        The other histogram must have the same frequencies and bin width.
+        If its segments are already covered by this histogram (e.g. the
+        same day read from two archives) it is ignored, since its counts
+        have already been recorded.
+
+        Raises
+        ------
+        ValueError
+            if the histograms are incompatible, or if their segments
+            overlap only partially, in which case the counts for the
+            overlap cannot be separated from the rest
+        """
+        self._check_compatible(other.f0, other.df, other.nfreq)
+        if not numpy.isclose(other.resolution, self.resolution):
+            raise ValueError("Cannot merge histograms with different "
+                             "resolution")
+        if other.offset is None or self.covers(other.segments):
+            return self
+        if abs(self.segments & other.segments):
+            raise ValueError("Cannot merge histograms with partially "
+                             "overlapping segments")
+        index = other.offset[:, None] + numpy.arange(other.nbins)[None, :]
+        if self.offset is None:
+            self.offset = other.offset.copy()
+        self._widen(numpy.where(other.counts > 0, index, UNDERFLOW))
+        self._add(index, weights=other.counts.astype(numpy.uint64))
+        self.under += other.under
+        self.over += other.over
+        self.segments.extend(other.segments)
+        self.segments.coalesce()
+        return self
+
+    def percentile(self, q):
+        """Return the ``q``-th percentile amplitude at each frequency
+
+        The percentile is linearly interpolated in ``log10`` amplitude
+        within the bin that contains it, so the precision is much better
+        than the bin width.
+
+        Parameters
+        ----------
+        q : `float`
+            the percentile to calculate, between 0 and 100
+
+        Returns
+        -------
+        values : `numpy.ndarray`
+            the percentile amplitude at each frequency, percentiles that
+        fall in the under- or overflow are clipped to the binned range
+        """
+        if self.offset is None:
+            raise ValueError("Cannot calculate percentile of empty "
+                             "histogram")
+        counts = self.counts.astype(float)
+        cum = numpy.cumsum(counts, axis=1) + self.under[:, None]
+        total = cum[:, -1] + self.over
+        target = q / 100. * total
+        outside = (((target <= self.under) & (self.under > 0)) |
+                   (target > cum[:, -1]))
+        if outside.any():
+            warnings.warn("%s percentile is outside of the binned range "
+                          "for %d of %d frequencies, and has been clipped"
+                          % (q, outside.sum(), self.nfreq))
+        # first bin whose cumulative count reaches the target
+        idx = (cum < target[:, None]).sum(axis=1)
+        idx = numpy.clip(idx, 0, self.nbins - 1)
+        rows = numpy.arange(self.nfreq)
+        below = cum[rows, idx] - counts[rows, idx]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            frac = numpy.clip((target - below) / counts[rows, idx], 0, 1)
+        frac[~numpy.isfinite(frac)] = 0.5
+        return 10 ** ((self.offset + idx + frac) * self.resolution)
+
+    def to_histogram(self, bins):
+        """Re-bin the counts onto the given amplitude bins
+
+        Each fine bin is assigned, in its entirety, to the output bin
+        containing its centre, under- and overflow counts are dropped.
+
+        Parameters
+        ----------
+        bins : `numpy.ndarray`
+            the amplitude bin edges, of length ``nbins + 1``
+
+        Returns
+        -------
+        counts : `numpy.ndarray`
+            ``(nfreq, nbins)`` array of counts in each bin
+        """
+        bins = numpy.asarray(bins, dtype=float)
+        out = numpy.zeros((self.nfreq, bins.size - 1))
+        if self.offset is None:
+            return out
+        centres = 10 ** ((self.offset[:, None] + numpy.arange(self.nbins) +
+                          .5) * self.resolution)
+        idx = numpy.searchsorted(bins, centres, side='right') - 1
+        keep = (idx >= 0) & (idx < bins.size - 1)
+        rows = numpy.arange(self.nfreq)[:, None].repeat(self.nbins, axis=1)
+        numpy.add.at(out, (rows[keep], idx[keep]), self.counts[keep])
+        return out
+
+    # -- I/O ------------------------------------
+
+    def write(self, group, name):
+        """Write this histogram to a new HDF5 group
+
+        Parameters
+        ----------
+        group : `h5py.Group`
+            the parent group
+
+        name : `str`
+            the name of the new group
+        """
+        h5g = group.create_group(name)
+        for attr in ['f0', 'df', 'nfreq', 'resolution', 'nbins']:
+            h5g.attrs[attr] = getattr(self, attr)
+        h5g.attrs['unit'] = str(self.unit or '')
+        h5g.create_dataset('segments', data=numpy.array(
+            [map(float, seg) for seg in self.segments]).reshape(-1, 2))
+        if self.offset is not None:
+            h5g.create_dataset('offset', data=self.offset)
+            h5g.create_dataset('counts', data=self.counts,
+                               compression='gzip')
+            h5g.create_dataset('under', data=self.under)
+            h5g.create_dataset('over', data=self.over)
+        return h5g
+
+    @classmethod
+    def read(cls, h5g):
+        """Read a histogram from an HDF5 group written by `write`
+        """
+        attrs = h5g.attrs
+        new = cls(attrs['f0'], attrs['df'], attrs['nfreq'],
+                  unit=units.Unit(attrs['unit']) if attrs['unit'] else None,
+                  resolution=attrs['resolution'], nbins=attrs['nbins'])
+        new.segments = SegmentList(Segment(*seg) for
+                                   seg in h5g['segments'][()])
+        if 'offset' in h5g:
+            new.offset = h5g['offset'][()].astype(numpy.int64)
+            new.counts[:] = h5g['counts'][()]
+            new.under[:] = h5g['under'][()]
+            new.over[:] = h5g['over'][()]
+        return new
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Track and limit the memory held in the `globalv` data buffers
+
+Each `add_xxx` method records the number of bytes held for its key via
+:meth:`record`, and each accessor marks its key as recently used via
+:meth:`touch`. When the total exceeds `globalv.MEMORY_LIMIT` the least
+recently used evictable entries (raw data, preferring those from which
+spectrograms have already been calculated) are moved out of memory into
+files in `globalv.MEMMAP_DIRECTORY` (or the system temporary directory),
+so that they are still available to write to the data archive at the
+end of the run. That directory should be on disk, not ``tmpfs``,
+otherwise eviction frees no memory at all.
+
+Floating-point time-series data can also be stored at reduced precision,
+either for all channels via ``storage-dtype`` in the ``[DEFAULT]`` section
+of the configuration (setting `globalv.STORAGE_DTYPE`), or for a single
+channel via the ``storage-dtype`` option of that channel's section, e.g.::
+
+   [H1:PEM-CS_ACC_PSL_PERISCOPE_X_DQ]
+   storage-dtype = float32
+
+Spectrograms are always stored at the precision in which they were
+calculated, since the PSD of (e.g.) strain data, around 1e-46, is below
+the smallest float32 subnormal.
+
+Consumers that need full precision (e.g. the range calculation) can
+override this for a given key with :meth:`require_precision`.
+"""
+
+import re
+import threading
+from contextlib import contextmanager
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy
+
+from .. import globalv
+from ..utils import vprint
+from .spill import (is_file_backed, spill_to_disk)
+from .store import allocated_nbytes
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['parse_size', 'record', 'touch', 'pin', 'unpin', 'pinned',
+           'set_evictable', 'set_derived', 'get_usage', 'evict',
+           'get_storage_dtype', 'to_storage_dtype', 'require_precision']
+
+STORES = ['DATA', 'SPECTROGRAMS', 'COHERENCE_COMPONENTS']
+
+UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+re_size = re.compile('\A\s*(?P<value>[0-9.]+)\s*(?P<unit>[KMGT]?)i?B?\s*\Z',
+                     re.I)
+
+# (store, key) -> nbytes, ordered from least- to most-recently used
+_USAGE = OrderedDict()
+# store -> running total of nbytes recorded in _USAGE
+_TOTALS = {}
+# (store, key) pairs that can be moved to disk when over the limit
+_EVICTABLE = set()
+# DATA keys from which spectral data have been calculated
+_DERIVED = set()
+# key -> number of active pins, keys here are never dropped
+_PINNED = {}
+# key -> storage dtype, overriding channel and global settings
+_DTYPES = {}
+# guard for the above, data may be read from multiple threads
+_LOCK = threading.RLock()
+
+
+def parse_size(size):
+    """Parse a human-readable memory size into a number of bytes
+
+    Parameters
+    ----------
+    size : `str`, `int`
+        the size to parse, e.g. ``'32G'``, ``'512 MB'``, or ``1024``
+
+    Returns
+    -------
+    nbytes : `int`
+        the number of bytes
+
+    Raises
+    ------
+    ValueError
+        if the size cannot be parsed
+
+    Examples
+    --------
+    >>> parse_size('32G')
+    34359738368
+    """
+    if isinstance(size, (int, long, float)):
+        return int(size)
+    try:
+        match = re_size.match(str(size)).groupdict()
+    except AttributeError:
+        raise ValueError("Cannot parse memory size %r" % size)
+    return int(float(match['value']) * UNITS[match['unit'].upper()])
+
+
+def _get_store(store):
+    return getattr(globalv, store)
+
+
+def _nbytes(serieslist):
+    # file-backed data live in the page cache, not the heap
+    return sum(allocated_nbytes(series) for series in serieslist if
+               not is_file_backed(series))
+
+
+def get_usage(store=None):
+    """Return the total number of bytes recorded for one or all stores
+    """
+    with _LOCK:
+        if store is None:
+            return sum(_TOTALS.itervalues())
+        return _TOTALS.get(store, 0)
+
+
+def _forget(store, key):
+    """Remove the usage record for a key, returning its size
+    """
+    nbytes = _USAGE.pop((store, key), 0)
+    _TOTALS[store] = _TOTALS.get(store, 0) - nbytes
+    return nbytes
+
+
+def touch(store, key):
+    """Mark the given key as most-recently used
+    """
+    with _LOCK:
+        try:
+            nbytes = _USAGE.pop((store, key))
+        except KeyError:
+            return
+        _USAGE[(store, key)] = nbytes
+
+
+def record(store, key):
+    """Record the current size of the given key, evicting if necessary
+
+    Parameters
+    ----------
+    store : `str`
+        name of the `globalv` buffer, one of `STORES`
+
+    key : `str`
+        the key whose memory usage has changed
+    """
+    with _LOCK:
+        _forget(store, key)
+        try:
+            nbytes = _nbytes(_get_store(store)[key])
+        except KeyError:
+            return
+        _USAGE[(store, key)] = nbytes
+        _TOTALS[store] += nbytes
+        total = get_usage()
+        if globalv.MEMORY_LIMIT and total > globalv.MEMORY_LIMIT:
+            evict(total - globalv.MEMORY_LIMIT)
+
+
+def set_evictable(store, key, evictable=True):
+    """Declare whether the data for the given key can be moved to disk
+    """
+    if evictable:
+        _EVICTABLE.add((store, key))
+    else:
+        _EVICTABLE.discard((store, key))
+
+
+def set_derived(*keys):
+    """Record that spectral data have been calculated from the given
+    `globalv.DATA` keys, so that their data are evicted first
+    """
+    with _LOCK:
+        _DERIVED.update(keys)
+
+
+def pin(*keys):
+    """Protect the given keys from eviction until they are unpinned
+
+    Pins are counted, so a key is only released once every call to
+    `pin` has been matched by a call to :meth:`unpin`.
+    """
+    with _LOCK:
+        for key in keys:
+            _PINNED[key] = _PINNED.get(key, 0) + 1
+
+
+def unpin(*keys):
+    """Release keys previously protected with :meth:`pin`
+    """
+    with _LOCK:
+        for key in keys:
+            count = _PINNED.get(key, 0) - 1
+            if count > 0:
+                _PINNED[key] = count
+            else:
+                _PINNED.pop(key, None)
+
+
+@contextmanager
+def pinned(*keys):
+    """Context manager to protect the given keys from eviction
+
+    Examples
+    --------
+    >>> with pinned('H1:GDS-CALIB_STRAIN'):
+    ...     data = get_timeseries('H1:GDS-CALIB_STRAIN', segments)
+    """
+    pin(*keys)
+    try:
+        yield
+    finally:
+        unpin(*keys)
+
+
+def evict(nbytes):
+    """Move least-recently used, evictable entries from memory to disk
+
+    Evicted data remain in their `globalv` buffer, but are backed by
+    memory-mapped files (see `~gwsumm.data.spill.spill_to_disk`), so no
+    longer count towards the memory usage.
+
+    Parameters
+    ----------
+    nbytes : `int`
+        the (minimum) number of bytes to free
+
+    Returns
+    -------
+    freed : `int`
+        the number of bytes actually freed, which may be less than
+        requested if not enough entries are evictable
+    """
+    with _LOCK:
+        freed = 0
+        # first pass only evicts data that have already been processed into
+        # spectrograms, second pass evicts anything else that is evictable
+        for derived in (True, False):
+            for (store, key) in list(_USAGE):
+                if freed >= nbytes:
+                    return freed
+                if (store, key) not in _EVICTABLE or key in _PINNED:
+                    continue
+                if derived and key not in _DERIVED:
+                    continue
+                size = _forget(store, key)
+                serieslist = _get_store(store).get(key, [])
+                for i, series in enumerate(serieslist):
+                    # assign via list to preserve any index
+                    list.__setitem__(serieslist, i, spill_to_disk(series))
+                _EVICTABLE.discard((store, key))
+                freed += size
+                vprint("    Memory limit exceeded, moved %s[%r] to disk "
+                       "[%.1f MB]\n" % (store, key, size / 1024. ** 2))
+        return freed
+
+
+# -- storage precision --------------------------------------------------------
+
+def get_storage_dtype(key, channel=None):
+    """Return the dtype in which to store floating-point data for a key
+
+    Parameters
+    ----------
+    key : `str`
+        the `globalv` key for these data
+
+    channel : `~gwpy.detector.Channel`, optional
+        the channel these data were read for, whose ``storage_dtype``
+        attribute (if set) takes precedence over `globalv.STORAGE_DTYPE`
+
+    Returns
+    -------
+    dtype : `numpy.dtype`, `None`
+        the storage dtype, or `None` to store data as given
+    """
+    try:
+        dtype = _DTYPES[key]
+    except KeyError:
+        dtype = getattr(channel, 'storage_dtype', None)
+        if dtype is None:
+            dtype = globalv.STORAGE_DTYPE
+    if dtype is None:
+        return None
+    return numpy.dtype(dtype)
+
+
+def to_storage_dtype(series, key, channel=None):
+    """Convert a floating-point series to the storage dtype for its key
+
+    Only the precision of the data is reduced, never increased, and
+    non-floating-point data (e.g. state vectors) are always stored as
+    given.
+
+    Parameters
+    ----------
+    series : `~gwpy.types.Array`
+        the data to be stored
+
+    key : `str`
+        the `globalv` key for these data
+
+    channel : `~gwpy.detector.Channel`, optional
+        the channel these data were read for
+
+    Returns
+    -------
+    series : `~gwpy.types.Array`
+        the input ``series``, or a copy in the storage dtype
+    """
+    dtype = get_storage_dtype(key, channel=channel)
+    if dtype is None or series.dtype.kind not in 'fc':
+        return series
+    if series.dtype.kind == 'c':
+        dtype = numpy.result_type(dtype, numpy.complex64)
+    if dtype.itemsize >= series.dtype.itemsize:
+        return series
+    new = series.value.astype(dtype).view(type(series))
+    new.__array_finalize__(series)
+    return new
+
+
+def require_precision(store, key, dtype=numpy.float64):
+    """Store all data for a key with at least the given precision
+
+    Any data already stored for this key at lower precision are dropped,
+    so that they are recalculated at full precision on the next request.
+
+    Parameters
+    ----------
+    store : `str`
+        name of the `globalv` buffer, one of `STORES`
+
+    key : `str`
+        the key whose data should be stored at full precision
+
+    dtype : `type`, `numpy.dtype`, optional
+        the minimum storage precision
+    """
+    dtype = numpy.dtype(dtype)
+    with _LOCK:
+        _DTYPES[key] = dtype
+        try:
+            stored = _get_store(store)[key]
+        except KeyError:
+            return
+        for i in range(len(stored))[::-1]:
+            if (stored[i].dtype.kind in 'fc' and
+                    stored[i].dtype.itemsize < dtype.itemsize):
+                stored.pop(i)
+        record(store, key)
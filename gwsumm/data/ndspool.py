@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pool of NDS2 connections shared for the whole job
+
+Large requests are split into jobs of (group of channels, chunk of time),
+that are fetched concurrently on separate connections, then reassembled
+in order. The pool is configured via the ``[nds]`` section of the
+configuration::
+
+   [nds]
+   host = nds.ligo.caltech.edu
+   port = 31200
+   connections = 4
+   chunk = 3600
+   channels-per-fetch = 32
+   retries = 3
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+from time import sleep
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy
+
+import nds2
+
+from ..config import NoOptionError
+from ..utils import vprint
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['NDSConnectionPool', 'get_nds_pool']
+
+_NDS_POOL = {}
+
+
+class NDSConnectionPool(object):
+    """A reusable set of connections to a single NDS2 server
+
+    Parameters
+    ----------
+    host : `str`
+        name of the NDS2 server
+
+    port : `int`
+        port number for the NDS2 server
+
+    size : `int`, optional
+        maximum number of concurrent connections
+
+    chunk : `int`, optional
+        maximum duration (seconds) of data to fetch in a single request
+
+    groupsize : `int`, optional
+        maximum number of channels to fetch in a single request
+
+    retries : `int`, optional
+        number of times to retry a failed request, with exponential
+        back-off between attempts
+
+    connect : `callable`, optional
+        method to open a new connection as ``connect(host, port)``,
+        defaults to opening an `nds2.connection`
+    """
+    def __init__(self, host, port, size=4, chunk=3600, groupsize=32,
+                 retries=3, connect=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.chunk = chunk
+        self.groupsize = groupsize
+        self.retries = retries
+        if connect is not None:
+            self._connect = connect
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _connect(host, port):
+        try:
+            return nds2.connection(host, port)
+        except RuntimeError as e:
+            if 'SASL authentication' in str(e):
+                from gwpy.io.nds import kinit
+                kinit()
+                return nds2.connection(host, port)
+            raise
+
+    # -- connection handling --------------------
+
+    def acquire(self):
+        """Return an idle connection from the pool, or open a new one
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect(self.host, self.port)
+
+    def release(self, connection, broken=False):
+        """Return a connection to the pool
+
+        Connections marked as ``broken`` are dropped rather than reused.
+        """
+        if broken:
+            return
+        with self._lock:
+            self._idle.append(connection)
+
+    # -- data access ----------------------------
+
+    def jobs(self, channels, start, end):
+        """Split a request into (channels, start, end) jobs
+        """
+        groups = [channels[i:i+self.groupsize] for
+                  i in range(0, len(channels), self.groupsize)]
+        chunks = []
+        t = start
+        while t < end:
+            chunks.append((t, min(t + self.chunk, end)))
+            t += self.chunk
+        return [(group, a, b) for group in groups for (a, b) in chunks]
+
+    def _fetch_job(self, DictClass, channels, start, end, **kwargs):
+        for attempt in range(self.retries + 1):
+            connection = self.acquire()
+            try:
+                data = DictClass.fetch(channels, start, end,
+                                       connection=connection, **kwargs)
+            except RuntimeError as e:
+                self.release(connection, broken=True)
+                if attempt == self.retries:
+                    raise
+                wait = 2 ** attempt
+                vprint("    NDS fetch for [%d, %d) failed (%s), retrying in "
+                       "%d seconds\n" % (start, end, str(e), wait))
+                sleep(wait)
+            else:
+                self.release(connection)
+                return data
+
+    def fetch(self, DictClass, channels, start, end, **kwargs):
+        """Fetch data for the given channels, in parallel if needed
+
+        Parameters
+        ----------
+        DictClass : `type`
+            the dict class to use, e.g.
+            `~gwpy.timeseries.TimeSeriesDict`
+
+        channels : `list` of `~gwpy.detector.Channel`
+            the channels to fetch
+
+        start : `int`
+            GPS start time of the request
+
+        end : `int`
+            GPS end time of the request
+
+        **kwargs
+            other keyword arguments are passed to ``DictClass.fetch``
+
+        Returns
+        -------
+        data : ``DictClass``
+            the data for each channel, covering ``[start, end)``
+
+        Raises
+        ------
+        ValueError
+            if the pieces returned for a channel are not contiguous
+        """
+        jobs = self.jobs(channels, start, end)
+
+        def _fetch(job):
+            return self._fetch_job(DictClass, *job, **kwargs)
+
+        nthreads = min(self.size, len(jobs))
+        if nthreads <= 1:
+            results = map(_fetch, jobs)
+        else:
+            pool = ThreadPool(nthreads)
+            try:
+                results = pool.map(_fetch, jobs)
+            finally:
+                pool.close()
+        # reassemble data in time order for each channel
+        parts = OrderedDict()
+        for data in results:
+            for channel, series in data.iteritems():
+                parts.setdefault(channel, []).append(series)
+        out = DictClass()
+        for channel, series in parts.iteritems():
+            series.sort(key=lambda ts: ts.span[0])
+            if len(series) == 1:
+                out[channel] = series[0]
+                continue
+            for a, b in zip(series[:-1], series[1:]):
+                if a.is_contiguous(b) != 1:
+                    raise ValueError("NDS data for %s are not contiguous "
+                                     "at %s" % (channel, b.span[0]))
+            # join once, keeping all metadata (e.g. StateVector bits)
+            first = series[0]
+            joined = numpy.concatenate(
+                [ts.value for ts in series]).view(type(first))
+            joined.__array_finalize__(first)
+            try:
+                del joined.xindex
+            except AttributeError:
+                pass
+            out[channel] = joined
+        return out
+
+
+def get_nds_pool(config):
+    """Return the `NDSConnectionPool` for the configured NDS server
+
+    Parameters
+    ----------
+    config : `~gwsumm.config.GWSummConfigParser`
+        the job configuration, with an ``[nds]`` section
+
+    Returns
+    -------
+    pool : `NDSConnectionPool`
+        the (shared) connection pool for ``[nds] host`` and ``port``
+    """
+    host = config.get('nds', 'host')
+    port = config.getint('nds', 'port')
+    try:
+        return _NDS_POOL[(host, port)]
+    except KeyError:
+        pass
+    kwargs = {}
+    for key, opt in [('size', 'connections'), ('chunk', 'chunk'),
+                     ('groupsize', 'channels-per-fetch'),
+                     ('retries', 'retries')]:
+        try:
+            kwargs[key] = config.getint('nds', opt)
+        except NoOptionError:
+            pass
+    _NDS_POOL[(host, port)] = NDSConnectionPool(host, port, **kwargs)
+    return _NDS_POOL[(host, port)]
@@ -80,7 +80,8 @@ def get_range(channel, segments, config=None, cache=None,
                                        frametype=frametype, format='psd',
                                        datafind_error=datafind_error, nds=nds,
                                        stride=stride, fftlength=fftlength,
-                                       overlap=overlap, method=method)
+                                       overlap=overlap, method=method,
+                                       dtype=numpy.float64)
         # calculate range for each PSD in each spectrogram
         for sg in spectrograms:
             ts = TimeSeries(numpy.zeros(sg.shape[0],), unit='Mpc',
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent on-disk cache of data read from GWF files
+
+Raw reads are stored as fixed-length GPS chunks, one binary file per
+(channel, frametype, dtype, chunk), named by the hash of that key. Data
+are always cached at their native sampling rate, and only resampled
+once the cached and newly-read pieces of each interval have been joined
+(see :meth:`FrameReadCache.fetch`), so that the result never depends on
+which chunks happened to be cached. Consecutive invocations over the
+same interval (e.g. day-mode pages updated every few minutes) then only
+need to decode the frames that were written since the last run.
+
+The cache is configured via the ``[read-cache]`` section of the
+configuration::
+
+   [read-cache]
+   directory = /scratch/gwsumm/read-cache
+   max-size = 50G
+   chunk = 300
+
+The ``chunk`` duration (seconds) must be a multiple of 60, so that
+minute-trend reads align with chunk boundaries.
+"""
+
+from __future__ import division
+
+import hashlib
+import json
+import os
+from math import (ceil, floor)
+
+import numpy
+
+from ..config import (NoSectionError, NoOptionError)
+from ..utils import (mkdir, vprint)
+from .memory import parse_size
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['FrameReadCache', 'get_read_cache']
+
+SECTION = 'read-cache'
+
+_READ_CACHE = {}
+
+
+class FrameReadCache(object):
+    """On-disk, content-addressed cache of raw data chunks
+
+    Parameters
+    ----------
+    directory : `str`
+        path of the cache directory
+
+    chunk : `int`, optional
+        duration (seconds) of each cached chunk
+
+    maxsize : `int`, optional
+        maximum number of bytes to hold on disk, least-recently used
+        chunks are removed beyond this
+    """
+    def __init__(self, directory, chunk=300, maxsize=None):
+        if chunk % 60:
+            raise ValueError("Read-cache chunk must be a multiple of 60 "
+                             "seconds, %r given" % chunk)
+        self.directory = directory
+        self.chunk = int(chunk)
+        self.maxsize = maxsize
+        self._size = None
+        mkdir(self.directory)
+
+    # -- file naming ----------------------------
+
+    def path(self, channel, frametype, start, rate=None, dtype=None):
+        """Return the file path for the given chunk of data
+
+        Parameters
+        ----------
+        channel : `~gwpy.detector.Channel`
+            the channel of interest
+
+        frametype : `str`
+            the frametype from which the data were read
+
+        start : `int`
+            GPS start time of the chunk
+
+        rate : `float`, optional
+            the requested (resampled) rate of the data, `None` for native
+
+        dtype : `str`, optional
+            the requested data type of the data, `None` for native
+        """
+        key = repr((str(getattr(channel, 'ndsname', channel)), str(frametype),
+                    rate is None and 'native' or float(rate),
+                    dtype is None and 'native' or str(numpy.dtype(dtype)),
+                    int(start), self.chunk))
+        hash_ = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, hash_[:2], '%s.npz' % hash_)
+
+    def _chunks(self, start, end):
+        """Return the GPS start times of all complete chunks in an interval
+        """
+        first = int(ceil(start / self.chunk)) * self.chunk
+        last = int(floor(end / self.chunk)) * self.chunk
+        return range(first, last, self.chunk)
+
+    # -- query ----------------------------------
+
+    def split(self, channels, frametype, start, end, rates={}, dtypes={}):
+        """Split an interval into pieces that are, or aren't, cached
+
+        Parameters
+        ----------
+        channels : `list` of `~gwpy.detector.Channel`
+            the channels to be read
+
+        frametype : `str`
+            the frametype to be read
+
+        start : `float`
+            GPS start of the read interval
+
+        end : `float`
+            GPS end of the read interval
+
+        rates : `dict`, optional
+            `(channel, rate)` dict of requested sampling rates
+
+        dtypes : `dict`, optional
+            `(channel, dtype)` dict of requested data types
+
+        Returns
+        -------
+        pieces : `list` of `tuple`
+            list of `(start, end, cached)` tuples covering the interval,
+            where ``cached`` is `True` if the data for all channels can be
+            read from the cache
+        """
+        pieces = []
+
+        def _add(a, b, cached):
+            if b <= a:
+                return
+            if pieces and pieces[-1][2] == cached and pieces[-1][1] == a:
+                pieces[-1] = (pieces[-1][0], b, cached)
+            else:
+                pieces.append((a, b, cached))
+
+        pos = start
+        for cstart in self._chunks(start, end):
+            _add(pos, cstart, False)
+            cached = all(os.path.isfile(self.path(
+                c, frametype, cstart, rate=rates.get(c),
+                dtype=dtypes.get(c))) for c in channels)
+            _add(cstart, cstart + self.chunk, cached)
+            pos = cstart + self.chunk
+        _add(pos, end, False)
+        return pieces
+
+    # -- I/O ------------------------------------
+
+    def fetch(self, reader, channels, frametype, start, end, DictClass,
+              rates={}, dtypes={}):
+        """Read data for an interval, using cached chunks where possible
+
+        Pieces of the interval that aren't cached are read with
+        ``reader``, and written to the cache. All pieces are then joined,
+        and resampled, so that the output is the same as reading the
+        whole interval at once.
+
+        Parameters
+        ----------
+        reader : `callable`
+            method to call as ``reader(start, end)`` to read data for all
+            channels at their native sampling rate, returning a
+            ``DictClass``
+
+        channels : `list` of `~gwpy.detector.Channel`
+            the channels to be read
+
+        frametype : `str`
+            the frametype to be read
+
+        start : `float`
+            GPS start of the read interval
+
+        end : `float`
+            GPS end of the read interval
+
+        DictClass : `type`
+            the type of dict to return
+
+        rates : `dict`, optional
+            `(channel, rate)` dict of requested sampling rates
+
+        dtypes : `dict`, optional
+            `(channel, dtype)` dict of requested data types
+
+        Returns
+        -------
+        data : ``DictClass``
+            a new dict of `(channel, series)` pairs
+        """
+        pieces = []
+        for (pstart, pend, cached) in self.split(channels, frametype, start,
+                                                 end, dtypes=dtypes):
+            if cached:
+                pieces.append(self.read(channels, frametype, pstart, pend,
+                                        DictClass, dtypes=dtypes))
+            else:
+                pieces.append(reader(pstart, pend))
+                self.write(pieces[-1], frametype, pstart, pend,
+                           dtypes=dtypes)
+        out = pieces[0]
+        for piece in pieces[1:]:
+            for channel, series in piece.iteritems():
+                out[channel] = out[channel].append(series, inplace=False)
+        for channel, rate in rates.iteritems():
+            if channel in out and out[channel].sample_rate.value != rate:
+                out[channel] = out[channel].resample(rate)
+        return out
+
+    def read(self, channels, frametype, start, end, DictClass, rates={},
+             dtypes={}):
+        """Read data for the given channels from the cache
+
+        The interval ``[start, end)`` must be made of complete chunks, all
+        of which are in the cache, as returned by :meth:`split`.
+
+        Returns
+        -------
+        data : ``DictClass``
+            a new dict of `(channel, series)` pairs
+        """
+        out = DictClass()
+        for channel in channels:
+            arrays = []
+            meta = None
+            for cstart in self._chunks(start, end):
+                path = self.path(channel, frametype, cstart,
+                                 rate=rates.get(channel),
+                                 dtype=dtypes.get(channel))
+                with open(path, 'rb') as f:
+                    npz = numpy.load(f)
+                    arrays.append(npz['data'])
+                    if meta is None:
+                        meta = json.loads(str(npz['meta']))
+                # mark as recently used
+                os.utime(path, None)
+            out[channel] = DictClass.EntryClass(
+                numpy.concatenate(arrays), epoch=start,
+                sample_rate=meta['sample_rate'], unit=meta['unit'],
+                name=meta['name'], channel=channel)
+        return out
+
+    def write(self, data, frametype, start, end, rates={}, dtypes={}):
+        """Write all complete chunks in the given data to the cache
+
+        Parameters
+        ----------
+        data : `dict`
+            `(channel, series)` dict of data as read from frames
+
+        frametype : `str`
+            the frametype from which the data were read
+
+        start : `float`
+            GPS start of the read interval
+
+        end : `float`
+            GPS end of the read interval
+        """
+        for channel, series in data.iteritems():
+            span = series.span
+            meta = json.dumps({
+                'sample_rate': float(series.sample_rate.value),
+                'unit': str(series.unit),
+                'name': series.name,
+            })
+            for cstart in self._chunks(max(start, span[0]),
+                                       min(end, span[1])):
+                path = self.path(channel, frametype, cstart,
+                                 rate=rates.get(channel),
+                                 dtype=dtypes.get(channel))
+                chunk = series.crop(cstart, cstart + self.chunk)
+                mkdir(os.path.dirname(path))
+                tmp = '%s.tmp%d' % (path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    numpy.savez(f, data=chunk.value, meta=meta)
+                os.rename(tmp, path)
+                if self._size is not None:
+                    self._size += os.path.getsize(path)
+        self.enforce_limit()
+
+    # -- size management ------------------------
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def enforce_limit(self):
+        """Remove least-recently used chunks until the cache fits `maxsize`
+        """
+        if not self.maxsize:
+            return
+        if self._size is not None and self._size <= self.maxsize:
+            return
+        files = sorted(self._scan())
+        self._size = sum(f[1] for f in files)
+        removed = 0
+        while files and self._size > self.maxsize:
+            _, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            removed += 1
+        if removed:
+            vprint("    Removed %d old chunks from read cache\n" % removed)
+
+
+def get_read_cache(config):
+    """Return the `FrameReadCache` configured for this job, if any
+
+    Parameters
+    ----------
+    config : `~gwsumm.config.GWSummConfigParser`
+        the job configuration, with a ``[read-cache]`` section
+
+    Returns
+    -------
+    cache : `FrameReadCache` or `None`
+        the cache, or `None` if none was configured
+    """
+    try:
+        directory = config.get(SECTION, 'directory')
+    except (NoSectionError, NoOptionError):
+        return None
+    directory = os.path.abspath(os.path.expanduser(directory))
+    try:
+        return _READ_CACHE[directory]
+    except KeyError:
+        pass
+    try:
+        chunk = config.getint(SECTION, 'chunk')
+    except NoOptionError:
+        chunk = 300
+    try:
+        maxsize = parse_size(config.get(SECTION, 'max-size'))
+    except NoOptionError:
+        maxsize = None
+    _READ_CACHE[directory] = FrameReadCache(directory, chunk=chunk,
+                                            maxsize=maxsize)
+    return _READ_CACHE[directory]
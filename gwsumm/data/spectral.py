@@ -22,7 +22,7 @@
 from __future__ import division
 
 import operator
-import warnings
+from functools import partial
 try:
     from collections import OrderedDict
 except ImportError:
@@ -35,7 +35,7 @@ import numpy
 
 from astropy import units
 
-from gwpy.segments import (DataQualityFlag, SegmentList)
+from gwpy.segments import (DataQualityFlag, Segment, SegmentList)
 try:
     from gwpy.frequencyseries import FrequencySeries
 except ImportError:
@@ -46,8 +46,16 @@ from .. import globalv
 from ..utils import (vprint, count_free_cores, safe_eval)
 from ..channels import (get_channel, re_channel,
                         split_combination as split_channel_combination)
-from .utils import (use_segmentlist, make_globalv_key, get_fftparams)
+from .utils import (use_segmentlist, make_globalv_key, get_fftparams,
+                    pin_channels)
 from .mathutils import get_with_math
+from .store import get_indexed_list
+from . import memory
+from .spill import spill_overlaps
+from .fftengine import (batch_spectrogram, prepare_fft)
+from .fftpool import SpectrogramScheduler
+from .filters import apply_power_response
+from .histogram import SpectralHistogram
 from .timeseries import (get_timeseries, get_timeseries_dict)
 
 OPERATOR = {
@@ -64,9 +72,13 @@ __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 def get_spectrogram(channel, segments, config=None, cache=None,
                     query=True, nds=None, format='power', return_=True,
                     frametype=None, multiprocess=True, datafind_error='raise',
-                    **fftparams):
+                    dtype=None, **fftparams):
     """Retrieve the time-series and generate a spectrogram of the given
     channel
+
+    If ``dtype`` is given, any spectrogram data already stored for this
+    channel at lower precision (e.g. read from an archive) are dropped and
+    recalculated.
     """
     channel = get_channel(channel)
 
@@ -79,7 +91,7 @@ def get_spectrogram(channel, segments, config=None, cache=None,
                                       return_=return_, frametype=frametype,
                                       multiprocess=multiprocess,
                                       datafind_error=datafind_error,
-                                      **fftparams))
+                                      dtype=dtype, **fftparams))
     if return_ and len(channels) == 1:
         return specs[0]
     elif return_:
@@ -88,23 +100,49 @@ def get_spectrogram(channel, segments, config=None, cache=None,
             config=config, query=False, format=format, return_=True)
 
 
+def _get_nproc(multiprocess):
+    """Return the number of processes to use for a ``multiprocess``
+    argument
+    """
+    if multiprocess is True:
+        return count_free_cores()
+    elif multiprocess is False:
+        return 1
+    return multiprocess
+
+
+def _default_method(channel):
+    """Return the method used for spectrograms already calculated for
+    this channel, or ``'welch'``
+    """
+    methods = set([key.split(';')[1] for key in globalv.SPECTROGRAMS
+                   if key.startswith('%s;' % channel.ndsname)])
+    try:
+        return list(methods)[0]
+    except IndexError:
+        return 'welch'
+
+
 @use_segmentlist
+@pin_channels
 def _get_spectrogram(channel, segments, config=None, cache=None,
                      query=True, nds=None, format='power', return_=True,
                      frametype=None, multiprocess=True,
-                     datafind_error='raise', **fftparams):
-
+                     datafind_error='raise', dtype=None, scheduler=None,
+                     **fftparams):
+    """Internal method to retrieve (or calculate) the spectrogram of a
+    single channel
+
+    If a `~gwsumm.data.fftpool.SpectrogramScheduler` is given, new
+    spectrograms are queued on it (and stored when it is run), rather
+    than calculated here.
+    """
     channel = get_channel(channel)
 
     # if we aren't given a method, check to see whether data have already
     # been processed, if so, choose that one
     if fftparams.get('method', None) is None:
-        methods = set([key.split(';')[1] for key in globalv.SPECTROGRAMS
-                       if key.startswith('%s;' % channel.ndsname)])
-        try:
-            fftparams['method'] = list(methods)[0]
-        except IndexError:
-            fftparams['method'] = 'welch'
+        fftparams['method'] = _default_method(channel)
 
     # clean fftparams dict using channel default values
     fftparams = get_fftparams(channel, **fftparams)
@@ -118,6 +156,10 @@ def _get_spectrogram(channel, segments, config=None, cache=None,
     # keep FftParams as a dict for convenience
     fftparams = fftparams.dict()
 
+    # override reduced-precision storage for this key
+    if dtype is not None:
+        memory.require_precision('SPECTROGRAMS', key, dtype)
+
     # extract spectrogram stride from dict
     try:
         stride = float(fftparams.pop('stride'))
@@ -131,85 +173,80 @@ def _get_spectrogram(channel, segments, config=None, cache=None,
     new = segments - havesegs
 
     # get processes
-    if multiprocess is True:
-        nproc = count_free_cores()
-    elif multiprocess is False:
-        nproc = 1
-    else:
-        nproc = multiprocess
+    nproc = _get_nproc(multiprocess)
 
-    globalv.SPECTROGRAMS.setdefault(key, SpectrogramList())
+    stored = get_indexed_list(globalv.SPECTROGRAMS, key, SpectrogramList)
 
     query &= abs(new) != 0
     if query:
         # read channel information
-        try:
-            filter_ = channel.frequency_response
-        except AttributeError:
+        filter_ = _get_frequency_response(channel)
+        if fftparams['method'] in ['rayleigh']:
             filter_ = None
+
+        # continue from the samples left over by the last calculation
+        incremental = globalv.INCREMENTAL_SPECTROGRAMS
+        if incremental:
+            tail, readsegs = _find_tail(key, new)
         else:
-            if isinstance(filter_, str):
-                filter_ = safe_eval(filter_, strict=True)
+            tail, readsegs = None, new
 
         # get time-series data
-        timeserieslist = get_timeseries(channel, new, config=config,
+        timeserieslist = get_timeseries(channel, readsegs, config=config,
                                         cache=cache, frametype=frametype,
                                         multiprocess=nproc, query=query,
                                         datafind_error=datafind_error, nds=nds)
+        if tail is not None:
+            timeserieslist = _prepend_tail(key, tail, timeserieslist)
         # calculate spectrograms
-        if len(timeserieslist):
+        run = scheduler is None
+        if run:
+            scheduler = SpectrogramScheduler(nproc)
+        if run and len(timeserieslist):
             vprint("    Calculating (%s) spectrograms for %s"
                    % (fftparams['method'], str(channel)))
+
+        def _store(specgram, full=None):
+            _store_spectrogram(specgram, channel, key, filter_=filter_)
+            if full is not None:
+                _store_tail(key, full, specgram.span[1])
+            vprint('.')
+
         for ts in timeserieslist:
             # if too short for a single segment, continue
             if abs(ts.span) < (stride + fftparams.get('overlap', 0)):
+                if incremental:
+                    _store_tail(key, ts, ts.span[0])
                 continue
             # truncate timeseries to integer number of strides
+            full = ts
             d = size_for_spectrogram(ts.duration.to('s').value, stride,
                                      fftparams['fftlength'],
                                      fftparams.get('overlap', 0))
             ts = ts.crop(ts.span[0], ts.span[0] + d, copy=False)
-            # calculate spectrogram
-            try:
-                specgram = ts.spectrogram(stride, nproc=nproc, **fftparams)
-            except ZeroDivisionError:
-                if stride == 0:
-                    raise ZeroDivisionError("Spectrogram stride is 0")
-                elif fftparams['fftlength'] == 0:
-                    raise ZeroDivisionError("FFT length is 0")
-                else:
-                    raise
-            except ValueError as e:
-                if 'has no unit' in str(e):
-                    unit = ts.unit
-                    ts._unit = units.Unit('count')
-                    specgram = ts.spectrogram(stride, nproc=nproc, **fftparams)
-                    specgram._unit = unit ** 2 / units.Hertz
-                else:
-                    raise
-            if filter_ and fftparams['method'] not in ['rayleigh']:
-                # manually setting x0 is a hack against precision error
-                # somewhere inside the **(1/2.) operation (Quantity)
-                x0 = specgram.x0.value
-                specgram = (specgram ** (1/2.)).filter(*filter_,
-                                                       inplace=True) ** 2
-                specgram.x0 = x0
-            if specgram.unit is None:
-                specgram._unit = channel.unit
-            elif len(globalv.SPECTROGRAMS[key]):
-                specgram._unit = globalv.SPECTROGRAMS[key][-1].unit
-            add_spectrogram(specgram, key=key)
-            vprint('.')
-        if len(timeserieslist):
-            vprint('\n')
+            # always calculate in double precision, the squared
+            # amplitudes of (e.g.) strain data underflow float32
+            if ts.dtype == numpy.float32:
+                ts = ts.astype(numpy.float64)
+            # use the shared FFT plan and window for this length
+            prepare_fft(fftparams['fftlength'] * ts.sample_rate.value,
+                        fftparams.get('window'), ts.dtype)
+            # queue spectrogram, keeping the full data for the tail
+            scheduler.add(ts, stride, fftparams, partial(
+                _store, full=full if incremental else None))
+        if run:
+            scheduler.run()
+            if len(timeserieslist):
+                vprint('\n')
 
     if not return_:
         return
 
     # return correct data
+    memory.touch('SPECTROGRAMS', key)
     out = SpectrogramList()
-    for specgram in globalv.SPECTROGRAMS[key]:
-        for seg in segments:
+    for seg in segments:
+        for specgram in stored.overlaps(seg):
             if abs(seg) < specgram.dt.value:
                 continue
             if specgram.span.intersects(seg):
@@ -220,25 +257,66 @@ def _get_spectrogram(channel, segments, config=None, cache=None,
                     s = s**(1/2.)
                 elif format in ['rayleigh']:
                     # XXX FIXME: this corrects the bias offset in Rayleigh
+                    # (not in-place, s is a view of the stored data)
                     med = numpy.median(s.value)
-                    s /= med
+                    s = s / med
                 if s.shape[0]:
                     out.append(s)
     return out.coalesce()
 
 
-def get_spectrum(channel, segments, config=None, cache=None, query=True,
-                 nds=None, format='power', return_=True, **fftparams):
-    """Retrieve the time-series and generate a spectrogram of the given
-    channel
+def _spectrum_name(channel, segments, format):
+    """Return the `globalv.SPECTRUM` key, and segments, for a spectrum
     """
-    channel = get_channel(channel)
     if isinstance(segments, DataQualityFlag):
         name = ','.join([channel.ndsname, segments.name])
         segments = segments.active
     else:
         name = channel.ndsname
-    name += ',%s' % format
+    return '%s,%s' % (name, format), segments
+
+
+def get_spectral_histogram(channel, segments, config=None, cache=None,
+                           query=True, nds=None, format='power',
+                           **fftparams):
+    """Return the histogram of spectrogram amplitudes for the given channel
+
+    The `~gwsumm.data.histogram.SpectralHistogram` is stored in
+    `globalv.SPECTRAL_HISTOGRAMS` (and the archive), and only updated with
+    spectrograms for segments it doesn't already cover.
+
+    Returns
+    -------
+    hist : `~gwsumm.data.histogram.SpectralHistogram`
+        the histogram, or `None` if no spectrogram data were found
+    """
+    channel = get_channel(channel)
+    name, segments = _spectrum_name(channel, segments, format)
+    hist = globalv.SPECTRAL_HISTOGRAMS.get(name, None)
+    if hist is None:
+        new = segments
+    else:
+        new = segments - hist.segments
+    # update the histogram one spectrogram at a time, never joining them
+    speclist = get_spectrogram(channel, new, config=config, cache=cache,
+                               query=query, nds=nds, format=format,
+                               **fftparams)
+    for specgram in speclist:
+        if hist is None:
+            hist = SpectralHistogram.from_spectrogram(specgram)
+        _update_histogram(hist, specgram)
+    if hist is not None:
+        globalv.SPECTRAL_HISTOGRAMS[name] = hist
+    return hist
+
+
+def get_spectrum(channel, segments, config=None, cache=None, query=True,
+                 nds=None, format='power', return_=True, **fftparams):
+    """Retrieve the time-series and generate a spectrogram of the given
+    channel
+    """
+    channel = get_channel(channel)
+    name = _spectrum_name(channel, segments, format)[0]
     cmin = '%s.min' % name
     cmax = '%s.max' % name
 
@@ -250,29 +328,19 @@ def get_spectrum(channel, segments, config=None, cache=None, query=True,
         if 'stride' not in fftparams and 'fftlength' in fftparams:
             fftparams.setdefault('stride', fftparams['fftlength'])
 
-        speclist = get_spectrogram(channel, segments, config=config,
-                                   cache=cache, query=query, nds=nds,
-                                   format=format, **fftparams)
-        try:
-            specgram = speclist.join(gap='ignore')
-        except ValueError as e:
-            if 'units do not match' in str(e):
-                warnings.warn(str(e))
-                for spec in speclist[1:]:
-                    spec.unit = speclist[0].unit
-                specgram = speclist.join(gap='ignore')
-            else:
-                raise
-        try:
-            globalv.SPECTRUM[name] = specgram.percentile(50)
-        except (ValueError, IndexError):
+        hist = get_spectral_histogram(channel, segments, config=config,
+                                      cache=cache, query=query, nds=nds,
+                                      format=format, **fftparams)
+        if hist is None or not hist.count:
             globalv.SPECTRUM[name] = FrequencySeries([], channel=channel, f0=0,
                                                      df=1, unit=units.Unit(''))
             globalv.SPECTRUM[cmin] = globalv.SPECTRUM[name]
             globalv.SPECTRUM[cmax] = globalv.SPECTRUM[name]
         else:
-            globalv.SPECTRUM[cmin] = specgram.percentile(5)
-            globalv.SPECTRUM[cmax] = specgram.percentile(95)
+            for key, q in [(name, 50), (cmin, 5), (cmax, 95)]:
+                globalv.SPECTRUM[key] = FrequencySeries(
+                    hist.percentile(q), f0=hist.f0, df=hist.df,
+                    unit=hist.unit, channel=channel)
         vprint(".\n")
 
     if not return_:
@@ -285,22 +353,45 @@ def get_spectrum(channel, segments, config=None, cache=None, query=True,
     return out
 
 
+def _update_histogram(hist, specgram):
+    """Add the rows of a spectrogram not already recorded to a histogram
+    """
+    dt = specgram.dt.value
+    times = specgram.x0.value + numpy.arange(specgram.shape[0]) * dt
+    keep = numpy.ones(times.size, dtype=bool)
+    for seg in hist.segments:
+        keep &= (times >= float(seg[1])) | (times + dt <= float(seg[0]))
+    idx = numpy.flatnonzero(keep)
+    if not idx.size:
+        return
+    i, j = idx[0], idx[-1] + 1
+    hist.update(specgram[i:j], segment=(times[i], times[j-1] + dt))
+
+
 def add_spectrogram(specgram, key=None, coalesce=True):
     """Add a `Spectrogram` to the global memory cache
     """
     if key is None:
         key = specgram.name or str(specgram.channel)
-    globalv.SPECTROGRAMS.setdefault(key, SpectrogramList())
-    globalv.SPECTROGRAMS[key].append(specgram)
-    if coalesce:
-        globalv.SPECTROGRAMS[key].coalesce()
+    stored = get_indexed_list(globalv.SPECTROGRAMS, key, SpectrogramList)
+    stored.add(specgram, coalesce=coalesce)
+    if globalv.MEMMAP_DIRECTORY:
+        spill_overlaps(stored, specgram.span)
+    memory.record('SPECTROGRAMS', key)
 
 
 @use_segmentlist
+@pin_channels
 def get_spectrograms(channels, segments, config=None, cache=None, query=True,
                      nds=None, format='power', return_=True, frametype=None,
-                     multiprocess=True, datafind_error='raise', **fftparams):
+                     multiprocess=True, datafind_error='raise', batch=True,
+                     **fftparams):
     """Get spectrograms for multiple channels
+
+    If ``batch=True`` is given (default), Welch spectrograms for channels
+    that share the same sample rate, FFT parameters and data segments are
+    calculated together using
+    :meth:`~gwsumm.data.fftengine.batch_spectrogram`.
     """
     channels = map(get_channel, channels)
     # get timeseries data in bulk
@@ -324,6 +415,22 @@ def get_spectrograms(channels, segments, config=None, cache=None, query=True,
                             multiprocess=multiprocess, frametype=frametype,
                             datafind_error=datafind_error, nds=nds,
                             return_=False)
+        if (batch and format not in ['rayleigh'] and
+                not globalv.INCREMENTAL_SPECTROGRAMS):
+            _get_spectrograms_batched(qchannels, segments, **fftparams)
+        # calculate all remaining (channel, segment) spectrograms together
+        scheduler = SpectrogramScheduler(_get_nproc(multiprocess))
+        for channel in qchannels:
+            _get_spectrogram(channel, segments, config=config, cache=cache,
+                             query=query, nds=nds, format=format,
+                             return_=False, multiprocess=multiprocess,
+                             datafind_error=datafind_error,
+                             scheduler=scheduler, **fftparams)
+        if len(scheduler):
+            vprint("    Calculating spectrograms for %d segments of %d "
+                   "channels" % (len(scheduler), len(qchannels)))
+            scheduler.run()
+            vprint('\n')
     # loop over channels and generate spectrograms
     out = OrderedDict()
     for channel in channels:
@@ -335,6 +442,145 @@ def get_spectrograms(channels, segments, config=None, cache=None, query=True,
     return out
 
 
+def _get_frequency_response(channel):
+    """Return the parsed ``frequency_response`` of a channel, or `None`
+    """
+    try:
+        filter_ = channel.frequency_response
+    except AttributeError:
+        return None
+    if isinstance(filter_, str):
+        filter_ = safe_eval(filter_, strict=True)
+    return filter_
+
+
+def _store_spectrogram(specgram, channel, key, filter_=None):
+    """Store a new spectrogram for a channel in `globalv.SPECTROGRAMS`
+
+    The frequency response ``filter_`` is applied first, if given, and the
+    unit is made consistent with any spectrograms already stored under
+    ``key``, so that new and archived data can be joined.
+    """
+    if filter_:
+        apply_power_response(specgram, filter_, channel.ndsname)
+    stored = globalv.SPECTROGRAMS.get(key, [])
+    if specgram.unit is None:
+        specgram._unit = channel.unit
+    elif len(stored):
+        specgram._unit = stored[-1].unit
+    add_spectrogram(specgram, key=key)
+    memory.set_derived(make_globalv_key(channel))
+
+
+def _get_spectrograms_batched(channels, segments, **fftparams):
+    """Calculate Welch spectrograms for groups of compatible channels
+
+    Channels are grouped by FFT parameters, sample rate, and the exact
+    span of each data segment; each group of two or more series is
+    calculated in a single call to `batch_spectrogram`, with the results
+    stored in `globalv.SPECTROGRAMS` as for `get_spectrogram`. Channels
+    using other methods are left for the per-channel path.
+    """
+    groups = OrderedDict()
+    for channel in channels:
+        fftparams_ = fftparams.copy()
+        if fftparams_.get('method', None) is None:
+            fftparams_['method'] = _default_method(channel)
+        fftparams_ = get_fftparams(channel, **fftparams_)
+        if fftparams_.method != 'welch' or not fftparams_.fftlength:
+            continue
+        key = make_globalv_key(channel, fftparams_)
+        havesegs = globalv.SPECTROGRAMS.get(key, SpectrogramList()).segments
+        for ts in get_timeseries(channel, segments - havesegs, query=False):
+            gid = (fftparams_.fftlength, fftparams_.overlap or 0,
+                   fftparams_.stride, fftparams_.window,
+                   ts.sample_rate.value, float(ts.x0.value), ts.size)
+            groups.setdefault(gid, []).append((channel, key, ts))
+
+    for gid, members in groups.iteritems():
+        fftlength, overlap, stride, window, rate = gid[:5]
+        if len(members) < 2:
+            continue
+        duration = abs(members[0][2].span)
+        if duration < stride + overlap:
+            continue
+        d = size_for_spectrogram(duration, stride, fftlength, overlap)
+        nrows = int(round(d * rate)) // int(round(stride * rate))
+        if nrows < 1:
+            continue
+        vprint("    Calculating (welch) spectrograms for %d channels "
+               "in batch" % len(members))
+        specgrams = batch_spectrogram([m[2] for m in members], stride,
+                                      fftlength, overlap=overlap,
+                                      window=window, nrows=nrows)
+        for (channel, key, ts), specgram in zip(members, specgrams):
+            _store_spectrogram(specgram, channel, key,
+                               filter_=_get_frequency_response(channel))
+            vprint('.')
+        vprint('\n')
+
+
+def _find_tail(key, segments):
+    """Find the stored tail for a spectrogram key that continues a segment
+
+    Returns
+    -------
+    tail : `~gwpy.timeseries.TimeSeries`, `None`
+        the samples left over at the end of the last spectrogram
+        calculation for this key, if they start one of the ``segments``
+
+    readsegs : `~gwpy.segments.SegmentList`
+        the segments for which data still need to be read
+    """
+    try:
+        tail = globalv.SPECTROGRAM_TAILS[key]
+    except KeyError:
+        return None, segments
+    t0, t1 = map(float, tail.span)
+    for seg in segments:
+        if abs(float(seg[0]) - t0) < tail.dt.value / 2. and seg[1] >= t1:
+            return tail, segments - SegmentList([Segment(t0, t1)])
+    return None, segments
+
+
+def _prepend_tail(key, tail, timeserieslist):
+    """Join a stored tail onto the start of the series that continues it
+
+    The tail is forgotten if no series continues it.
+    """
+    globalv.SPECTROGRAM_TAILS.pop(key, None)
+    end = float(tail.span[1])
+    out = []
+    for ts in timeserieslist:
+        if (tail is not None and ts.dt == tail.dt and
+                abs(float(ts.span[0]) - end) < ts.dt.value / 2.):
+            ts = tail.append(ts, inplace=False)
+            tail = None
+        out.append(ts)
+    return out
+
+
+def _store_tail(key, ts, start):
+    """Record the samples of ``ts`` after ``start`` as the tail for a key
+
+    These are the samples that did not fill a complete spectrogram stride,
+    which are used to continue the spectrogram when more data arrive.
+    Only the latest tail for each key is kept.
+    """
+    start = float(start)
+    end = float(ts.span[1])
+    try:
+        current = float(globalv.SPECTROGRAM_TAILS[key].span[1])
+    except KeyError:
+        current = None
+    if current is not None and current > end:
+        return
+    if end - start < ts.dt.value / 2.:
+        globalv.SPECTROGRAM_TAILS.pop(key, None)
+    else:
+        globalv.SPECTROGRAM_TAILS[key] = ts.crop(start, end, copy=True)
+
+
 def size_for_spectrogram(size, stride, fftlength, overlap):
     if size < stride:
         return None
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Back data arrays in global memory with memory-mapped buffers
+
+When `globalv.MEMMAP_DIRECTORY` is set, data added to the `globalv.DATA`
+and `globalv.SPECTROGRAMS` buffers are moved into `numpy.memmap` arrays
+backed by files in that directory, so that large datasets live in the
+page cache rather than the python heap. The files are unlinked as soon as
+they are mapped, so are removed automatically when the data are released.
+
+Independently, :meth:`share_channels` moves the data for a set of channels
+into anonymous shared mappings, so that forked plotting processes read
+the parent's pages directly, rather than duplicating them on first touch.
+Shared data are read-only, so that no process can modify the data seen
+by the others (or written to the archive); anything that needs to
+modify them must work on a copy.
+"""
+
+import mmap
+import os
+import tempfile
+
+import numpy
+
+from .. import globalv
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['is_spilled', 'is_file_backed', 'is_tmpfs', 'spill_to_disk',
+           'spill_overlaps', 'share_memory', 'share_channels']
+
+STORES = ['DATA', 'SPECTROGRAMS', 'COHERENCE_COMPONENTS']
+
+
+def is_spilled(series, types=(numpy.memmap, mmap.mmap)):
+    """Returns `True` if the given array is backed by a memory mapping
+
+    Parameters
+    ----------
+    series : `numpy.ndarray`
+        the array to test
+
+    types : `tuple` of `type`, optional
+        the mapping types to look for, give ``(numpy.memmap,)`` to only
+        match arrays backed by files on disk
+    """
+    base = series
+    while base is not None:
+        if isinstance(base, types):
+            return True
+        base = getattr(base, 'base', None)
+    return False
+
+
+def is_file_backed(series):
+    """Returns `True` if the given array is backed by a file on disk
+    """
+    return is_spilled(series, types=(numpy.memmap,))
+
+
+def is_tmpfs(path):
+    """Returns `True` if the given path is on an in-memory filesystem
+
+    Files on ``tmpfs`` (or ``ramfs``) are held in memory, so spilling
+    data there frees nothing. Returns `False` if the filesystem cannot
+    be determined (e.g. on systems without ``/proc/mounts``).
+    """
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except IOError:
+        return False
+    fstype = None
+    mount = ''
+    for mpoint, type_ in mounts:
+        if ((path == mpoint or path.startswith(mpoint.rstrip('/') + '/')) and
+                len(mpoint) >= len(mount)):
+            mount, fstype = mpoint, type_
+    return fstype in ('tmpfs', 'ramfs')
+
+
+def spill_to_disk(series, directory=None):
+    """Copy a data series into a memory-mapped file
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`, or similar
+        the data series to move
+
+    directory : `str`, optional
+        the scratch directory in which to create the file, defaults to
+        `globalv.MEMMAP_DIRECTORY`
+
+    Returns
+    -------
+    spilled : `~gwpy.timeseries.TimeSeries`, or similar
+        a new series of the same type and metadata as the input, that
+        is a view of the memory-mapped array
+    """
+    if directory is None:
+        directory = globalv.MEMMAP_DIRECTORY
+    if is_spilled(series) or not series.size:
+        return series
+    fd, path = tempfile.mkstemp(prefix='gwsumm-', suffix='.mmap',
+                                dir=directory)
+    os.close(fd)
+    try:
+        mmap = numpy.memmap(path, dtype=series.dtype, mode='w+',
+                            shape=series.shape)
+    finally:
+        # the mapping holds the file open, so we can unlink straight away
+        os.remove(path)
+    mmap[...] = series.value
+    spilled = mmap.view(type(series))
+    spilled.__array_finalize__(series)
+    return spilled
+
+
+def spill_overlaps(serieslist, segment, directory=None):
+    """Spill all series in an indexed list that overlap the given segment
+
+    This should be called after inserting new data; series merged with
+    a file-backed neighbour are already file-backed (see
+    `~gwsumm.data.store.RowBuffer`), so only new data are copied.
+    """
+    for i in serieslist.find(segment):
+        series = serieslist[i]
+        if not is_spilled(series):
+            # assign via list to preserve the index
+            list.__setitem__(serieslist, i,
+                             spill_to_disk(series, directory=directory))
+
+
+def share_memory(series):
+    """Copy a data series into an anonymous shared memory mapping
+
+    The returned series is backed by a read-only view of a ``MAP_SHARED``
+    mapping, so processes forked after this call attach to the same
+    physical pages without copying, but cannot modify them.
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`, or similar
+        the data series to move
+
+    Returns
+    -------
+    shared : `~gwpy.timeseries.TimeSeries`, or similar
+        a new series of the same type and metadata as the input, that
+        is a view of the shared mapping, without any `RowBuffer`
+        spare capacity
+    """
+    if is_spilled(series) or not series.size:
+        return series
+    buffer_ = mmap.mmap(-1, series.nbytes)
+    array = numpy.frombuffer(buffer_, dtype=series.dtype,
+                             count=series.size).reshape(series.shape)
+    array[...] = series.value
+    array.setflags(write=False)
+    shared = array.view(type(series))
+    shared.__array_finalize__(series)
+    # the RowBuffer (if any) no longer backs these data
+    shared._rowbuffer = None
+    return shared
+
+
+def share_channels(channels):
+    """Move all stored data for the given channels into shared memory
+
+    Parameters
+    ----------
+    channels : `list` of `str`
+        the names of the channels whose data should be shared, data in
+        any of the `globalv` buffers whose key refers to these channels
+        are moved
+
+    Returns
+    -------
+    nbytes : `int`
+        the number of bytes moved into shared memory
+    """
+    from .memory import record
+    names = set(map(str, channels))
+    nbytes = 0
+    for store in STORES:
+        gdict = getattr(globalv, store)
+        for key in gdict:
+            if not names.intersection(key.split(';', 1)[0].split(',')):
+                continue
+            serieslist = gdict[key]
+            shared = 0
+            for i, series in enumerate(serieslist):
+                if is_spilled(series):
+                    continue
+                shared += series.nbytes
+                list.__setitem__(serieslist, i, share_memory(series))
+            if shared:
+                # shared arrays are sized exactly, so re-count this key
+                record(store, key)
+                nbytes += shared
+    return nbytes
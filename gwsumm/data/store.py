@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Interval-indexed containers for data held in global memory
+
+The `globalv` data buffers hold one list of data series per key. The
+containers in this module keep those lists sorted by GPS start time, with
+a parallel index of start and end times, so that overlap queries bisect
+the index rather than walking every stored series for every requested
+segment.
+
+Contiguous spectrograms are merged into preallocated, growable row
+buffers (see `RowBuffer`), so that adding each new stride costs a copy of
+that stride only, rather than of everything already stored, and stored
+spectrograms (and crops of them) are views of those buffers.
+
+When `globalv.MEMMAP_DIRECTORY` is set, all contiguous series are merged
+into row buffers backed by (unlinked) files in that directory, which grow
+by extending the file, so that the data already stored are never copied
+or rewritten.
+"""
+
+import tempfile
+from bisect import (bisect_left, bisect_right)
+
+import numpy
+
+from gwpy.segments import (Segment, SegmentList)
+from gwpy.timeseries import TimeSeriesList
+try:
+    from gwpy.timeseries import StateVectorList
+except ImportError:
+    StateVectorList = TimeSeriesList
+from gwpy.spectrogram import SpectrogramList
+
+from .. import globalv
+from .spill import is_file_backed
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['IndexedTimeSeriesList', 'IndexedStateVectorList',
+           'IndexedSpectrogramList', 'RowBuffer', 'get_indexed_list',
+           'allocated_nbytes']
+
+# factor by which row buffers grow when full
+GROWTH = 1.5
+
+
+class IndexedSeriesListMixin(object):
+    """Mixin for a list of data series sorted and indexed by GPS span
+
+    Series are inserted in order of their start time, and a parallel index
+    of ``(start, end)`` times is maintained incrementally for the common
+    operations (`append`, `add`, `pop`). Any other mutation simply
+    invalidates the index, which is rebuilt on the next query.
+    """
+    def _reset_index(self):
+        self._starts = None
+        self._ends = None
+        self._overlapping = False
+        self._segments = None
+
+    def _build_index(self):
+        # restore time-ordering after any arbitrary mutation
+        list.sort(self, key=lambda series: float(series.span[0]))
+        self._starts = []
+        self._ends = []
+        self._overlapping = False
+        self._segments = None
+        for series in self:
+            start, end = map(float, series.span)
+            if self._ends and start < self._ends[-1]:
+                self._overlapping = True
+            self._starts.append(start)
+            self._ends.append(end)
+
+    @property
+    def index(self):
+        """The ``(starts, ends)`` GPS index of this list
+        """
+        if getattr(self, '_starts', None) is None:
+            self._build_index()
+        return self._starts, self._ends
+
+    @property
+    def segments(self):
+        """The (coalesced) `SegmentList` covered by this list
+
+        The coalesced list is cached until the next mutation, and a
+        (shallow) copy is returned, so callers are free to modify it.
+        """
+        starts, ends = self.index
+        if getattr(self, '_segments', None) is None:
+            self._segments = SegmentList(
+                Segment(s, e) for s, e in zip(starts, ends)).coalesce()
+        return SegmentList(self._segments)
+
+    # -- queries --------------------------------
+
+    def find(self, segment):
+        """Return the positions of all series that overlap a segment
+
+        Parameters
+        ----------
+        segment : `~gwpy.segments.Segment`
+            ``[start, end)`` GPS interval of interest
+
+        Returns
+        -------
+        indices : `list` of `int`
+            the positions in this list of each overlapping series, in order
+        """
+        starts, ends = self.index
+        start, end = map(float, segment)
+        hi = bisect_left(starts, end)
+        if self._overlapping:
+            lo = 0
+        else:
+            lo = bisect_right(ends, start)
+        return [i for i in range(lo, hi) if ends[i] > start]
+
+    def overlaps(self, segment):
+        """Return all series in this list that overlap a segment
+        """
+        return [self[i] for i in self.find(segment)]
+
+    def covers(self, segment):
+        """Returns `True` if the given segment is fully covered by this list
+
+        This walks only those series that overlap the segment, from a
+        bisection of the index.
+        """
+        starts, ends = self.index
+        start, end = map(float, segment)
+        if end <= start:
+            return True
+        cursor = start
+        for i in self.find(segment):
+            if starts[i] > cursor:
+                return False
+            cursor = max(cursor, ends[i])
+            if cursor >= end:
+                return True
+        return False
+
+    # -- insertion ------------------------------
+
+    def _check_type(self, item):
+        if not isinstance(item, self.EntryClass):
+            raise TypeError("Cannot append type '%s' to %s"
+                            % (type(item).__name__, type(self).__name__))
+
+    def add(self, item, coalesce=True):
+        """Insert a new series at the correct position in time
+
+        Parameters
+        ----------
+        item : `~gwpy.timeseries.TimeSeries`, or similar
+            the data series to insert
+
+        coalesce : `bool`, optional
+            merge the new series with its contiguous neighbours, default:
+            `True`; only the immediate neighbours are considered, so this
+            costs one merge rather than a full `coalesce` of the list
+        """
+        self._check_type(item)
+        starts, ends = self.index
+        start, end = map(float, item.span)
+        pos = bisect_right(starts, start)
+        list.insert(self, pos, item)
+        starts.insert(pos, start)
+        ends.insert(pos, end)
+        self._segments = None
+        if ((pos and ends[pos-1] > start) or
+                (pos + 1 < len(starts) and starts[pos+1] < end)):
+            self._overlapping = True
+        if coalesce:
+            if pos and self[pos-1].is_contiguous(item) == 1:
+                pos -= 1
+                self._merge_next(pos)
+            if pos + 1 < len(self) and self[pos].is_contiguous(
+                    self[pos+1]) == 1:
+                self._merge_next(pos)
+        return self
+
+    def _merge_next(self, pos):
+        """Merge the series at ``pos + 1`` onto the end of that at ``pos``
+        """
+        this = self[pos]
+        if globalv.MEMMAP_DIRECTORY or is_file_backed(this):
+            return self._merge_buffered(pos)
+        try:
+            this = this.append(self[pos+1])
+        except ValueError as e:
+            # shared (read-only) data can't be extended in place
+            if ('cannot resize this array' in str(e) or
+                    not this.flags.writeable):
+                this = this.copy().append(self[pos+1])
+            else:
+                raise
+        list.__setitem__(self, pos, this)
+        list.__delitem__(self, pos+1)
+        self._ends[pos] = self._ends.pop(pos+1)
+        del self._starts[pos+1]
+
+    def _merge_buffered(self, pos):
+        """Merge the series at ``pos + 1`` into the `RowBuffer` behind
+        that at ``pos``
+
+        The buffer is backed by a file in `globalv.MEMMAP_DIRECTORY`, if
+        set.
+        """
+        this = self[pos]
+        other = self[pos+1]
+        this.is_compatible(other)
+        buffer_ = getattr(this, '_rowbuffer', None)
+        dtype = numpy.result_type(this.dtype, other.dtype)
+        if (buffer_ is None or not buffer_.owns(this.value) or
+                buffer_.array.dtype != dtype):
+            buffer_ = RowBuffer(this.value, dtype=dtype,
+                                capacity=int((this.shape[0] +
+                                              other.shape[0]) * GROWTH) + 1,
+                                directory=globalv.MEMMAP_DIRECTORY or None)
+        new = buffer_.extend(other.value).view(type(this))
+        new.__array_finalize__(this)
+        # drop any time index inherited from the shorter array
+        try:
+            del new.xindex
+        except AttributeError:
+            pass
+        new._rowbuffer = buffer_
+        list.__setitem__(self, pos, new)
+        list.__delitem__(self, pos+1)
+        self._ends[pos] = self._ends.pop(pos+1)
+        del self._starts[pos+1]
+
+    def append(self, item):
+        """Insert a new series in time order, without coalescing
+        """
+        return self.add(item, coalesce=False)
+
+    def extend(self, items):
+        for item in items:
+            self.add(item, coalesce=False)
+        return self
+
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        if getattr(self, '_starts', None) is not None:
+            self._starts.pop(index)
+            self._ends.pop(index)
+            self._segments = None
+        return item
+
+    def coalesce(self):
+        super(IndexedSeriesListMixin, self).coalesce()
+        self._reset_index()
+        return self
+
+    # -- generic mutation invalidates the index --
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, key, value)
+        self._reset_index()
+
+    def __delitem__(self, key):
+        list.__delitem__(self, key)
+        self._reset_index()
+
+    def __setslice__(self, i, j, sequence):
+        list.__setslice__(self, i, j, sequence)
+        self._reset_index()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._reset_index()
+
+    def __iadd__(self, other):
+        return self.extend(other)
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._reset_index()
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._reset_index()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._reset_index()
+
+    def reverse(self):
+        list.reverse(self)
+        self._reset_index()
+
+
+class IndexedTimeSeriesList(IndexedSeriesListMixin, TimeSeriesList):
+    """`~gwpy.timeseries.TimeSeriesList` with a GPS interval index
+    """
+    pass
+
+
+class IndexedStateVectorList(IndexedSeriesListMixin, StateVectorList):
+    """`~gwpy.timeseries.StateVectorList` with a GPS interval index
+    """
+    pass
+
+
+class RowBuffer(object):
+    """A growable array, of which only the first `nrows` are in use
+
+    Parameters
+    ----------
+    first : `numpy.ndarray`
+        the initial rows
+
+    capacity : `int`, optional
+        the number of rows to allocate, defaults to ``GROWTH`` times the
+        number of rows in ``first``
+
+    dtype : `numpy.dtype`, optional
+        the data type of the buffer, defaults to that of ``first``
+
+    directory : `str`, optional
+        back the buffer with an (unlinked) file in this directory, rather
+        than the heap
+    """
+    def __init__(self, first, capacity=None, dtype=None, directory=None):
+        first = numpy.asarray(first)
+        if capacity is None:
+            capacity = int(first.shape[0] * GROWTH) + 1
+        if directory is None:
+            self.file = None
+        else:
+            self.file = tempfile.TemporaryFile(prefix='gwsumm-',
+                                               suffix='.mmap', dir=directory)
+        self.array = self._allocate(capacity, first.shape[1:],
+                                    numpy.dtype(dtype or first.dtype))
+        self.array[:first.shape[0]] = first
+        self.nrows = first.shape[0]
+
+    def _allocate(self, capacity, rowshape, dtype):
+        """Allocate a new array with room for ``capacity`` rows
+
+        File-backed buffers extend the file and map it again, so the
+        rows already written are kept without copying them.
+        """
+        shape = (capacity,) + tuple(rowshape)
+        if self.file is None:
+            return numpy.empty(shape, dtype=dtype)
+        self.file.truncate(int(numpy.prod(shape)) * dtype.itemsize)
+        return numpy.memmap(self.file, dtype=dtype, mode='r+', shape=shape)
+
+    @property
+    def capacity(self):
+        return self.array.shape[0]
+
+    def owns(self, array):
+        """Returns `True` if ``array`` is the view of all rows in use
+        """
+        return (array.shape[0] == self.nrows and
+                array.__array_interface__['data'][0] ==
+                self.array.__array_interface__['data'][0])
+
+    def extend(self, rows):
+        """Append rows, returning a view of all rows now in use
+
+        The buffer is only reallocated (by a factor of ``GROWTH``) when
+        full, so the cost of appending is amortised over many calls.
+        Views returned by earlier calls remain valid.
+        """
+        rows = numpy.asarray(rows)
+        end = self.nrows + rows.shape[0]
+        if end > self.capacity:
+            new = self._allocate(int(end * GROWTH) + 1, self.array.shape[1:],
+                                 self.array.dtype)
+            if self.file is None:
+                new[:self.nrows] = self.array[:self.nrows]
+            self.array = new
+        self.array[self.nrows:end] = rows
+        self.nrows = end
+        return self.array[:end]
+
+
+def allocated_nbytes(series):
+    """Return the number of bytes allocated for a stored series
+
+    This includes any spare capacity of the `RowBuffer` behind it.
+    """
+    buffer_ = getattr(series, '_rowbuffer', None)
+    if buffer_ is not None:
+        return buffer_.array.nbytes
+    return getattr(series, 'nbytes', 0)
+
+
+class IndexedSpectrogramList(IndexedSeriesListMixin, SpectrogramList):
+    """`~gwpy.spectrogram.SpectrogramList` with a GPS interval index
+
+    Contiguous spectrograms are merged by writing the new rows into
+    the spare capacity of a `RowBuffer`, rather than resizing (and
+    copying) the whole array.
+    """
+    def _merge_next(self, pos):
+        return self._merge_buffered(pos)
+
+
+INDEXED_LIST = {
+    TimeSeriesList: IndexedTimeSeriesList,
+    StateVectorList: IndexedStateVectorList,
+    SpectrogramList: IndexedSpectrogramList,
+}
+
+
+def get_indexed_list(store, key, listclass=TimeSeriesList):
+    """Return the indexed list stored in a `globalv` buffer for a key
+
+    If no list exists for the given key a new (empty) one is created,
+    and any plain list stored by other code is upgraded in-place.
+
+    Parameters
+    ----------
+    store : `dict`
+        the global memory buffer, e.g. `globalv.DATA`
+
+    key : `str`
+        the key of interest
+
+    listclass : `type`, optional
+        the (un-indexed) list class appropriate for the data
+
+    Returns
+    -------
+    serieslist : `IndexedSeriesListMixin`
+        the indexed list stored for the given key
+    """
+    try:
+        current = store[key]
+    except KeyError:
+        current = None
+    if isinstance(current, IndexedSeriesListMixin):
+        return current
+    if current is not None:
+        listclass = type(current)
+    try:
+        indexed = INDEXED_LIST[listclass]()
+    except KeyError:  # unknown type, build an index over whatever it is
+        indexed = type('Indexed%s' % listclass.__name__,
+                       (IndexedSeriesListMixin, listclass), {})()
+    if current:
+        indexed.extend(current)
+    store[key] = indexed
+    return indexed
@@ -24,9 +24,14 @@ from __future__ import division
 import operator
 import re
 import os
+import socket
+import threading
 import warnings
+from itertools import chain
 from math import (floor, ceil)
 from time import sleep
+from httplib import HTTPException
+from multiprocessing.pool import ThreadPool
 try:
     from collections import OrderedDict
 except ImportError:
@@ -54,8 +59,19 @@ from ..utils import (vprint, count_free_cores)
 from ..config import (GWSummConfigParser, NoSectionError, NoOptionError)
 from ..channels import (get_channel, update_missing_channel_params, re_channel,
                         split_combination as split_channel_combination)
-from .utils import (use_configparser, use_segmentlist, make_globalv_key)
+from .utils import (use_configparser, use_segmentlist, make_globalv_key,
+                    pin_channels)
 from .mathutils import (get_with_math, parse_math_definition)
+from .store import get_indexed_list
+from . import memory
+from .spill import spill_overlaps
+from .readcache import get_read_cache
+from .datafindcache import get_datafind_cache
+from .ndspool import get_nds_pool
+from .filters import apply_filter
+from .trends import synthesize_trends
+from .cache import IndexedCache
+from .fftpool import close_process_pool
 
 
 OPERATOR = {
@@ -80,9 +96,33 @@ FRAMETYPE_REGEX = {
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
+# per-thread pool of open datafind connections
+_DATAFIND_CONNECTIONS = threading.local()
+
 
 # -- utilities ----------------------------------------------------------------
 
+def _datafind_connection(host, port, cert=None, key=None, reset=False):
+    """Return an open connection to the datafind server for this thread
+
+    Connections are reused for all queries from a given thread, rather
+    than opening a new one for each query.
+    """
+    try:
+        pool = _DATAFIND_CONNECTIONS.pool
+    except AttributeError:
+        pool = _DATAFIND_CONNECTIONS.pool = dict()
+    id_ = (host, port, cert, key)
+    if reset or id_ not in pool:
+        if cert is not None:
+            pool[id_] = datafind.GWDataFindHTTPSConnection(
+                host=host, port=port, cert_file=cert, key_file=key)
+        else:
+            pool[id_] = datafind.GWDataFindHTTPConnection(host=host,
+                                                          port=port)
+    return pool[id_]
+
+
 @use_configparser
 def find_frames(ifo, frametype, gpsstart, gpsend, config=GWSummConfigParser(),
                 urltype='file', gaps='warn', onerror='raise'):
@@ -171,38 +211,42 @@ def find_frames(ifo, frametype, gpsstart, gpsend, config=GWSummConfigParser(),
     except ValueError:
         match = None
 
-    def _query():
-        if cert is not None:
-            dfconn = datafind.GWDataFindHTTPSConnection(
-                host=host, port=port, cert_file=cert, key_file=key)
-        else:
-            dfconn = datafind.GWDataFindHTTPConnection(host=host, port=port)
-        return dfconn.find_frame_urls(ifo[0].upper(), frametype, gpsstart,
-                                      gpsend, urltype=urltype, on_gaps=gaps,
+    def _query(start, end, reset=False):
+        dfconn = _datafind_connection(host, port, cert=cert, key=key,
+                                      reset=reset)
+        return dfconn.find_frame_urls(ifo[0].upper(), frametype, start,
+                                      end, urltype=urltype, on_gaps=gaps,
                                       match=match)
-    try:
-        cache = _query()
-    except RuntimeError as e:
-        sleep(1)
+
+    def _find(start, end):
         try:
-            cache = _query()
-        except RuntimeError:
-            if 'Invalid GPS times' in str(e):
-                e.args = ('%s: %d ... %s' % (str(e), gpsstart, gpsend),)
-            if onerror in ['ignore', None]:
-                pass
-            elif onerror in ['warn']:
-                warnings.warn('Caught %s: %s'
-                              % (type(e).__name__, str(e)))
-            else:
-                raise
-            cache = Cache()
+            return _query(start, end)
+        except (RuntimeError, HTTPException, socket.error) as e:
+            sleep(1)
+            try:
+                return _query(start, end, reset=True)
+            except (RuntimeError, HTTPException, socket.error):
+                if 'Invalid GPS times' in str(e):
+                    e.args = ('%s: %d ... %s' % (str(e), start, end),)
+                if onerror in ['ignore', None]:
+                    pass
+                elif onerror in ['warn']:
+                    warnings.warn('Caught %s: %s'
+                                  % (type(e).__name__, str(e)))
+                else:
+                    raise
+
+    # only query for intervals we haven't searched already
+    dfcache = get_datafind_cache(config)
+    cache = dfcache.find((host, ifo, frametype, urltype, match),
+                         gpsstart, gpsend, _find)
 
     # XXX: if querying for day of LLO frame type change, do both
     if (ifo[0].upper() == 'L' and frametype in ['C', 'R', 'M', 'T'] and
             gpsstart < LLOCHANGE < gpsend):
         start = len(cache) and cache[-1].segment[1] or gpsstart
         if start < gpsend:
+            dfconn = _datafind_connection(host, port, cert=cert, key=key)
             cache.extend(dfconn.find_frame_urls(ifo[0].upper(),
                                                 'L1_%s' % frametype, start,
                                                 gpsend, urltype=urltype,
@@ -212,6 +256,50 @@ def find_frames(ifo, frametype, gpsstart, gpsend, config=GWSummConfigParser(),
     return cache
 
 
+@use_configparser
+def find_frames_concurrently(queries, config=GWSummConfigParser(),
+                             nthreads=None, **kwargs):
+    """Query the datafind server for a number of frametypes at once
+
+    Parameters
+    ----------
+    queries : `list` of `tuple`
+        a list of `(ifo, frametype, gpsstart, gpsend)` queries
+
+    config : `~ConfigParser.ConfigParser`, optional
+        configuration with `[datafind]` section, the ``threads`` option
+        sets the maximum number of concurrent queries (default: 8)
+
+    nthreads : `int`, optional
+        number of concurrent queries, overrides the configuration
+
+    **kwargs
+        other keyword arguments are passed to :meth:`find_frames`
+
+    Returns
+    -------
+    caches : `list` of `~glue.lal.Cache`
+        the cache for each query, in the same order as the input
+    """
+    if nthreads is None:
+        try:
+            nthreads = config.getint('datafind', 'threads')
+        except (NoOptionError, NoSectionError):
+            nthreads = 8
+    nthreads = max(1, min(nthreads, len(queries)))
+
+    def _find(query):
+        return find_frames(*query, config=config, **kwargs)
+
+    if nthreads == 1:
+        return map(_find, queries)
+    pool = ThreadPool(nthreads)
+    try:
+        return pool.map(_find, queries)
+    finally:
+        pool.close()
+
+
 def find_cache_segments(*caches):
     """Return the segments covered by one or more data caches
 
@@ -225,26 +313,9 @@ def find_cache_segments(*caches):
     segments : `~gwpy.segments.SegmentList`
         list of segments containing in cache
     """
-    out = SegmentList()
-    nframes = sum(len(c) for c in caches)
-    if nframes == 0:
-        return out
-    for cache in caches:
-        # build segment for this cache
-        if not len(cache):
-            continue
-        seg = cache[0].segment
-        for e in cache:
-            # if new segment doesn't overlap, append and start again
-            if e.segment.disjoint(seg):
-                out.append(seg)
-                seg = e.segment
-            # otherwise, append to current segment
-            else:
-                seg |= e.segment
-    # append final segment and return
-    out.append(seg)
-    return out
+    if len(caches) == 1 and isinstance(caches[0], IndexedCache):
+        return caches[0].segments()
+    return IndexedCache(e for cache in caches for e in cache).segments()
 
 
 def find_frame_type(channel):
@@ -311,10 +382,11 @@ def get_channel_type(name):
 
 @use_configparser
 @use_segmentlist
+@pin_channels
 def get_timeseries_dict(channels, segments, config=GWSummConfigParser(),
                         cache=None, query=True, nds=None, multiprocess=True,
                         frametype=None, statevector=False, return_=True,
-                        datafind_error='raise', **ioargs):
+                        datafind_error='raise', parallel=None, **ioargs):
     """Retrieve the data for a set of channels
 
     Parameters
@@ -358,6 +430,12 @@ def get_timeseries_dict(channels, segments, config=GWSummConfigParser(),
         whether you actually want anything returned to you, or you are just
         calling this function to load data for use later
 
+    parallel : `bool`, optional
+        whether to read channels from different frametypes concurrently,
+        using up to ``multiprocess`` threads, defaults to
+        `globalv.PARALLEL_FRAMETYPES`; each group is then read serially,
+        since forking from a multi-threaded process can deadlock
+
     **ioargs
         all other keyword arguments are passed to the relevant data
         reading method (either `~gwpy.timeseries.TimeSeriesDict.read` or
@@ -385,12 +463,60 @@ def get_timeseries_dict(channels, segments, config=GWSummConfigParser(),
                     frametypes[id_].append(channel)
                 else:
                     frametypes[id_] = [channel]
-        for ftype, channellist in frametypes.iteritems():
+        # resolve frame caches for all groups at once
+        caches = dict()
+        if (cache is None and frametype is None and
+                (nds is False or (nds is None and
+                                  'LIGO_DATAFIND_SERVER' in os.environ))):
+            queries = []
+            ListClass = statevector and StateVectorList or TimeSeriesList
+            for (ifo, ftype), channellist in frametypes.iteritems():
+                new = _find_new_segments(channellist, segments, ListClass)
+                if ifo is None or ftype is None or not abs(new):
+                    continue
+                span = new.extent().protract(8)
+                queries.append((ifo, ftype, span[0], span[1]))
+            if len(queries) > 1:
+                found = find_frames_concurrently(queries, config=config,
+                                                 gaps='ignore',
+                                                 onerror=datafind_error)
+                for q, fcache in zip(queries, found):
+                    # leave empty caches for the reader to handle fallback
+                    if len(fcache):
+                        caches[q[:2]] = fcache
+        # read groups concurrently, sharing the worker budget between them
+        if parallel is None:
+            parallel = globalv.PARALLEL_FRAMETYPES
+        if multiprocess is True:
+            nproc = count_free_cores()
+        else:
+            nproc = int(multiprocess or 1)
+        nthreads = parallel and min(len(frametypes), nproc) or 1
+        # never fork reader processes from inside the thread pool
+        if nthreads > 1:
+            groupmp = False
+        else:
+            groupmp = multiprocess
+
+        def _read(group):
+            ftype, channellist = group
             _get_timeseries_dict(channellist, segments, config=config,
-                                 cache=cache, query=query, nds=nds,
-                                 multiprocess=multiprocess, frametype=ftype[1],
-                                 statevector=statevector, return_=False,
-                                 datafind_error=datafind_error, **ioargs)
+                                 cache=caches.get(ftype, cache), query=query,
+                                 nds=nds, multiprocess=groupmp,
+                                 frametype=ftype[1], statevector=statevector,
+                                 return_=False, datafind_error=datafind_error,
+                                 **ioargs)
+
+        if nthreads > 1:
+            vprint("    Reading %d frametype groups in parallel [%d threads]\n"
+                   % (len(frametypes), nthreads))
+            pool = ThreadPool(nthreads)
+            try:
+                pool.map(_read, frametypes.items())
+            finally:
+                pool.close()
+        else:
+            map(_read, frametypes.items())
     if not return_:
         return
     else:
@@ -403,7 +529,18 @@ def get_timeseries_dict(channels, segments, config=GWSummConfigParser(),
         return out
 
 
+def _find_new_segments(channels, segments, ListClass):
+    """Return the segments for which data are missing for any channel
+    """
+    havesegs = reduce(operator.and_,
+                      (globalv.DATA.get(make_globalv_key(channel),
+                                        ListClass()).segments
+                       for channel in map(get_channel, channels)))
+    return segments - havesegs
+
+
 @use_segmentlist
+@pin_channels
 def _get_timeseries_dict(channels, segments, config=None,
                          cache=None, query=True, nds=None, frametype=None,
                          multiprocess=True, return_=True, statevector=False,
@@ -427,11 +564,7 @@ def _get_timeseries_dict(channels, segments, config=None,
 
     # read segments from global memory
     keys = dict((c.ndsname, make_globalv_key(c)) for c in channels)
-    havesegs = reduce(operator.and_,
-                      (globalv.DATA.get(keys[channel.ndsname],
-                                        ListClass()).segments
-                       for channel in channels))
-    new = segments - havesegs
+    new = _find_new_segments(channels, segments, ListClass)
 
     # get processes
     if multiprocess is True:
@@ -470,30 +603,24 @@ def _get_timeseries_dict(channels, segments, config=None,
     elif nds is None:
         nds = 'LIGO_DATAFIND_SERVER' not in os.environ
 
+    # find persistent read cache
+    readcache = not nds and get_read_cache(config) or None
+
     # read new data
     query &= (abs(new) > 0)
     if cache is not None:
         query &= len(cache) > 0
     if query:
+        requested = new
         for channel in channels:
-            globalv.DATA.setdefault(keys[channel.ndsname], ListClass())
+            get_indexed_list(globalv.DATA, keys[channel.ndsname], ListClass)
         # open NDS connection
         if nds and config.has_option('nds', 'host'):
-            host = config.get('nds', 'host')
-            port = config.getint('nds', 'port')
-            try:
-                ndsconnection = nds2.connection(host, port)
-            except RuntimeError as e:
-                if 'SASL authentication' in str(e):
-                    from gwpy.io.nds import kinit
-                    kinit()
-                    ndsconnection = nds2.connection(host, port)
-                else:
-                    raise
+            ndspool = get_nds_pool(config)
             frametype = source = 'nds'
             ndstype = channels[0].type
         elif nds:
-            ndsconnection = None
+            ndspool = None
             frametype = source = 'nds'
             ndstype = channels[0].type
         # or find frame type and check cache
@@ -526,6 +653,8 @@ def _get_timeseries_dict(channels, segments, config=None,
                                          onerror=datafind_error)
 
             # parse discontiguous cache blocks and rebuild segment list
+            if not isinstance(fcache, IndexedCache):
+                fcache = IndexedCache(fcache)
             cachesegments = find_cache_segments(fcache)
             new &= cachesegments
             source = 'frames'
@@ -558,6 +687,9 @@ def _get_timeseries_dict(channels, segments, config=None,
                 ctype = list(ctype)[0]
             else:
                 ctype = None
+        # don't fork readers while the spectrogram pool's threads are alive
+        if len(new) and nproc > 1:
+            close_process_pool()
         # loop through segments, recording data for each
         if len(new) and nproc > 1:
             vprint("    Fetching data (from %s) for %d channels [%s]"
@@ -567,10 +699,12 @@ def _get_timeseries_dict(channels, segments, config=None,
             segment = type(segment)(int(segment[0]), int(segment[1]))
             if abs(segment) < 1:
                 continue
-            if nds:
-                tsd = DictClass.fetch(qchannels, segment[0], segment[1],
-                                      connection=ndsconnection, type=ndstype,
-                                      **ioargs)
+            if nds and ndspool is not None:
+                tsds = [ndspool.fetch(DictClass, qchannels, segment[0],
+                                      segment[1], type=ndstype, **ioargs)]
+            elif nds:
+                tsds = [DictClass.fetch(qchannels, segment[0], segment[1],
+                                        type=ndstype, **ioargs)]
             else:
                 # pad resampling
                 if segment[1] == cachesegments[-1][1] and qresample:
@@ -600,26 +734,34 @@ def _get_timeseries_dict(channels, segments, config=None,
                     for c in qchannels:
                         if c.ndsname in filter_:
                             del c.filter
-                # read data
-                tsd = DictClass.read(segcache, qchannels,
-                                     start=segstart, end=segend, type=ctype,
-                                     nproc=nproc, resample=qresample,
-                                     verbose=verbose, **ioargs)
+                # read data, using chunks from the read cache if we can
+                if readcache is None:
+                    tsds = [DictClass.read(
+                        segcache, qchannels, start=segstart, end=segend,
+                        type=ctype, nproc=nproc, resample=qresample,
+                        verbose=verbose, **ioargs)]
+                else:
+                    tsds = [readcache.fetch(
+                        lambda a, b: DictClass.read(
+                            segcache, qchannels, start=a, end=b, type=ctype,
+                            nproc=nproc, verbose=verbose, **ioargs),
+                        qchannels, frametype, segstart, segend, DictClass,
+                        rates=qresample, dtypes=qdtype)]
                 # put filters back
                 for c in qchannels:
                     if c.ndsname in filter_:
                         c.filter = filter_[c.ndsname]
-            for (channel, data) in tsd.iteritems():
+            for (channel, data) in chain.from_iterable(
+                    t.iteritems() for t in tsds):
                 key = keys[channel.ndsname]
-                if (key in globalv.DATA and
-                        data.span in globalv.DATA[key].segments):
+                stored = get_indexed_list(globalv.DATA, key, ListClass)
+                if stored.covers(data.span):
                     continue
                 if data.unit is None:
                     data.unit = 'undef'
-                for seg in globalv.DATA[key].segments:
-                    if seg.intersects(data.span):
-                        data = data.crop(*(data.span - seg))
-                        break
+                for old in stored.overlaps(data.span):
+                    data = data.crop(*(data.span - old.span))
+                    break
                 try:
                     filt = filter_[channel.ndsname]
                 except KeyError:
@@ -641,9 +783,9 @@ def _get_timeseries_dict(channels, segments, config=None,
                             data *= filt[2]
                         except TypeError:
                             data = data * filt[2]
-                    # filter zpk
+                    # filter zpk, continuing from previous contiguous data
                     elif isinstance(filt, tuple):
-                        data = data.filter(*filt)
+                        data = apply_filter(data, filt, key)
                     # filter fail
                     else:
                         raise ValueError("Cannot parse filter for %s: %r"
@@ -659,8 +801,8 @@ def _get_timeseries_dict(channels, segments, config=None,
                 elif data.unit is None:
                     data._unit = channel.unit
                 # XXX: HACK for failing unit check
-                if len(globalv.DATA[key]):
-                    data._unit = globalv.DATA[key][-1].unit
+                if len(stored):
+                    data._unit = stored[-1].unit
                 # update channel type for trends
                 if (data.channel.type is None and
                        data.channel.trend is not None):
@@ -669,12 +811,19 @@ def _get_timeseries_dict(channels, segments, config=None,
                     elif data.dt.to('s').value == 60:
                         data.channel.type = 'm-trend'
                 # append and coalesce
+                memory.set_evictable('DATA', key)
                 add_timeseries(data, key=key, coalesce=True)
             if multiprocess:
                 vprint('.')
         if len(new):
             vprint("\n")
 
+        # fill gaps in trend data (e.g. late trend frames) from raw data
+        if not nds and not statevector:
+            synthesize_trends(channels, requested, config,
+                              multiprocess=multiprocess,
+                              datafind_error=datafind_error)
+
     if not return_:
         return
 
@@ -685,15 +834,17 @@ def _get_timeseries_dict(channels, segments, config=None,
         if keys[channel.ndsname] not in globalv.DATA:
             out[channel.ndsname] = ListClass()
         else:
-            for ts in globalv.DATA[keys[channel.ndsname]]:
-                for seg in segments:
+            stored = get_indexed_list(globalv.DATA, keys[channel.ndsname],
+                                      ListClass)
+            memory.touch('DATA', keys[channel.ndsname])
+            for seg in segments:
+                for ts in stored.overlaps(seg):
                     if abs(seg) == 0 or abs(seg) < ts.dt.value:
                         continue
-                    if ts.span.intersects(seg):
-                        common = map(float, ts.span & seg)
-                        cropped = ts.crop(*common, copy=False)
-                        if cropped.size:
-                            data.append(cropped)
+                    common = map(float, ts.span & seg)
+                    cropped = ts.crop(*common, copy=False)
+                    if cropped.size:
+                        data.append(cropped)
         out[channel.ndsname] = data.coalesce()
     return out
 
@@ -783,16 +934,21 @@ def add_timeseries(timeseries, key=None, coalesce=True):
         `~gwpy.timeseries.TimeSeries.name` of the series
 
     coalesce : `bool`, optional
-        coalesce contiguous series after adding, defaults to `True`
+        merge the new series with any contiguous neighbours after adding,
+        defaults to `True`
     """
     if timeseries.channel is not None:
         update_missing_channel_params(timeseries.channel)
     if key is None:
         key = timeseries.name or timeseries.channel.ndsname
     if isinstance(timeseries, StateVector):
-        globalv.DATA.setdefault(key, StateVectorList())
+        listclass = StateVectorList
     else:
-        globalv.DATA.setdefault(key, TimeSeriesList())
-    globalv.DATA[key].append(timeseries)
-    if coalesce:
-        globalv.DATA[key].coalesce()
+        listclass = TimeSeriesList
+    timeseries = memory.to_storage_dtype(timeseries, key,
+                                         channel=timeseries.channel)
+    stored = get_indexed_list(globalv.DATA, key, listclass)
+    stored.add(timeseries, coalesce=coalesce)
+    if globalv.MEMMAP_DIRECTORY:
+        spill_overlaps(stored, timeseries.span)
+    memory.record('DATA', key)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Calculate second- and minute-trends from raw data
+
+Trend frames are written by separate processes, and can arrive minutes
+to hours after the raw data. When enabled via the ``[trends]`` section
+of the configuration::
+
+   [trends]
+   synthesize = True
+   read-raw = False
+
+any times for which trend data were requested but could not be read
+are filled by calculating the trends from raw data, either those already
+in memory, or (if ``read-raw = True``) read from raw frames.
+Trend bins are aligned to GPS modulo 1 or 60 seconds, as for data read
+from trend frames, and only complete bins are recorded.
+
+The spans filled in this way are recorded in `globalv.SYNTHETIC_TRENDS`,
+and are not written to the data archive, so that a later run reads the
+real trend frames once they have arrived.
+"""
+
+from __future__ import division
+
+from math import (ceil, floor)
+
+import numpy
+
+from gwpy.segments import (Segment, SegmentList)
+
+from .. import globalv
+from ..config import (NoSectionError, NoOptionError)
+from ..channels import get_channel
+from ..utils import vprint
+from .utils import make_globalv_key
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['TREND_STATISTICS', 'trend_stride', 'make_trends',
+           'synthesize_trends']
+
+SECTION = 'trends'
+
+TREND_STATISTICS = ['mean', 'min', 'max', 'rms', 'n']
+
+
+def trend_stride(channel):
+    """Return the trend stride (seconds) for the given trend channel
+    """
+    if channel.type == 'm-trend' or (channel.sample_rate is not None and
+                                     channel.sample_rate.value < 1):
+        return 60
+    return 1
+
+
+def make_trends(series, stride, statistics=TREND_STATISTICS):
+    """Calculate trends of a `TimeSeries`
+
+    Parameters
+    ----------
+    series : `~gwpy.timeseries.TimeSeries`
+        the raw input data
+
+    stride : `int`
+        the duration (seconds) of each trend bin, bins are aligned to
+        GPS modulo ``stride``
+
+    statistics : `list` of `str`, optional
+        the trend statistics to calculate, any of `TREND_STATISTICS`
+
+    Returns
+    -------
+    trends : `dict`
+        a `(statistic, TimeSeries)` dict of trends, covering only the
+        complete bins contained within the input data, or an empty
+        `dict` if there are none
+    """
+    start, end = map(float, series.span)
+    tstart = int(ceil(start / stride)) * stride
+    tend = int(floor(end / stride)) * stride
+    if tend <= tstart:
+        return {}
+    rate = series.sample_rate.value
+    nsamp = int(round(stride * rate))
+    nbins = (tend - tstart) // stride
+    idx0 = int(round((tstart - start) * rate))
+    data = numpy.asarray(series.value[idx0:idx0+nbins*nsamp]).reshape(
+        nbins, nsamp)
+    out = {}
+    for stat in statistics:
+        if stat == 'mean':
+            value = data.mean(axis=1)
+        elif stat == 'min':
+            value = data.min(axis=1)
+        elif stat == 'max':
+            value = data.max(axis=1)
+        elif stat == 'rms':
+            value = numpy.sqrt((data.astype(float) ** 2).mean(axis=1))
+        elif stat == 'n':
+            value = numpy.ones(nbins) * nsamp
+        else:
+            raise ValueError("Cannot calculate %r trend" % stat)
+        out[stat] = type(series)(value, epoch=tstart, sample_rate=1/stride,
+                                 unit=stat != 'n' and series.unit or '',
+                                 name='%s.%s' % (series.name, stat))
+    return out
+
+
+def _use_trend_synthesis(config, option='synthesize'):
+    try:
+        return config.getboolean(SECTION, option)
+    except (NoSectionError, NoOptionError):
+        return False
+
+
+def synthesize_trends(channels, segments, config, query=True, **kwargs):
+    """Fill gaps in trend data using trends calculated from raw data
+
+    Parameters
+    ----------
+    channels : `list` of `~gwpy.detector.Channel`
+        the trend channels of interest
+
+    segments : `~gwpy.segments.SegmentList`
+        the segments for which trend data are required
+
+    config : `~gwsumm.config.GWSummConfigParser`
+        the configuration for this analysis
+
+    query : `bool`, optional
+        whether to read raw data from frames, if ``[trends] read-raw``
+        is also set in the configuration, otherwise only raw data already
+        in memory are used
+
+    **kwargs
+        other keyword arguments are passed to `get_timeseries` when
+        reading raw data
+
+    Returns
+    -------
+    nbins : `int`
+        the number of trend samples created
+    """
+    from .timeseries import (get_timeseries, add_timeseries)
+    if not _use_trend_synthesis(config):
+        return 0
+    readraw = query and _use_trend_synthesis(config, 'read-raw')
+    # group trend channels by their raw source, so that each raw channel
+    # is only read (and reduced) once
+    sources = {}
+    for channel in channels:
+        if channel.trend is None:
+            continue
+        key = make_globalv_key(channel)
+        try:
+            missing = segments - globalv.DATA[key].segments
+        except KeyError:
+            missing = segments
+        stride = trend_stride(channel)
+        # only complete trend bins can be calculated, so ignore pieces
+        # (e.g. the edges of each segment) shorter than one bin
+        missing = _complete_bins(missing, stride)
+        if not abs(missing):
+            continue
+        raw = channel.name.rsplit('.', 1)[0]
+        sources.setdefault((raw, stride), []).append((channel, key, missing))
+
+    created = 0
+    for (raw, stride), trends in sources.iteritems():
+        missing = reduce(lambda a, b: a | b, [t[2] for t in trends])
+        missing.coalesce()
+        rawchannel = get_channel(raw)
+        rawdata = get_timeseries(rawchannel, missing, config=config,
+                                 query=readraw, **kwargs)
+        if not len(rawdata):
+            continue
+        vprint("    Calculating %s trends for %s from raw data\n"
+               % (stride == 60 and 'minute' or 'second', raw))
+        stats = set(t[0].trend for t in trends) & set(TREND_STATISTICS)
+        for ts in rawdata:
+            new = make_trends(ts, stride, statistics=stats)
+            for channel, key, need in trends:
+                try:
+                    trend = new[channel.trend]
+                except KeyError:
+                    continue
+                seg = Segment(*map(float, trend.span))
+                # only add complete bins that are still missing
+                for (a, b) in _complete_bins(need & SegmentList([seg]),
+                                             stride):
+                    cropped = trend.crop(a, b)
+                    cropped.channel = channel
+                    add_timeseries(cropped, key=key)
+                    globalv.SYNTHETIC_TRENDS.setdefault(
+                        key, SegmentList()).append(Segment(a, b))
+                    globalv.SYNTHETIC_TRENDS[key].coalesce()
+                    created += cropped.size
+    return created
+
+
+def _complete_bins(segments, stride):
+    """Return the parts of ``segments`` covered by complete trend bins
+    """
+    out = SegmentList()
+    for seg in segments:
+        a = int(ceil(seg[0] / stride)) * stride
+        b = int(floor(seg[1] / stride)) * stride
+        if b > a:
+            out.append(Segment(a, b))
+    return out
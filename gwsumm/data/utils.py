@@ -32,8 +32,10 @@ from glue.segments import segmentlist as GlueSegmentList
 
 from gwpy.segments import (DataQualityFlag, SegmentList, Segment)
 
-from ..channels import (get_channel, re_channel)
-from ..config import GWSummConfigParser
+from ..channels import (get_channel, re_channel,
+                        split_combination as split_channel_combination)
+from ..config import (GWSummConfigParser, NoSectionError)
+from . import memory
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -155,6 +157,28 @@ def use_configparser(f):
     return decorated_func
 
 
+def pin_channels(f):
+    """Decorate a method to protect its channels' data from eviction
+
+    The `globalv.DATA` keys of all channels given as the first positional
+    argument (including the components of any channel combinations) are
+    pinned (see :meth:`gwsumm.data.memory.pin`) until the method returns,
+    so that data read early in the call are not dropped before they are
+    used.
+    """
+    @wraps(f)
+    def decorated_func(channels, *args, **kwargs):
+        if isinstance(channels, (list, tuple, set)):
+            names = channels
+        else:
+            names = [channels]
+        keys = set(make_globalv_key(c) for name in names for
+                   c in split_channel_combination(name))
+        with memory.pinned(*keys):
+            return f(channels, *args, **kwargs)
+    return decorated_func
+
+
 # -- handle keys for globalv dicts --------------------------------------------
 # need a key that is unique across channel(s) with a specific for of
 # signal-processing parameters
@@ -192,6 +216,39 @@ class FftParams(object):
         return dict((x, getattr(self, x)) for x in self.__slots__)
 
 
+def parse_fftparams(config, section=None):
+    """Parse the FFT parameters from the ``[fft]`` section
+
+    Parameters
+    ----------
+    config : `~gwsumm.config.GWSummConfigParser`
+        the configuration to read
+
+    section : `str`, optional
+        a (tab) section whose ``fft-<param>`` options override the
+        defaults from ``[fft]``
+
+    Returns
+    -------
+    fftparams : `dict`
+        the FFT parameters, empty if no sections define any
+    """
+    try:
+        fftparams = dict(config.nditems('fft'))
+    except NoSectionError:
+        fftparams = {}
+    if section is not None:
+        for key, val in config.nditems(section):
+            if key.startswith('fft-'):
+                fftparams[key[4:]] = val
+    for key, val in fftparams.iteritems():
+        try:
+            fftparams[key] = eval(val)
+        except (NameError, SyntaxError):
+            pass
+    return fftparams
+
+
 def get_fftparams(channel, **defaults):
     channel = get_channel(channel)
     fftparams = FftParams(**defaults)
@@ -32,8 +32,16 @@ STATES = {}
 DATA = {}
 SPECTROGRAMS = {}
 SPECTRUM = {}
+# per-frequency amplitude histograms from which SPECTRUM is calculated
+SPECTRAL_HISTOGRAMS = {}
 COHERENCE_COMPONENTS = {}
 COHERENCE_SPECTRUM = {}
+# samples left over after the last complete stride of each spectrogram
+SPECTROGRAM_TAILS = {}
+# final state of the streaming filter for each DATA key, with its GPS end time
+FILTER_STATES = {}
+# spans of DATA calculated from raw data in place of missing trend frames
+SYNTHETIC_TRENDS = {}
 SEGMENTS = DataQualityDict()
 TRIGGERS = {}
 
@@ -41,6 +49,17 @@ VERBOSE = False
 PROFILE = False
 START = time.time()
 
+# memory ceiling (bytes) for the data buffers above, `None` for no limit
+MEMORY_LIMIT = None
+# scratch directory for memory-mapped data arrays, `None` to use the heap
+MEMMAP_DIRECTORY = None
+# dtype in which to store floating-point data, `None` to store as read
+STORAGE_DTYPE = None
+# continue spectrograms from the samples left over by the last run
+INCREMENTAL_SPECTROGRAMS = False
+# read data for different frametypes concurrently
+PARALLEL_FRAMETYPES = False
+
 # run time variables
 MODE = 4
 WRITTEN_PLOTS = []
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Plan all data access for a run before processing any tabs
+
+Each `~gwsumm.tabs.DataTab` discovers the data it needs one state at a
+time, so the same frames can be opened many times over for different
+tabs and states. A `DataPlan` walks the states and plots of all tabs
+up-front, recording the union of segments required for each channel
+(or flag, or trigger set) and each data product, then reads everything
+in as few grouped requests as possible:
+
+- all channels that need the same segments are read in a single call,
+  with time-series and spectrogram inputs read together so that each
+  frame file is only opened once,
+- groups are processed in order of GPS start time, for file locality,
+- spectrograms, segments and triggers are then generated for the union
+  of times needed.
+
+The tabs subsequently find everything they need in `globalv`.
+"""
+
+import re
+from collections import OrderedDict
+
+from gwpy.segments import SegmentList
+
+from .data import (get_timeseries_dict, get_spectrograms,
+                   get_coherence_spectrograms)
+from .segments import get_segments
+from .state import (ALLSTATE, get_state)
+from .state.core import MATHOPS
+from .triggers import get_triggers
+from .utils import vprint
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['DataPlan']
+
+PRODUCTS = ['timeseries', 'statevector', 'spectrogram', 'rayleigh',
+            'coherence', 'segments', 'triggers']
+
+re_mathop = re.compile('(%s)' % '|'.join(map(re.escape, MATHOPS.keys())))
+
+
+class DataPlan(object):
+    """The union of data required by a set of tabs
+
+    Requests are stored for each of the `PRODUCTS` as a `dict` mapping
+    the data key (a channel, a flag, a pair of channels for coherence, or
+    an ``(etg, channel)`` tuple for triggers) to the `SegmentList` over
+    which those data are needed.
+
+    Spectral requests (spectrogram, rayleigh and coherence) are keyed by
+    ``(key, fftkey)``, where ``fftkey`` indexes the FFT parameters of the
+    requesting tab in `DataPlan.fftparams`.
+    """
+    def __init__(self):
+        self.requests = dict((product, OrderedDict()) for
+                             product in PRODUCTS)
+        self.fftparams = OrderedDict()
+
+    def add(self, product, key, segments):
+        """Record that ``key`` is needed for the given segments
+
+        Parameters
+        ----------
+        product : `str`
+            the data product, one of `PRODUCTS`
+
+        key : `object`
+            the channel, flag, or other identifier of the data
+
+        segments : `~gwpy.segments.SegmentList`
+            the segments for which these data are needed
+        """
+        segments = SegmentList(segments)
+        requests = self.requests[product]
+        try:
+            requests[key] = (requests[key] | segments).coalesce()
+        except KeyError:
+            requests[key] = segments.coalesce()
+
+    def groups(self, *products):
+        """Group requests that need identical segments
+
+        Parameters
+        ----------
+        *products : `str`
+            one or more of `PRODUCTS`, whose requests are merged before
+            grouping
+
+        Returns
+        -------
+        groups : `list` of `tuple`
+            a list of ``(segments, keys)`` pairs, sorted by the start
+            time of the segments
+        """
+        return self._group(*[self.requests[product] for
+                             product in products])
+
+    @staticmethod
+    def _group(*requests):
+        merged = OrderedDict()
+        for requests_ in requests:
+            for key, segments in requests_.iteritems():
+                try:
+                    merged[key] = (merged[key] | segments).coalesce()
+                except KeyError:
+                    merged[key] = segments
+        groups = OrderedDict()
+        for key, segments in merged.iteritems():
+            if not abs(segments):
+                continue
+            groups.setdefault(tuple(map(tuple, segments)), []).append(key)
+        return sorted([(SegmentList(segments), keys) for
+                       segments, keys in groups.iteritems()],
+                      key=lambda g: g[0][0][0])
+
+    @staticmethod
+    def _split_fftparams(keys):
+        """Split ``(key, fftkey)`` spectral requests by FFT parameters
+
+        Returns
+        -------
+        split : `list` of `tuple`
+            a list of ``(fftkey, keys)`` pairs
+        """
+        split = OrderedDict()
+        for key, fftkey in keys:
+            split.setdefault(fftkey, []).append(key)
+        return split.items()
+
+    # -------------------------------------------
+    # planning
+
+    @classmethod
+    def from_tabs(cls, tabs, config, segdb_error='raise',
+                  datafind_error='raise'):
+        """Plan the data access for the given tabs
+
+        The states of each tab are finalised along the way, with the
+        segment queries defining those states grouped together.
+
+        Parameters
+        ----------
+        tabs : `list` of `~gwsumm.tabs.DataTab`
+            the tabs to plan for
+
+        config : `~gwsumm.config.GWSummConfigParser`
+            the configuration for this analysis
+
+        segdb_error : `str`, optional
+            action upon error fetching segments from the segment database
+
+        datafind_error : `str`, optional
+            action upon error querying for frames
+
+        Returns
+        -------
+        plan : `DataPlan`
+            the plan of all data needed by the given tabs
+        """
+        tabs = [tab for tab in tabs if not getattr(tab, 'ismeta', False)]
+        cls.fetch_states(tabs, config, segdb_error=segdb_error)
+        plan = cls()
+        for tab in tabs:
+            tab.finalize_states(config=config, segdb_error=segdb_error,
+                                datafind_error=datafind_error)
+            plan.add_tab(tab, config)
+        return plan
+
+    @staticmethod
+    def fetch_states(tabs, config, segdb_error='raise'):
+        """Query the segments defining all tab states, in bulk
+
+        States with the same validity and segment database are queried
+        together; states defined from files or by thresholding data are
+        left to `~gwsumm.state.SummaryState.fetch`.
+        """
+        queries = OrderedDict()
+        for tab in tabs:
+            for state in tab.states:
+                if (state.ready or not state.definition or state.filename or
+                        not state.known or re_mathop.search(state.definition)):
+                    continue
+                key = (state.url, tuple(map(tuple, state.known)))
+                queries.setdefault(key, set()).add(state.definition)
+        for (url, known), definitions in queries.iteritems():
+            vprint("    Querying segments for %d states\n" % len(definitions))
+            get_segments(sorted(definitions), SegmentList(known),
+                         config=config, url=url, segdb_error=segdb_error,
+                         return_=False)
+
+    def add_tab(self, tab, config):
+        """Record all data needed by the given tab
+
+        This follows the same selection of plots as
+        `~gwsumm.tabs.DataTab.process_state`, for the 'all-data' plots
+        and for each state in turn.
+        """
+        fftparams = tab.get_fftparams(config)
+        fftkey = repr(sorted(fftparams.items()))
+        self.fftparams.setdefault(fftkey, fftparams)
+        passes = [(False, state) for state in tab.states]
+        if any([(p.all_data & p.new) for p in tab.plots]):
+            passes.insert(0, (True, get_state(ALLSTATE)))
+        for all_data, state in passes:
+            segments = state.active
+            # time-series
+            for channel in tab.get_channels('timeseries', all_data=all_data,
+                                            read=True):
+                self.add('timeseries', channel, segments)
+            for channel in tab.get_channels('statevector', 'odc',
+                                            all_data=all_data, read=True):
+                self.add('statevector', channel, segments)
+            # spectrograms
+            for channel in tab.get_channels('spectrogram', 'spectrum',
+                                            all_data=all_data, read=True):
+                self.add('spectrogram', (channel, fftkey), segments)
+            for channel in tab.get_channels('rayleigh-spectrogram',
+                                            'rayleigh-spectrum',
+                                            all_data=all_data, read=True):
+                self.add('rayleigh', (channel, fftkey), segments)
+            pairs = tab.get_channels('coherence-spectrogram',
+                                     all_data=all_data, read=True,
+                                     unique=False, state=state)
+            for pair in zip(pairs[::2], pairs[1::2]):
+                self.add('coherence', (pair, fftkey), segments)
+            # segments
+            flags = set(tab.get_flags('segments', all_data=all_data))
+            flags.update(tab.get_flags('timeseries', all_data=all_data,
+                                       type='time-volume'))
+            flags.update(tab.get_flags('spectrogram', all_data=all_data,
+                                       type='strain-time-volume'))
+            for flag in flags:
+                self.add('segments', flag, segments)
+            # triggers
+            for etg, channel in tab.get_triggers(
+                    'triggers', 'trigger-timeseries', 'trigger-rate',
+                    'trigger-histogram', all_data=all_data, state=state):
+                self.add('triggers', (etg, channel), segments)
+
+    # -------------------------------------------
+    # execution
+
+    def execute(self, config, nds=None, multiprocess=True, datacache=None,
+                trigcache=None, segmentcache=None, segdb_error='raise',
+                datafind_error='raise'):
+        """Read and generate all of the data in this plan
+
+        Parameters are as for `~gwsumm.tabs.DataTab.process_state`.
+        """
+        # segments
+        for segments, flags in self.groups('segments'):
+            vprint("    Querying %d data-quality flags for %d segments\n"
+                   % (len(flags), len(segments)))
+            get_segments(flags, segments, config=config, cache=segmentcache,
+                         segdb_error=segdb_error, return_=False)
+
+        # raw data, read once for all products
+        spectral = OrderedDict()
+        for product in ['spectrogram', 'rayleigh', 'coherence']:
+            for (key, _), segments in self.requests[product].iteritems():
+                if product != 'coherence':
+                    key = (key,)
+                for channel in key:
+                    try:
+                        spectral[channel] = (
+                            spectral[channel] | segments).coalesce()
+                    except KeyError:
+                        spectral[channel] = segments
+        for segments, channels in self._group(
+                self.requests['timeseries'], spectral):
+            vprint("    Reading %d channels for %d segments\n"
+                   % (len(channels), len(segments)))
+            get_timeseries_dict(channels, segments, config=config, nds=nds,
+                                multiprocess=multiprocess, cache=datacache,
+                                datafind_error=datafind_error, return_=False)
+        for segments, channels in self.groups('statevector'):
+            vprint("    Reading %d state-vector channels for %d segments\n"
+                   % (len(channels), len(segments)))
+            get_timeseries_dict(channels, segments, config=config, nds=nds,
+                                multiprocess=multiprocess, statevector=True,
+                                cache=datacache, return_=False,
+                                datafind_error=datafind_error, dtype='uint32')
+
+        # spectrograms, with the FFT parameters of the requesting tabs
+        for segments, keys in self.groups('spectrogram'):
+            for fftkey, channels in self._split_fftparams(keys):
+                vprint("    Calculating spectrograms for %d channels\n"
+                       % len(channels))
+                get_spectrograms(channels, segments, config=config, nds=nds,
+                                 multiprocess=multiprocess, return_=False,
+                                 cache=datacache,
+                                 datafind_error=datafind_error,
+                                 **self.fftparams[fftkey])
+        for segments, keys in self.groups('rayleigh'):
+            for fftkey, channels in self._split_fftparams(keys):
+                fp2 = self.fftparams[fftkey].copy()
+                fp2['method'] = fp2['format'] = 'rayleigh'
+                get_spectrograms(channels, segments, config=config,
+                                 return_=False, multiprocess=multiprocess,
+                                 **fp2)
+        for segments, keys in self.groups('coherence'):
+            for fftkey, pairs in self._split_fftparams(keys):
+                fp2 = self.fftparams[fftkey].copy()
+                fp2['method'] = 'welch'
+                get_coherence_spectrograms(
+                    [c for pair in pairs for c in pair], segments,
+                    config=config, nds=nds, multiprocess=multiprocess,
+                    return_=False, cache=datacache,
+                    datafind_error=datafind_error, **fp2)
+
+        # triggers
+        for segments, triggers in self.groups('triggers'):
+            for etg, channel in triggers:
+                get_triggers(channel, etg, segments, config=config,
+                             cache=trigcache, multiprocess=multiprocess,
+                             return_=False)
@@ -35,6 +35,11 @@ try:
     from gwpy.frequencyseries import FrequencySeries
 except ImportError:
     from gwpy.spectrum import Spectrum as FrequencySeries
+try:
+    from gwpy.frequencyseries import SpectralVariance
+except ImportError:
+    from gwpy.spectrum import SpectralVariance
+from gwpy.timeseries import TimeSeries
 from gwpy.plotter import *
 from gwpy.plotter.tex import label_to_latex
 
@@ -43,10 +48,14 @@ from ..utils import re_quote, re_cchar
 from ..channels import split as split_channels
 from ..data import (get_channel, get_timeseries, get_spectrogram,
                     get_coherence_spectrogram, get_spectrum, get_coherence_spectrum,
-                    add_timeseries)
+                    get_spectral_histogram, add_timeseries)
+from ..data.utils import make_globalv_key
+from ..data.envelope import (get_envelope, FACTOR as ENVELOPE_FACTOR)
 from ..state import ALLSTATE
 from .registry import (get_plot, register_plot)
 from .mixins import *
+from .raster import (axes_pixels, pixel_edges, rasterize_spectrograms)
+from .utils import log_safe
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -64,9 +73,47 @@ class TimeSeriesDataPlot(DataLabelSvgMixin, DataPlot):
 
     def __init__(self, *args, **kwargs):
         super(TimeSeriesDataPlot, self).__init__(*args, **kwargs)
+        self.decimate = self.pargs.pop('decimate', True)
         for c in self.channels:
             c._timeseries = True
 
+    def _plot_timeseries(self, ax, ts, key=None, **kwargs):
+        """Plot a `TimeSeries`, decimated to the pixel width of the axes
+
+        Data with many more samples than there are pixels across the axes
+        are drawn as a (semi-transparent) min/max envelope with the mean
+        overlaid, using the coarsest level of the `EnvelopePyramid` that
+        still resolves each pixel.
+
+        Returns
+        -------
+        line : `~matplotlib.lines.Line2D`
+            the line drawn for these data
+        """
+        nbins = 2 * int(ax.bbox.width)
+        if self.decimate and ts.size > ENVELOPE_FACTOR * nbins:
+            try:
+                times, min_, max_, mean = get_envelope(
+                    ts, key=key).get_level(nbins)
+            except ValueError:
+                pass
+            else:
+                # draw the mean through plot_timeseries so that it shares
+                # the epoch and GPS axis handling of undecimated data
+                mean = TimeSeries(mean, epoch=times[0],
+                                  sample_rate=1 / (times[1] - times[0]),
+                                  unit=ts.unit, name=ts.name,
+                                  channel=ts.channel)
+                line = ax.plot_timeseries(mean, **kwargs)[0]
+                # draw the envelope lighter than, and beneath, the mean
+                ax.fill_between(line.get_xdata(), min_, max_,
+                                color=line.get_color(),
+                                linewidth=0,
+                                alpha=kwargs.get('alpha', 1) * .3,
+                                zorder=line.get_zorder() - .5)
+                return line
+        return ax.plot_timeseries(ts, **kwargs)[0]
+
     def add_state_segments(self, ax, **kwargs):
         """Add an `Axes` below the given ``ax`` displaying the `SummaryState`
         for this `TimeSeriesDataPlot`.
@@ -145,6 +192,13 @@ class TimeSeriesDataPlot(DataLabelSvgMixin, DataPlot):
                     for c in clist]
             if len(clist) > 1:
                 data = [tsl.join(gap='pad', pad=numpy.nan) for tsl in data]
+            # double-check log scales
+            if self.pargs.get('logy', False) and len(clist) > 1:
+                data = map(log_safe, data)
+            elif self.pargs.get('logy', False):
+                for tsl in data:
+                    for i, ts in enumerate(tsl):
+                        list.__setitem__(tsl, i, log_safe(ts))
             flatdata = [ts for tsl in data for ts in tsl]
             # validate parameters
             for ts in flatdata:
@@ -152,9 +206,6 @@ class TimeSeriesDataPlot(DataLabelSvgMixin, DataPlot):
                 if (hasattr(ts, 'metadata') and
                         not 'x0' in ts.metadata) or not ts.x0:
                     ts.epoch = self.start
-                # double-check log scales
-                if self.pargs.get('logy', False):
-                    ts.value[ts.value == 0] = 1e-100
             # set label
             try:
                 label = pargs.pop('label')
@@ -177,8 +228,10 @@ class TimeSeriesDataPlot(DataLabelSvgMixin, DataPlot):
                     data[0].EntryClass([], epoch=self.start, unit='s',
                                        name=label), label=label, **pargs)
             else:
+                key = make_globalv_key(clist[0])
                 for ts in data[0]:
-                    line = ax.plot_timeseries(ts, label=label, **pargs)[0]
+                    line = self._plot_timeseries(ax, ts, key=key, label=label,
+                                                 **pargs)
                     label = None
                     pargs['color'] = line.get_color()
 
@@ -219,6 +272,15 @@ register_plot(TimeSeriesDataPlot)
 
 class SpectrogramDataPlot(TimeSeriesDataPlot):
     """DataPlot a Spectrogram
+
+    Long spectrograms can be binned onto the pixels of the output image
+    before drawing, which bounds the cost of rendering by the size of the
+    figure, by giving ``rebin = True``. Each pixel then shows the
+    ``rebin-method`` (one of ``'nanmedian'`` (default) or ``'nanmax'``)
+    of the spectrogram cells it contains, so the image can differ
+    slightly from that drawn cell-by-cell, most noticeably on a
+    logarithmic frequency axis, where many high-frequency bins fall
+    into each pixel.
     """
     type = 'spectrogram'
     data = 'spectrogram'
@@ -266,6 +328,8 @@ class SpectrogramDataPlot(TimeSeriesDataPlot):
         clog = self.pargs.pop('logcolor')
         clabel = self.pargs.pop('colorlabel')
         rasterized = self.pargs.pop('rasterized', True)
+        rebin = self.pargs.pop('rebin', False)
+        rebinmethod = self.pargs.pop('rebin-method', 'nanmedian')
         ratio = self.ratio
 
         # get cmap
@@ -330,6 +394,7 @@ class SpectrogramDataPlot(TimeSeriesDataPlot):
             clim = channel.psd_range
 
         # plot data
+        toplot = []
         for specgram in specgrams:
             # undo demodulation
             specgram = undo_demodulation(specgram, channel,
@@ -337,8 +402,33 @@ class SpectrogramDataPlot(TimeSeriesDataPlot):
             # calculate ratio
             if ratio is not None:
                 specgram = specgram.ratio(ratio)
-            # plot
-            ax.plot_spectrogram(specgram, cmap=cmap, rasterized=rasterized)
+            if rebin:
+                toplot.append(specgram)
+            else:
+                ax.plot_spectrogram(specgram, cmap=cmap,
+                                    rasterized=rasterized)
+        if rebin and toplot:
+            # bin onto the pixels of the output and draw a single image
+            xlim = self.pargs.get('xlim', (self.start, self.end))
+            logy = (self.pargs.get('logy', False) or
+                    self.pargs.get('yscale', None) == 'log')
+            freqs = numpy.concatenate([s.frequencies.value for
+                                       s in toplot])
+            if logy:
+                freqs = freqs[freqs > 0]
+            ylim = list(self.pargs.get('ylim', None) or
+                        (freqs.min(), freqs.max()))
+            if logy and ylim[0] <= 0:
+                ylim[0] = freqs.min()
+            width, height = axes_pixels(ax)
+            xedges = pixel_edges(xlim, width)
+            yedges = pixel_edges(ylim, height, log=logy)
+            image = rasterize_spectrograms(toplot, xedges, yedges,
+                                           method=rebinmethod)
+            ax.imshow(numpy.ma.masked_invalid(image), origin='lower',
+                      aspect='auto', interpolation='nearest', cmap=cmap,
+                      extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]),
+                      rasterized=rasterized)
 
         # add colorbar
         if len(specgrams) == 0:
@@ -461,16 +551,15 @@ class SpectrumDataPlot(DataPlot):
                                     format=sdform, method=method)
 
             # undo demodulation
-            for spec in data:
-                spec = undo_demodulation(spec, channel,
-                                         self.pargs.get('xlim', None))
+            data = [undo_demodulation(spec, channel,
+                                      self.pargs.get('xlim', None))
+                    for spec in data]
 
             # anticipate log problems
             if self.pargs['logx']:
                 data = [s[1:] for s in data]
             if self.pargs['logy']:
-                for sp in data:
-                    sp.value[sp.value == 0] = 1e-100
+                data = map(log_safe, data)
 
             if use_percentiles:
                 ax.plot_spectrum_mmm(*data, **pargs)
@@ -837,6 +926,8 @@ class SpectralVarianceDataPlot(SpectrumDataPlot):
                              "more than 1 channel")
         super(SpectralVarianceDataPlot, self).__init__(
             channels, *args, **kwargs)
+        # FFT parameters of the spectrograms, set by the parent tab
+        self.fftparams = {}
 
     def parse_variance_kwargs(self):
         varargs = dict()
@@ -845,6 +936,56 @@ class SpectralVarianceDataPlot(SpectrumDataPlot):
                 varargs[key] = self.pargs.pop(key)
         return varargs
 
+    @staticmethod
+    def _histogram_variance(hist, low=None, high=None, log=False, nbins=100,
+                            bins=None, density=False, norm=False):
+        """Build a `SpectralVariance` from a `SpectralHistogram`
+
+        The keyword arguments match those of
+        `~gwpy.spectrogram.Spectrogram.variance`. If neither ``norm`` nor
+        ``density`` is given, the counts are normalised to the fraction
+        of time in each bin.
+
+        Amplitudes outside of the histogram's window (see
+        `~gwsumm.data.histogram.SpectralHistogram`) are counted in the
+        lowest or highest bin, so that no time is lost.
+        """
+        if norm and density:
+            raise ValueError("Cannot give both norm=True and density=True, "
+                             "please pick one")
+        if bins is None:
+            # match Spectrogram.variance, padding the data range by two
+            if low is None or high is None:
+                dmin, dmax = hist.limits()
+            if low is None:
+                low = dmin / 2.
+            if high is None:
+                high = dmax * 2.
+            if log:
+                bins = numpy.logspace(numpy.log10(low), numpy.log10(high),
+                                      int(nbins) + 1)
+            else:
+                bins = numpy.linspace(low, high, int(nbins) + 1)
+        bins = numpy.asarray(bins, dtype=float)
+        counts = hist.to_histogram(bins)
+        if hist.dropped:
+            warnings.warn("%d of %d amplitudes are outside the histogram "
+                          "window, and have been counted in the outermost "
+                          "bins of the spectral variance"
+                          % (hist.dropped, hist.count * hist.nfreq))
+            counts[:, 0] += hist.under
+            counts[:, -1] += hist.over
+        total = counts.sum(axis=1)[:, None]
+        total[total == 0] = 1
+        if norm:
+            counts /= total
+        elif density:
+            counts /= total * numpy.diff(bins)[None, :]
+        else:
+            counts /= hist.count
+        return SpectralVariance(counts, bins=bins, f0=hist.f0, df=hist.df,
+                                unit=hist.unit)
+
     def _draw(self):
         """Load all data, and generate this `SpectrumDataPlot`
         """
@@ -887,25 +1028,26 @@ class SpectralVarianceDataPlot(SpectrumDataPlot):
         # calculate spectral variance and plot
         # pad data request to over-fill plots (no gaps at the end)
         if self.state and not self.all_data:
-            valid = self.state.active
+            valid = self.state
         else:
             valid = SegmentList([self.span])
-        livetime = float(abs(valid))
+        livetime = float(abs(getattr(valid, 'active', valid)))
 
         if livetime:
             plotargs.setdefault('vmin', 1/livetime)
         plotargs.setdefault('vmax', 1.)
         plotargs.pop('label')
 
-        specgram = get_spectrogram(self.channels[0], valid, query=False,
-                                    format='asd').join(gap='ignore')
+        # the variance is re-binned from the amplitude histogram
+        # accumulated alongside the spectrograms, rather than from
+        # a joined spectrogram
+        hist = get_spectral_histogram(self.channels[0], valid, query=False,
+                                      format='asd', **self.fftparams)
 
-        if specgram.size:
-            asd = specgram.median(axis=0)
-            asd.name = None
-            variance = specgram.variance(**varargs)
-            # normalize the variance
-            variance /= livetime / specgram.dt.value
+        if hist is not None and hist.count:
+            asd = FrequencySeries(hist.percentile(50), f0=hist.f0,
+                                  df=hist.df, unit=hist.unit)
+            variance = self._histogram_variance(hist, **varargs)
             # undo demodulation
             variance = undo_demodulation(variance, self.channels[0],
                                          self.pargs.get('xlim', None))
@@ -1029,6 +1171,9 @@ def undo_demodulation(spec, channel, limits=None):
                 return spec
         high = Quantity(high, 'Hz')
         if high < spec.f0:
+            # stored data may be read-only
+            if not spec.flags.writeable:
+                spec = spec.copy()
             if spec.ndim > 1:  # Spectrogram
                 spec.value[:] = numpy.fliplr(spec.value)
             else:  # FrequencySeries
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pixel-aware binning of spectrograms for display
+
+A day of 1/8 Hz resolution data up to 8 kHz contains far more cells than
+the output image has pixels. Here spectrograms are reduced onto the pixel
+grid of the target axes (linear in time, linear or logarithmic in
+frequency) before drawing, so the cost of rendering is bounded by the
+size of the figure, not the span of the data.
+
+Each pixel takes the reduction (see `REDUCERS`) of all cells whose
+centres fall within it, or, where cells are larger than pixels, the value
+of the cell covering the pixel centre.
+"""
+
+from __future__ import division
+
+import warnings
+
+import numpy
+
+from matplotlib import rcParams
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+__all__ = ['REDUCERS', 'axes_pixels', 'pixel_edges',
+           'rasterize_spectrograms']
+
+
+def _reduce_nanmax(values, first, axis):
+    return numpy.fmax.reduceat(values, first, axis=axis)
+
+
+def _reduce_nanmedian(values, first, axis):
+    groups = numpy.split(values, first[1:], axis=axis)
+    with warnings.catch_warnings():  # all-NaN groups
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return numpy.concatenate([numpy.nanmedian(g, axis=axis, keepdims=True)
+                                  for g in groups], axis=axis)
+
+
+# functions to reduce groups of cells, with signature
+# (values, first index of each group, axis) -> reduced values
+REDUCERS = {
+    'nanmax': _reduce_nanmax,
+    'nanmedian': _reduce_nanmedian,
+}
+
+
+def axes_pixels(ax):
+    """Return the ``(width, height)`` of the given axes, in saved pixels
+    """
+    fig = ax.figure
+    dpi = rcParams['savefig.dpi']
+    if not isinstance(dpi, (int, float)):  # 'figure'
+        dpi = fig.dpi
+    pos = ax.get_position()
+    return (int(round(pos.width * fig.get_figwidth() * dpi)),
+            int(round(pos.height * fig.get_figheight() * dpi)))
+
+
+def pixel_edges(lim, npix, log=False):
+    """Return the edges of ``npix`` pixels spanning the given limits
+
+    Parameters
+    ----------
+    lim : `tuple`
+        ``(low, high)`` limits of the axis
+
+    npix : `int`
+        number of pixels
+
+    log : `bool`, optional
+        space the pixels logarithmically, default: `False`
+
+    Returns
+    -------
+    edges : `numpy.ndarray`
+        array of ``npix + 1`` pixel edges
+    """
+    low, high = map(float, lim)
+    if log:
+        return numpy.logspace(numpy.log10(low), numpy.log10(high), npix + 1)
+    return numpy.linspace(low, high, npix + 1)
+
+
+def _bin_axis(values, centres, width, edges, reducer, axis):
+    """Reduce the cells along one axis of ``values`` onto the given pixels
+    """
+    npix = edges.size - 1
+    shape = list(values.shape)
+    shape[axis] = npix
+    out = numpy.empty(shape)
+    out.fill(numpy.nan)
+    slicer = [slice(None)] * values.ndim
+
+    # reduce all cells whose centre is within each pixel
+    idx = numpy.searchsorted(edges, centres, side='right') - 1
+    order = numpy.argsort(idx, kind='mergesort')
+    idx = idx[order]
+    keep = (idx >= 0) & (idx < npix)
+    order = order[keep]
+    idx = idx[keep]
+    filled = numpy.zeros(npix, dtype=bool)
+    if idx.size:
+        if (numpy.diff(order) == 1).all():  # avoid copying the input
+            slicer[axis] = slice(order[0], order[-1] + 1)
+            cells = values[tuple(slicer)]
+        else:
+            cells = values.take(order, axis=axis)
+        pix, first = numpy.unique(idx, return_index=True)
+        slicer[axis] = pix
+        out[tuple(slicer)] = reducer(cells, first, axis)
+        filled[pix] = True
+
+    # pixels smaller than a cell take the cell that covers their centre
+    empty = numpy.nonzero(~filled)[0]
+    if empty.size:
+        pcentres = (edges[empty] + edges[empty + 1]) / 2.
+        sort = numpy.argsort(centres)
+        sorted_ = centres[sort]
+        j = numpy.searchsorted(sorted_, pcentres).clip(0, sorted_.size - 1)
+        prev = (j - 1).clip(0)
+        j = numpy.where(numpy.abs(pcentres - sorted_[prev]) <
+                        numpy.abs(sorted_[j] - pcentres), prev, j)
+        cover = numpy.abs(sorted_[j] - pcentres) <= width / 2.
+        slicer[axis] = empty[cover]
+        source = [slice(None)] * values.ndim
+        source[axis] = sort[j[cover]]
+        out[tuple(slicer)] = values[tuple(source)]
+    return out
+
+
+def rasterize_spectrograms(specgrams, xedges, yedges, method='nanmedian'):
+    """Bin a list of spectrograms onto a single image of pixels
+
+    Parameters
+    ----------
+    specgrams : `list` of `~gwpy.spectrogram.Spectrogram`
+        the spectrograms to draw
+
+    xedges : `numpy.ndarray`
+        the GPS time edges of each image column
+
+    yedges : `numpy.ndarray`
+        the frequency edges of each image row
+
+    method : `str`, optional
+        the name of the reduction to use for each pixel, one of the
+        keys of `REDUCERS`
+
+    Returns
+    -------
+    image : `numpy.ndarray`
+        ``(len(yedges) - 1, len(xedges) - 1)`` array of pixel values,
+        with `~numpy.nan` where there are no data
+
+    Notes
+    -----
+    Cells are reduced along the frequency axis first, then along time, so
+    ``'nanmedian'`` gives the median (over time) of the median (over
+    frequency) within each pixel; this keeps the cost linear in the size
+    of the data.
+
+    Pixels that overlap more than one spectrogram (i.e. at the boundary
+    between segments) take the maximum of the values from each.
+    """
+    try:
+        reducer = REDUCERS[method]
+    except KeyError:
+        raise ValueError("Unrecognised rasterization method %r, choose one "
+                         "of: %s" % (method, ', '.join(sorted(REDUCERS))))
+    image = numpy.empty((yedges.size - 1, xedges.size - 1))
+    image.fill(numpy.nan)
+    for specgram in specgrams:
+        if not specgram.shape[0]:
+            continue
+        dt = specgram.dt.value
+        times = (specgram.x0.value + dt / 2. +
+                 numpy.arange(specgram.shape[0]) * dt)
+        # only consider rows within the image
+        keep = (times + dt / 2. > xedges[0]) & (times - dt / 2. < xedges[-1])
+        if not keep.any():
+            continue
+        rows = numpy.nonzero(keep)[0]
+        values = numpy.asarray(specgram.value)[rows[0]:rows[-1] + 1]
+        times = times[rows[0]:rows[-1] + 1]
+        freqs = numpy.asarray(specgram.frequencies.value)
+        binned = _bin_axis(values, freqs, abs(specgram.df.value), yedges,
+                           reducer, axis=1)
+        binned = _bin_axis(binned, times, dt, xedges, reducer, axis=0)
+        image = numpy.fmax(image, binned.T)
+    return image
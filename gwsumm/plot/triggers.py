@@ -39,6 +39,7 @@ from ..utils import re_cchar
 from ..data import (get_channel, get_timeseries, add_timeseries)
 from ..triggers import get_triggers
 from .registry import (get_plot, register_plot)
+from .utils import log_safe
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -346,7 +347,7 @@ class TriggerTimeSeriesDataPlot(TimeSeriesDataPlot):
             for ts in data:
                 # double-check log scales
                 if self.pargs['logy']:
-                    ts.value[ts.value == 0] = 1e-100
+                    ts = log_safe(ts)
                 if color is None:
                     line = ax.plot_timeseries(ts, label=label)[0]
                     color = line.get_color()
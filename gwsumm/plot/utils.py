@@ -41,3 +41,17 @@ def get_column_label(column):
         return COLUMN_LABEL.get(column)
     except KeyError:
         return get_column_string(column)
+
+
+def log_safe(series, fill=1e-100):
+    """Return a series with zeros replaced for plotting on a log scale
+
+    Stored data may be read-only (see
+    `~gwsumm.data.spill.share_channels`), so zeros are replaced in a
+    copy, and the input is returned unchanged if it has none.
+    """
+    zeros = series.value == 0
+    if zeros.any():
+        series = series.copy()
+        series.value[zeros] = fill
+    return series
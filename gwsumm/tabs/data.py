@@ -45,7 +45,12 @@ from ..channels import (re_channel,
 from ..config import *
 from ..mode import (get_mode, MODE_ENUM)
 from ..data import (get_channel, get_timeseries_dict, get_spectrograms,
-                    get_coherence_spectrograms, get_spectrum, FRAMETYPE_REGEX)
+                    get_coherence_spectrograms, get_spectrum,
+                    get_spectral_histogram, FRAMETYPE_REGEX)
+from ..data import memory
+from ..data.utils import parse_fftparams
+from ..data.fftpool import close_process_pool
+from ..data.spill import share_channels
 from ..plot import get_plot
 from ..segments import get_segments
 from ..state import (generate_all_state, ALLSTATE, SummaryState, get_state)
@@ -98,6 +103,9 @@ class DataTab(DataTabBase):
     noplots : `bool`, optional, default: `False`
         indicates that this tab only exists to trigger data access, and
         shouldn't actually generate any figures
+    fftparams : `dict`, optional
+        FFT parameters for the spectral data of this tab, defaults to
+        those in the ``[fft]`` section of the configuration
     **kwargs
         other keyword arguments
 
@@ -110,12 +118,13 @@ class DataTab(DataTabBase):
     type = 'archived-data'
 
     def __init__(self, name, start, end, states=list([ALLSTATE]),
-                 ismeta=False, noplots=False, **kwargs):
+                 ismeta=False, noplots=False, fftparams=None, **kwargs):
         """Initialise a new `DataTab`.
         """
         super(DataTab, self).__init__(name, start, end, states=states, **kwargs)
         self.ismeta = ismeta
         self.noplots = noplots
+        self.fftparams = fftparams
         self.subplots = []
 
     # -------------------------------------------
@@ -164,6 +173,7 @@ class DataTab(DataTabBase):
 
         job = super(DataTab, cls).from_ini(cp, section, **kwargs)
         job._config = cp._sections[section]
+        job.fftparams = parse_fftparams(cp, section)
 
         # -------------------
         # parse plot requests
@@ -301,6 +311,16 @@ class DataTab(DataTabBase):
     # -------------------------------------------
     # SummaryTab processing
 
+    def get_fftparams(self, config=ConfigParser()):
+        """Return the FFT parameters for the spectral data of this tab
+
+        These are the ``fftparams`` given to this tab, or the defaults
+        from the ``[fft]`` section of the configuration.
+        """
+        if self.fftparams is None:
+            return parse_fftparams(config)
+        return self.fftparams.copy()
+
     def finalize_states(self, config=ConfigParser(), segdb_error='raise',
                         **kwargs):
         """Fetch the segments for each state for this `SummaryTab`
@@ -351,20 +371,29 @@ class DataTab(DataTabBase):
         vprint("States finalised [%d total]\n" % len(self.states))
         vprint("    Default state: %r\n" % str(self.defaultstate))
 
-        # pre-process requests for 'all-data' plots
-        all_data = any([(p.all_data & p.new) for p in self.plots])
-        if all_data:
-            self.process_state(None, config=config, multiprocess=multiprocess,
-                               **stateargs)
-        # process each state
-        for state in sorted(self.states, key=lambda s: abs(s.active),
-                            reverse=True):
-            if state:
-                vprint("Processing '%s' state\n" % state.name)
-            else:
-                vprint("Pre-processing all-data requests\n")
-            self.process_state(state, config=config, multiprocess=multiprocess,
-                               **stateargs)
+        # protect data required for time-domain plots from the memory limit
+        pinned = set(get_channel(c).ndsname for channel in self.get_channels(
+                         'timeseries', 'statevector', 'odc') for
+                     c in split_channel_combination(channel))
+        memory.pin(*pinned)
+
+        try:
+            # pre-process requests for 'all-data' plots
+            all_data = any([(p.all_data & p.new) for p in self.plots])
+            if all_data:
+                self.process_state(None, config=config,
+                                   multiprocess=multiprocess, **stateargs)
+            # process each state
+            for state in sorted(self.states, key=lambda s: abs(s.active),
+                                reverse=True):
+                if state:
+                    vprint("Processing '%s' state\n" % state.name)
+                else:
+                    vprint("Pre-processing all-data requests\n")
+                self.process_state(state, config=config,
+                                   multiprocess=multiprocess, **stateargs)
+        finally:
+            memory.unpin(*pinned)
 
 
     def process_state(self, state, nds=None, multiprocess=True,
@@ -443,15 +472,7 @@ class DataTab(DataTabBase):
         # process spectrograms
 
         # find FFT parameters
-        try:
-            fftparams = dict(config.nditems('fft'))
-        except NoSectionError:
-            fftparams = {}
-        for key, val in fftparams.iteritems():
-            try:
-                fftparams[key] = eval(val)
-            except (NameError, SyntaxError):
-                pass
+        fftparams = self.get_fftparams(config)
 
         sgchannels = self.get_channels('spectrogram', 'spectrum',
                                        all_data=all_data, read=True)
@@ -505,6 +526,18 @@ class DataTab(DataTabBase):
             fp2['method'] = fp2['format'] = 'rayleigh'
             get_spectrum(channel, state, config=config, return_=False, **fp2)
 
+        # accumulate amplitude histograms for spectral variance plots here,
+        # so that they are stored (and archived) by this process, rather
+        # than built (and discarded) by a forked plotting process
+        for channel in self.get_channels('spectrogram', all_data=all_data,
+                                         read=True, type='variance'):
+            get_spectral_histogram(channel, state, config=config, query=False,
+                                   format='asd', **fftparams)
+        # and make sure the plots look up the same spectrograms
+        for plot in self.plots + self.subplots:
+            if plot.type == 'variance':
+                plot.fftparams = fftparams
+
         # --------------------------------------------------------------------
         # process segments
 
@@ -581,6 +614,17 @@ class DataTab(DataTabBase):
             queue.get().process()
         # otherwise execute all processes and wait
         elif nproc > 1:
+            # don't fork plot workers while the spectrogram pool's
+            # threads are alive, it is restarted on demand
+            close_process_pool()
+            # publish data in shared memory so that forked processes
+            # don't each duplicate the pages they touch
+            shared = share_channels(set(
+                c.ndsname for p in new_plots if p._threadsafe for
+                c in getattr(p, 'allchannels', [])))
+            if shared:
+                vprint("        %.1f MB of data moved to shared memory\n"
+                       % (shared / 1024. ** 2))
             # actually execute all processes
             procs = []
             for i in range(min(nproc, multiprocess)):
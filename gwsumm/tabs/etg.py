@@ -33,6 +33,7 @@ from gwpy.plotter.table import (get_table_column, get_row_value)
 from .. import html
 from ..config import NoOptionError
 from ..data import get_channel
+from ..data.cache import IndexedCache
 from ..state import (get_state, ALLSTATE)
 from ..triggers import (get_etg_table, get_triggers, register_etg_table)
 from ..utils import re_quote
@@ -247,8 +248,8 @@ class EventTriggerTab(get_tab('default')):
         if isinstance(self.cache, str) and os.path.isfile(self.cache):
             with open(self.cache, 'r') as fobj:
                 try:
-                    self.cache = Cache.fromfile(fobj).sieve(
-                                             segment=self.span)
+                    self.cache = IndexedCache(
+                        Cache.fromfile(fobj)).sieve(segment=self.span)
                 except ValueError as e:
                     if "could not convert \'\\n\' to CacheEntry" in str(e):
                         error = 'could not parse event cache file'
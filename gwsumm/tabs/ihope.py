@@ -36,6 +36,7 @@ from gwpy.plotter.table import (get_table_column, get_row_value)
 from .. import (html, globalv)
 from ..config import (GWSummConfigParser, NoOptionError, DEFAULTSECT)
 from ..data import find_cache_segments
+from ..data.cache import IndexedCache
 from ..triggers import (get_triggers, register_etg_table)
 from ..utils import re_quote
 from ..state import SummaryState
@@ -190,8 +191,8 @@ class DailyAhopeTab(base):
         if os.path.isfile(self.inspiralcachefile):
             with open(self.inspiralcachefile, 'r') as fobj:
                 try:
-                    self.inspiralcache = Cache.fromfile(fobj).sieve(
-                                             segment=self.span)
+                    self.inspiralcache = IndexedCache(
+                        Cache.fromfile(fobj)).sieve(segment=self.span)
                 except ValueError as e:
                     if "could not convert \'\\n\' to CacheEntry" in str(e):
                         self.inspiralcache = Cache()
@@ -203,8 +204,8 @@ class DailyAhopeTab(base):
         if os.path.isfile(self.tmpltbankcachefile):
             with open(self.tmpltbankcachefile, 'r') as fobj:
                 try:
-                    self.tmpltbankcache = Cache.fromfile(fobj).sieve(
-                                              segment=self.span)
+                    self.tmpltbankcache = IndexedCache(
+                        Cache.fromfile(fobj)).sieve(segment=self.span)
                 except ValueError:
                     if "could not convert \'\\n\' to CacheEntry" in str(e):
                         self.tmpltbankcache = Cache()
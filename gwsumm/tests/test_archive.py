@@ -25,12 +25,15 @@ import os
 import tempfile
 from functools import wraps
 
+import numpy
 from numpy import testing as nptest
 
 from gwpy.timeseries import TimeSeries
+from gwpy.spectrogram import Spectrogram
 
 from common import unittest
 from gwsumm import (archive, data, globalv, channels)
+from gwsumm.data.histogram import SpectralHistogram
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -76,3 +79,63 @@ class ArchiveTests(unittest.TestCase):
         nptest.assert_array_equal(ts.value, TEST_DATA.value)
         for attr in ['epoch', 'unit', 'sample_rate', 'channel', 'name']:
             self.assertEqual(getattr(ts, attr), getattr(TEST_DATA, attr))
+
+    def test_read_archive_histograms(self):
+        specgram = Spectrogram(10 ** numpy.random.normal(-20, .5, (100, 4)),
+                               epoch=100, dt=1, f0=0, df=1)
+        hist = SpectralHistogram.from_spectrogram(specgram)
+        hist.update(specgram)
+        _hists = globalv.SPECTRAL_HISTOGRAMS
+        globalv.SPECTRAL_HISTOGRAMS = {'X1:TEST-CHANNEL': hist}
+        fnames = [tempfile.mktemp(suffix='.hdf', prefix='gwsumm-tests-')
+                  for _ in range(2)]
+        try:
+            for fname in fnames:
+                archive.write_data_archive(fname, timeseries=False,
+                                           segments=False, triggers=False)
+            globalv.SPECTRAL_HISTOGRAMS = {}
+            # read the same histogram from two archives (e.g. a daily
+            # archive and a previous run's archive), and check the counts
+            # are only recorded once
+            for fname in fnames:
+                archive.read_data_archive(fname)
+            merged = globalv.SPECTRAL_HISTOGRAMS['X1:TEST-CHANNEL']
+            self.assertEqual(merged.count, 100)
+            nptest.assert_array_equal(merged.counts, hist.counts)
+        finally:
+            globalv.SPECTRAL_HISTOGRAMS = _hists
+            for fname in fnames:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+
+    def test_read_archive_filter_states(self):
+        from gwsumm.data import filters
+        zpk = ([0.5], [0.9, 0.1], 2.)
+        series = TimeSeries(numpy.random.random(100), epoch=100,
+                            sample_rate=1)
+        whole = filters.apply_filter(series, zpk, 'test-archive-whole')
+        _states = globalv.FILTER_STATES
+        globalv.FILTER_STATES = {}
+        fname = tempfile.mktemp(suffix='.hdf', prefix='gwsumm-tests-')
+        try:
+            filters.apply_filter(series[:50], zpk, 'X1:TEST-FILTER')
+            archive.write_data_archive(fname, timeseries=False,
+                                       segments=False, triggers=False)
+            # a new run continues the filter from the archived state
+            globalv.FILTER_STATES = {}
+            archive.read_data_archive(fname)
+            self.assertEqual(globalv.FILTER_STATES['X1:TEST-FILTER'][0], 150)
+            b = filters.apply_filter(series[50:], zpk, 'X1:TEST-FILTER')
+            nptest.assert_array_almost_equal(b.value, whole.value[50:])
+        finally:
+            globalv.FILTER_STATES = _states
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_exclude_segments(self):
+        from gwpy.segments import (Segment, SegmentList)
+        out = archive.exclude_segments(
+            [TEST_DATA], SegmentList([Segment(102, 104), Segment(108, 120)]))
+        self.assertListEqual([ts.span for ts in out],
+                             [(100, 102), (104, 108)])
+        nptest.assert_array_equal(out[1].value, [5, 6, 7, 8])
@@ -20,8 +20,10 @@
 
 """
 
+import os
 import os.path
 import operator
+import warnings
 import tempfile
 import shutil
 
@@ -30,15 +32,22 @@ try:  # py3
 except ImportError:  # py2
     from urllib2 import urlopen
 
+import numpy
+
 from glue.lal import (Cache, CacheEntry)
 
-from gwpy.timeseries import TimeSeries
+from gwpy.timeseries import (TimeSeries, TimeSeriesDict, StateVector,
+                              StateVectorDict)
 from gwpy.detector import Channel
 from gwpy.segments import (Segment, SegmentList)
 
 from common import (unittest, empty_globalv_CHANNELS)
 from gwsumm import (data, globalv)
-from gwsumm.data import (utils, mathutils)
+from gwsumm.data import (utils, mathutils, store, memory, spill,
+                         readcache, datafindcache, ndspool, filters,
+                         envelope, trends, spectral, fftengine,
+                         histogram, fftpool)
+from gwsumm.data.cache import (IndexedCache, read_cache)
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -125,6 +134,22 @@ class DataTests(unittest.TestCase):
         self.assertRaises(ZeroDivisionError, utils.get_fftparams,
                           None, stride=0)
 
+    def test_parse_fftparams(self):
+        from gwsumm.config import GWSummConfigParser
+        config = GWSummConfigParser()
+        self.assertDictEqual(utils.parse_fftparams(config), {})
+        config.add_section('fft')
+        config.set('fft', 'fftlength', '8')
+        config.set('fft', 'window', 'hanning')
+        config.add_section('tab-test')
+        config.set('tab-test', 'fft-fftlength', '4')
+        config.set('tab-test', 'fft-overlap', '2')
+        self.assertDictEqual(utils.parse_fftparams(config),
+                             {'fftlength': 8, 'window': 'hanning'})
+        self.assertDictEqual(
+            utils.parse_fftparams(config, 'tab-test'),
+            {'fftlength': 4, 'overlap': 2, 'window': 'hanning'})
+
     def test_parse_math_definition(self):
         chans, operators = mathutils.parse_math_definition(
             "L1:TEST*2 + L1:TEST2^5")
@@ -137,6 +162,653 @@ class DataTests(unittest.TestCase):
         self.assertEqual(chans[1][0], 'L1:TEST2')
         self.assertTupleEqual(chans[1][1], (operator.pow, 5))
 
+    def test_indexed_list(self):
+        tsl = store.IndexedTimeSeriesList()
+        a = TimeSeries([1, 2, 3, 4, 5], epoch=0, sample_rate=1)
+        b = TimeSeries([1, 2, 3, 4, 5], epoch=10, sample_rate=1)
+        c = TimeSeries([6, 7, 8, 9, 10], epoch=5, sample_rate=1)
+        # check out-of-order inserts are sorted
+        tsl.add(b)
+        tsl.add(a)
+        self.assertListEqual(tsl.index[0], [0, 10])
+        self.assertListEqual(tsl.find(Segment(2, 3)), [0])
+        self.assertListEqual(tsl.find(Segment(4, 11)), [0, 1])
+        self.assertListEqual(tsl.find(Segment(5, 10)), [])
+        self.assertTrue(tsl.covers(Segment(1, 4)))
+        self.assertFalse(tsl.covers(Segment(4, 11)))
+        self.assertFalse(tsl.covers(Segment(14, 16)))
+        # check filling the gap coalesces all three
+        tsl.add(c)
+        self.assertEqual(len(tsl), 1)
+        self.assertEqual(tsl.segments, SegmentList([Segment(0, 15)]))
+        self.assertTrue(tsl.covers(Segment(1, 14)))
+
+    def test_indexed_spectrogram_list(self):
+        from gwpy.spectrogram import Spectrogram
+        sgl = store.IndexedSpectrogramList()
+        for i in range(10):
+            sgl.add(Spectrogram(numpy.ones((2, 4)) * i, epoch=i * 2, dt=1,
+                                f0=0, df=1))
+        self.assertEqual(len(sgl), 1)
+        self.assertEqual(sgl[0].span, (0, 20))
+        self.assertListEqual(list(sgl[0].value[:, 0]),
+                             [i for i in range(10) for _ in range(2)])
+        buffer_ = sgl[0]._rowbuffer
+        self.assertTrue(buffer_.owns(sgl[0].value))
+        self.assertGreaterEqual(buffer_.capacity, 20)
+        self.assertEqual(store.allocated_nbytes(sgl[0]), buffer_.array.nbytes)
+        # check earlier views are unaffected by later appends
+        view = sgl[0]
+        sgl.add(Spectrogram(numpy.ones((2, 4)) * 10, epoch=20, dt=1, f0=0,
+                            df=1))
+        self.assertEqual(view.shape[0], 20)
+        self.assertEqual(sgl[0].span, (0, 22))
+
+    def test_parse_size(self):
+        self.assertEqual(memory.parse_size('32G'), 32 * 1024 ** 3)
+        self.assertEqual(memory.parse_size('512 MB'), 512 * 1024 ** 2)
+        self.assertEqual(memory.parse_size(1024), 1024)
+        self.assertRaises(ValueError, memory.parse_size, 'lots')
+
+    def test_memory_pin(self):
+        key = 'test pin'
+        data.add_timeseries(TimeSeries(numpy.ones(1024), epoch=0,
+                                       sample_rate=1), key=key)
+        memory.set_evictable('DATA', key)
+        nbytes = memory.get_usage('DATA')
+        self.assertGreaterEqual(nbytes, 1024 * 8)
+        try:
+            with memory.pinned(key):
+                # nested pins are counted
+                with memory.pinned(key):
+                    pass
+                memory.evict(nbytes)
+                self.assertIn(key, globalv.DATA)
+                self.assertFalse(spill.is_spilled(globalv.DATA[key][0]))
+            memory.evict(nbytes)
+            self.assertEqual(memory.get_usage('DATA'), nbytes - 1024 * 8)
+            # check evicted data are kept on disk, not dropped
+            self.assertTrue(spill.is_file_backed(globalv.DATA[key][0]))
+            self.assertListEqual(list(globalv.DATA[key][0].value),
+                                 [1.] * 1024)
+        finally:
+            globalv.DATA.pop(key, None)
+            memory.set_evictable('DATA', key, False)
+            memory.record('DATA', key)
+
+    def test_memory_evict_derived(self):
+        keys = ['test evict a', 'test evict b']
+        for key in keys:
+            data.add_timeseries(TimeSeries(numpy.ones(1024), epoch=0,
+                                           sample_rate=1), key=key)
+            memory.set_evictable('DATA', key)
+        try:
+            # data used to calculate spectrograms are evicted first, even
+            # if used more recently
+            memory.set_derived(keys[1])
+            memory.evict(1)
+            self.assertFalse(spill.is_spilled(globalv.DATA[keys[0]][0]))
+            self.assertTrue(spill.is_spilled(globalv.DATA[keys[1]][0]))
+        finally:
+            for key in keys:
+                globalv.DATA.pop(key, None)
+                memory.set_evictable('DATA', key, False)
+                memory.record('DATA', key)
+            memory._DERIVED.discard(keys[1])
+
+    def test_spill_to_disk(self):
+        a = TimeSeries([1, 2, 3, 4, 5], epoch=0, sample_rate=1,
+                       name='test name')
+        self.assertFalse(spill.is_spilled(a))
+        b = spill.spill_to_disk(a, directory=tempfile.gettempdir())
+        self.assertTrue(spill.is_spilled(b))
+        self.assertIsInstance(b, TimeSeries)
+        self.assertEqual(b.name, a.name)
+        self.assertEqual(b.span, a.span)
+        self.assertListEqual(list(b.value), list(a.value))
+
+    def test_spilled_merge(self):
+        globalv.MEMMAP_DIRECTORY = tempfile.gettempdir()
+        try:
+            tsl = store.IndexedTimeSeriesList()
+            for i in range(10):
+                tsl.add(spill.spill_to_disk(TimeSeries(
+                    numpy.ones(4) * i, epoch=i * 4, sample_rate=1)))
+            self.assertEqual(len(tsl), 1)
+            self.assertTrue(spill.is_file_backed(tsl[0]))
+            self.assertEqual(tsl[0].span, (0, 40))
+            self.assertListEqual(list(tsl[0].value),
+                                 [i for i in range(10) for _ in range(4)])
+            # check merges write into the same file
+            buffer_ = tsl[0]._rowbuffer
+            tsl.add(TimeSeries(numpy.ones(4) * 10, epoch=40, sample_rate=1))
+            self.assertIs(tsl[0]._rowbuffer.file, buffer_.file)
+        finally:
+            globalv.MEMMAP_DIRECTORY = None
+
+    def test_share_channels(self):
+        from gwpy.spectrogram import Spectrogram
+        key = 'X1:TEST-SHARE'
+        sgl = store.IndexedSpectrogramList()
+        for i in range(4):
+            sgl.add(Spectrogram(numpy.ones((2, 4)) * i, epoch=i * 2, dt=1,
+                                f0=0, df=1))
+        self.assertIsNotNone(sgl[0]._rowbuffer)
+        globalv.SPECTROGRAMS[key] = sgl
+        memory.record('SPECTROGRAMS', key)
+        try:
+            self.assertGreater(memory._USAGE[('SPECTROGRAMS', key)],
+                               sgl[0].nbytes)
+            self.assertEqual(spill.share_channels([key]), sgl[0].nbytes)
+            shared = globalv.SPECTROGRAMS[key][0]
+            self.assertTrue(spill.is_spilled(shared))
+            self.assertIsNone(shared._rowbuffer)
+            # check usage is re-counted without the buffer capacity
+            self.assertEqual(memory._USAGE[('SPECTROGRAMS', key)],
+                             shared.nbytes)
+            # check a forked process reads the same pages, but can't
+            # modify them
+            pid = os.fork()
+            if pid == 0:  # child
+                ok = (shared.value[:, 0].tolist() ==
+                      [i for i in range(4) for _ in range(2)])
+                try:
+                    shared.value[0, 0] = -1
+                except ValueError:
+                    pass
+                else:
+                    ok = False
+                os._exit(0 if ok else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(shared.value[0, 0], 0)
+            # check plotting on a log scale copies, rather than writes
+            from gwsumm.plot.utils import log_safe
+            safe = log_safe(shared)
+            self.assertEqual(safe.value[0, 0], 1e-100)
+            self.assertEqual(shared.value[0, 0], 0)
+        finally:
+            globalv.SPECTROGRAMS.pop(key, None)
+            memory.record('SPECTROGRAMS', key)
+
+    def test_frame_read_cache(self):
+        tmpdir = tempfile.mkdtemp(prefix='gwsumm-test-')
+        try:
+            rcache = readcache.FrameReadCache(tmpdir, chunk=60)
+            channel = Channel('X1:TEST-CHANNEL')
+            self.assertListEqual(rcache.split([channel], 'X1_R', 30, 200),
+                                 [(30, 200, False)])
+            data = TimeSeries(range(200), epoch=0, sample_rate=1,
+                              name=channel.name)
+            rcache.write({channel: data}, 'X1_R', 30, 200)
+            self.assertListEqual(rcache.split([channel], 'X1_R', 30, 200),
+                                 [(30, 60, False), (60, 180, True),
+                                  (180, 200, False)])
+            out = rcache.read([channel], 'X1_R', 60, 180, TimeSeriesDict)
+            self.assertEqual(out[channel].span, (60, 180))
+            self.assertListEqual(list(out[channel].value), range(60, 180))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_frame_read_cache_resample(self):
+        tmpdir = tempfile.mkdtemp(prefix='gwsumm-test-')
+        try:
+            rcache = readcache.FrameReadCache(tmpdir, chunk=60)
+            channel = Channel('X1:TEST-CHANNEL')
+            data = TimeSeries(numpy.random.random(64 * 300), epoch=0,
+                              sample_rate=64, name=channel.name)
+
+            def reader(start, end):
+                return TimeSeriesDict({channel: data.crop(start, end)})
+
+            expected = data.crop(30, 250).resample(16)
+            # read once to fill the cache, then again to use it, the
+            # output should be the same as if the interval were read
+            # (and resampled) in one go
+            for i in range(2):
+                out = rcache.fetch(reader, [channel], 'X1_R', 30, 250,
+                                   TimeSeriesDict, rates={channel: 16})
+                self.assertEqual(out[channel].span, (30, 250))
+                numpy.testing.assert_allclose(out[channel].value,
+                                              expected.value)
+            self.assertListEqual(rcache.split([channel], 'X1_R', 30, 250),
+                                 [(30, 60, False), (60, 240, True),
+                                  (240, 250, False)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_datafind_cache(self):
+        dfcache = datafindcache.DatafindCache()
+        queries = []
+
+        def query(start, end):
+            queries.append((start, end))
+            return Cache([CacheEntry.from_T050017(
+                '/tmp/X-X1_R-%d-%d.gwf' % (t, 100)) for
+                t in range(start // 100 * 100, end, 100)])
+
+        key = (None, 'X', 'X1_R', 'file', None)
+        a = dfcache.find(key, 0, 200, query)
+        self.assertEqual(len(a), 2)
+        b = dfcache.find(key, 100, 400, query)
+        self.assertEqual(len(b), 3)
+        self.assertListEqual(queries, [(0, 200), (200, 400)])
+        self.assertListEqual([ce.segment[0] for ce in b], [100, 200, 300])
+        # check expired intervals, and the files only they cover, are
+        # dropped
+        dfcache._searched[key][0] = (0, 200, 0)
+        self.assertListEqual(dfcache.missing(key, 0, 400),
+                             SegmentList([Segment(0, 200)]))
+        self.assertEqual(len(dfcache.get(key, 0, 400)), 2)
+        # check gaps in the files found are searched again
+        gapkey = (None, 'X', 'X1_M', 'file', None)
+        gappy = datafindcache.DatafindCache(ttl=-1)
+        gappy.find(gapkey, 0, 400, lambda a, b: Cache([
+            CacheEntry.from_T050017('/tmp/X-X1_M-0-100.gwf'),
+            CacheEntry.from_T050017('/tmp/X-X1_M-300-100.gwf')]))
+        self.assertListEqual(gappy.missing(gapkey, 0, 400),
+                             SegmentList([Segment(100, 300)]))
+        # check the cache is only written when changed, and read back
+        tmpdir = tempfile.mkdtemp(prefix='gwsumm-test-datafind-')
+        try:
+            fname = os.path.join(tmpdir, 'datafind.pkl')
+            dfcache.filename = fname
+            dfcache.save()
+            self.assertTrue(os.path.isfile(fname))
+            os.remove(fname)
+            dfcache.save()
+            self.assertFalse(os.path.isfile(fname))
+            dfcache._dirty = True
+            dfcache.save()
+            new = datafindcache.DatafindCache(filename=fname)
+            self.assertListEqual(map(str, new.get(key, 0, 400)),
+                                 map(str, dfcache.get(key, 0, 400)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_nds_pool(self):
+        calls = []
+
+        class FakeDict(TimeSeriesDict):
+            @classmethod
+            def fetch(cls, channels, start, end, connection=None, **kw):
+                calls.append((connection, start, end))
+                if len(calls) == 1:
+                    raise RuntimeError("Transient failure")
+                out = cls()
+                for c in channels:
+                    out[c] = TimeSeries(numpy.arange(start, end), epoch=start,
+                                        sample_rate=1, name=str(c))
+                return out
+
+        pool = ndspool.NDSConnectionPool(
+            'localhost', 31200, size=2, chunk=40, groupsize=1, retries=1,
+            connect=lambda host, port: object())
+        channels = ['X1:TEST-A', 'X1:TEST-B']
+        self.assertEqual(len(pool.jobs(channels, 0, 100)), 6)
+        data = pool.fetch(FakeDict, channels, 0, 100)
+        self.assertEqual(len(calls), 7)
+        for c in channels:
+            self.assertEqual(data[c].span, (0, 100))
+            self.assertListEqual(list(data[c].value), range(100))
+
+        # check metadata are kept, and gaps are caught
+        class FakeStateDict(StateVectorDict):
+            short = 0
+
+            @classmethod
+            def fetch(cls, channels, start, end, connection=None, **kw):
+                out = cls()
+                for c in channels:
+                    out[c] = StateVector(
+                        numpy.arange(start, end - cls.short), epoch=start,
+                        sample_rate=1, name=str(c), bits=['a', 'b'])
+                return out
+
+        data = pool.fetch(FakeStateDict, channels, 0, 100)
+        self.assertIsInstance(data[channels[0]], StateVector)
+        self.assertListEqual(list(data[channels[0]].bits), ['a', 'b'])
+        self.assertListEqual(list(data[channels[0]].value), range(100))
+        FakeStateDict.short = 1
+        self.assertRaises(ValueError, pool.fetch, FakeStateDict, channels,
+                          0, 100)
+
+    def test_apply_filter(self):
+        zpk = ([0.5], [0.9, 0.1], 2.)
+        data = TimeSeries(numpy.random.random(100), epoch=0, sample_rate=1)
+        whole = filters.apply_filter(data, zpk, 'test-whole')
+        self.assertEqual(whole.span, data.span)
+        a = filters.apply_filter(data[:50], zpk, 'test-split')
+        b = filters.apply_filter(data[50:], zpk, 'test-split')
+        numpy.testing.assert_array_almost_equal(
+            numpy.concatenate((a.value, b.value)), whole.value)
+
+    def test_apply_power_response(self):
+        from gwpy.spectrogram import Spectrogram
+        zpk = ([], [-10, -10], 100.)
+        values = numpy.random.random((10, 33))
+        specgram = Spectrogram(values.copy(), epoch=0, dt=1, f0=0, df=.5)
+        expected = (specgram ** (1/2.)).filter(*zpk) ** 2
+        out = filters.apply_power_response(specgram, zpk, 'test-response')
+        self.assertIs(out, specgram)
+        numpy.testing.assert_allclose(out.value, expected.value)
+        self.assertIs(
+            filters.get_power_response('test-response', zpk, 0, .5, 33),
+            filters.get_power_response('test-response', zpk, 0., .5, 33))
+
+    def test_envelope(self):
+        data = TimeSeries(numpy.random.random(1000), epoch=0, sample_rate=10)
+        pyramid = envelope.get_envelope(data, key='test')
+        times, min_, max_, mean = pyramid.get_level(50)
+        self.assertEqual(min_.size, 63)
+        self.assertEqual(times[0], 0.8)
+        self.assertEqual(min_[0], data.value[:16].min())
+        self.assertEqual(max_[-1], data.value[992:].max())
+        self.assertAlmostEqual(mean[1], data.value[16:32].mean())
+        self.assertRaises(ValueError, pyramid.get_level, 500)
+        self.assertIs(envelope.get_envelope(data, key='test'), pyramid)
+        # check the cache is bounded
+        size = envelope.CACHE_SIZE
+        envelope.CACHE_SIZE = pyramid.nbytes
+        try:
+            other = TimeSeries(numpy.random.random(1000), epoch=100,
+                               sample_rate=10)
+            envelope.get_envelope(other, key='test')
+            self.assertNotIn(('test', 0., 1000), envelope._PYRAMIDS)
+            self.assertIn(('test', 100., 1000), envelope._PYRAMIDS)
+        finally:
+            envelope.CACHE_SIZE = size
+            envelope._PYRAMIDS.clear()
+
+    def test_make_trends(self):
+        data = TimeSeries(numpy.arange(300.), epoch=30, sample_rate=1,
+                          name='X1:TEST')
+        out = trends.make_trends(data, 60)
+        mean = out['mean']
+        self.assertEqual(mean.span, (60, 300))
+        self.assertEqual(mean.name, 'X1:TEST.mean')
+        self.assertListEqual(list(mean.value), [59.5, 119.5, 179.5, 239.5])
+        self.assertEqual(out['min'].value[0], 30)
+        self.assertEqual(out['max'].value[-1], 269)
+        self.assertListEqual(list(out['n'].value), [60] * 4)
+
+    def test_synthesize_trends(self):
+        from gwsumm.config import GWSummConfigParser
+        config = GWSummConfigParser()
+        config.add_section('trends')
+        config.set('trends', 'synthesize', 'True')
+        channel = data.get_channel('X1:TEST-SYNTH.mean,m-trend')
+        key = utils.make_globalv_key(channel)
+        raw = TimeSeries(numpy.arange(300.), epoch=30, sample_rate=1,
+                         name='X1:TEST-SYNTH', channel='X1:TEST-SYNTH')
+        data.add_timeseries(raw, key='X1:TEST-SYNTH')
+        try:
+            # check only complete bins are calculated and recorded
+            segments = SegmentList([Segment(30, 330)])
+            self.assertEqual(trends.synthesize_trends(
+                [channel], segments, config, query=False), 4)
+            self.assertEqual(globalv.DATA[key].segments,
+                             SegmentList([Segment(60, 300)]))
+            self.assertEqual(globalv.SYNTHETIC_TRENDS[key],
+                             SegmentList([Segment(60, 300)]))
+            # check edges shorter than one bin are ignored
+            self.assertEqual(trends.synthesize_trends(
+                [channel], segments, config, query=False), 0)
+        finally:
+            globalv.DATA.pop('X1:TEST-SYNTH', None)
+            globalv.DATA.pop(key, None)
+            globalv.SYNTHETIC_TRENDS.pop(key, None)
+
+    def test_indexed_cache(self):
+        cache = IndexedCache([CacheEntry.from_T050017(
+            '/tmp/X-X1_R-%d-10.gwf' % t) for t in [30, 0, 10, 50]])
+        self.assertListEqual(cache.segments(),
+                             [Segment(0, 20), Segment(30, 40),
+                              Segment(50, 60)])
+        sieved = cache.sieve(segment=Segment(15, 35))
+        self.assertIsInstance(sieved, IndexedCache)
+        self.assertListEqual([ce.segment[0] for ce in sieved], [10, 30])
+        self.assertListEqual(data.find_cache_segments(cache),
+                             cache.segments())
+
+    def test_read_cache_file(self):
+        tmpdir = tempfile.mkdtemp(prefix='gwsumm-test-')
+        try:
+            cachefile = os.path.join(tmpdir, 'test.lcf')
+            with open(cachefile, 'w') as f:
+                for t in range(0, 1000, 100):
+                    f.write('X X1_R %d 100 file://localhost/tmp/X-X1_R-%d-'
+                            '100.gwf\n' % (t, t))
+            cache = read_cache(cachefile, segment=Segment(150, 320),
+                               index=True)
+            self.assertListEqual([ce.segment[0] for ce in cache],
+                                 [100, 200, 300])
+            self.assertTrue(os.path.isfile(cachefile + '.idx.npz'))
+            self.assertListEqual(
+                read_cache(cachefile, segment=Segment(150, 320)), cache)
+            self.assertEqual(len(read_cache(cachefile)), 10)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_storage_dtype(self):
+        a = TimeSeries(numpy.arange(10.), epoch=0, sample_rate=1,
+                       name='test name')
+        self.assertIs(memory.to_storage_dtype(a, 'test dtype'), a)
+        globalv.STORAGE_DTYPE = 'float32'
+        try:
+            b = memory.to_storage_dtype(a, 'test dtype')
+            self.assertEqual(b.dtype, numpy.float32)
+            self.assertEqual(b.name, a.name)
+            self.assertEqual(b.span, a.span)
+            # integer data are never converted
+            c = TimeSeries(numpy.arange(10), epoch=0, sample_rate=1)
+            self.assertIs(memory.to_storage_dtype(c, 'test dtype'), c)
+            # check precision can be required for a single key
+            data.add_timeseries(a, key='test dtype')
+            self.assertEqual(globalv.DATA['test dtype'][0].dtype,
+                             numpy.float32)
+            memory.require_precision('DATA', 'test dtype')
+            self.assertEqual(len(globalv.DATA['test dtype']), 0)
+            data.add_timeseries(a, key='test dtype')
+            self.assertEqual(globalv.DATA['test dtype'][0].dtype,
+                             numpy.float64)
+        finally:
+            globalv.STORAGE_DTYPE = None
+
+    def test_storage_dtype_spectrogram(self):
+        from gwpy.spectrogram import Spectrogram
+        # strain PSDs underflow float32, so must be stored as given
+        psd = Spectrogram(numpy.ones((4, 8)) * 1e-46, epoch=0, dt=1, f0=0,
+                          df=1, name='test psd dtype')
+        globalv.STORAGE_DTYPE = 'float32'
+        try:
+            data.add_spectrogram(psd, key='test psd dtype')
+            stored = globalv.SPECTROGRAMS['test psd dtype'][0]
+            self.assertEqual(stored.dtype, numpy.float64)
+            numpy.testing.assert_array_equal(stored.value, psd.value)
+        finally:
+            globalv.STORAGE_DTYPE = None
+            globalv.SPECTROGRAMS.pop('test psd dtype', None)
+
+    def test_spectrogram_tails(self):
+        key = 'X1:TEST;welch;;;;4'
+        a = TimeSeries(numpy.arange(10.), epoch=0, sample_rate=1)
+        spectral._store_tail(key, a, 8)
+        self.assertEqual(globalv.SPECTROGRAM_TAILS[key].span, (8, 10))
+        tail, readsegs = spectral._find_tail(key,
+                                             SegmentList([Segment(8, 20)]))
+        self.assertIs(tail, globalv.SPECTROGRAM_TAILS[key])
+        self.assertListEqual(readsegs, SegmentList([Segment(10, 20)]))
+        b = TimeSeries(numpy.arange(10., 20.), epoch=10, sample_rate=1)
+        out = spectral._prepend_tail(key, tail, [b])
+        self.assertEqual(out[0].span, (8, 20))
+        self.assertListEqual(list(out[0].value), range(8, 20))
+        self.assertNotIn(key, globalv.SPECTROGRAM_TAILS)
+
+    def test_store_spectrogram_unit(self):
+        from gwpy.spectrogram import Spectrogram
+        from gwsumm.channels import get_channel
+        channel = get_channel('X1:TEST-STORE_UNIT')
+        key = 'X1:TEST-STORE_UNIT;welch'
+        a = Spectrogram(numpy.ones((4, 8)), epoch=0, dt=1, f0=0, df=1,
+                        unit='m^2/Hz')
+        b = Spectrogram(numpy.ones((4, 8)), epoch=4, dt=1, f0=0, df=1,
+                        unit='m*m/Hz')
+        try:
+            spectral._store_spectrogram(a, channel, key)
+            spectral._store_spectrogram(b, channel, key)
+            for specgram in globalv.SPECTROGRAMS[key]:
+                self.assertEqual(specgram.unit, a.unit)
+        finally:
+            globalv.SPECTROGRAMS.pop(key, None)
+
+    def test_batch_spectrogram(self):
+        # use data with a large offset, so any difference in detrending
+        # shows up in the low-frequency bins
+        series = [TimeSeries(numpy.random.random(640) + 10, epoch=0,
+                             sample_rate=16, name='X1:TEST-%d' % i)
+                  for i in range(3)]
+        specgrams = fftengine.batch_spectrogram(series, 8, 2, overlap=1,
+                                                window='hanning')
+        self.assertEqual(len(specgrams), 3)
+        for ts, specgram in zip(series, specgrams):
+            self.assertEqual(specgram.shape, (5, 17))
+            self.assertEqual(specgram.name, ts.name)
+            ref = ts.spectrogram(8, fftlength=2, overlap=1, window='hanning')
+            numpy.testing.assert_allclose(specgram.value, ref.value,
+                                          rtol=1e-6, atol=1e-12)
+        self.assertRaises(ValueError, fftengine.batch_spectrogram,
+                          [series[0], series[1][:320]], 8, 2)
+
+    def test_spectrogram_scheduler(self):
+        series = [TimeSeries(numpy.random.random(n), epoch=t, sample_rate=16,
+                             name='X1:TEST', unit='m')
+                  for t, n in [(0, 16 * 80 + 16), (100, 16 * 8)]]
+        out = []
+        scheduler = fftpool.SpectrogramScheduler(nproc=2)
+        for ts in series:
+            scheduler.add(ts, 8, {'fftlength': 2, 'overlap': 1}, out.append)
+        # 11 rows in total, split into jobs of 2 rows
+        self.assertListEqual([job[0] for job in scheduler.jobs()],
+                             [0] * 5 + [1])
+        scheduler.run()
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(len(out), 2)
+        for ts, specgram in zip(series, out):
+            ref = ts.spectrogram(8, fftlength=2, overlap=1)
+            self.assertEqual(specgram.span, ref.span)
+            self.assertEqual(specgram.unit, ref.unit)
+            numpy.testing.assert_array_almost_equal(specgram.value,
+                                                    ref.value)
+        # check the unit is given by the method
+        scheduler.add(series[1], 8, {'fftlength': 2, 'overlap': 1,
+                                     'method': 'rayleigh'}, out.append)
+        scheduler.run()
+        ref = series[1].spectrogram(8, fftlength=2, overlap=1,
+                                    method='rayleigh')
+        self.assertEqual(out[-1].unit, ref.unit)
+        # check data without a unit are calculated in counts
+        nounit = TimeSeries(series[1].value, epoch=100, sample_rate=16,
+                            name='X1:TEST')
+        nounit._unit = None
+        scheduler.add(nounit, 8, {'fftlength': 2, 'overlap': 1}, out.append)
+        scheduler.run()
+        numpy.testing.assert_array_almost_equal(out[-1].value, out[1].value)
+        # check the shared pool is never re-forked at a larger size
+        pool = fftpool.get_process_pool(2)
+        self.assertIs(fftpool.get_process_pool(8), pool)
+
+    def test_fft_registry(self):
+        a = fftengine.get_fft_window(32, 'hanning')
+        self.assertIs(fftengine.get_fft_window(32., 'hanning'), a)
+        self.assertFalse(a.flags.writeable)
+        self.assertEqual(a.size, 32)
+        self.assertIsNot(fftengine.get_fft_window(32, 'hanning',
+                                                  dtype=numpy.float32), a)
+        channel = Channel('X1:TEST-FFT_REGISTRY', sample_rate=16)
+        self.assertEqual(fftengine.warm_up([channel], fftlength=4), 1)
+        self.assertIn((64, 'hanning', 'float64'), fftengine.WINDOWS)
+
+    def test_spectral_histogram(self):
+        from gwpy.spectrogram import Spectrogram
+        values = 10 ** numpy.random.normal(-20, .5, size=(1000, 4))
+        a = Spectrogram(values[:400], epoch=0, dt=1, f0=0, df=1)
+        b = Spectrogram(values[400:], epoch=400, dt=1, f0=0, df=1)
+        hist = histogram.SpectralHistogram.from_spectrogram(a)
+        hist.update(a)
+        other = histogram.SpectralHistogram.from_spectrogram(b)
+        other.update(b)
+        hist.merge(other)
+        self.assertEqual(hist.count, 1000)
+        self.assertListEqual(hist.segments, [Segment(0, 1000)])
+        for q in (5, 50, 95):
+            numpy.testing.assert_allclose(
+                hist.percentile(q), numpy.percentile(values, q, axis=0),
+                rtol=.01)
+        self.assertRaises(ValueError, hist.update, a[:, :2])
+        # check merging data already recorded is a no-op
+        hist.merge(other)
+        self.assertEqual(hist.count, 1000)
+        # but partial overlaps cannot be merged
+        partial = histogram.SpectralHistogram.from_spectrogram(b)
+        partial.update(b, segment=(900, 1500))
+        self.assertRaises(ValueError, hist.merge, partial)
+
+    def test_spectral_histogram_widen(self):
+        from gwpy.spectrogram import Spectrogram
+        values = 10 ** numpy.concatenate((
+            numpy.random.normal(-20, .2, size=(200, 2)),
+            numpy.random.normal(-24, .2, size=(200, 2))))
+        a = Spectrogram(values[:200], epoch=0, dt=1, f0=0, df=1)
+        b = Spectrogram(values[200:], epoch=200, dt=1, f0=0, df=1)
+        # check later data outside the first window are still binned
+        hist = histogram.SpectralHistogram.from_spectrogram(a)
+        hist.update(a)
+        hist.update(b)
+        self.assertEqual(hist.dropped, 0)
+        self.assertGreater(hist.nbins, histogram.NBINS)
+        # and the same for merging histograms
+        other = histogram.SpectralHistogram.from_spectrogram(b)
+        other.update(b)
+        merged = histogram.SpectralHistogram.from_spectrogram(a)
+        merged.update(a)
+        merged.merge(other)
+        self.assertEqual(merged.dropped, 0)
+        for q in (5, 25, 75, 95):
+            numpy.testing.assert_allclose(
+                merged.percentile(q), numpy.percentile(values, q, axis=0),
+                rtol=.05)
+        # check percentiles outside a limited window are clipped, with
+        # a warning
+        narrow = histogram.SpectralHistogram.from_spectrogram(a,
+                                                              maxbins=400)
+        narrow.update(a)
+        narrow.update(b)
+        self.assertEqual(narrow.dropped, 400)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            narrow.percentile(5)
+        self.assertEqual(len(caught), 1)
+
+    def test_spectral_histogram_rebin(self):
+        from gwpy.spectrogram import Spectrogram
+        values = 10 ** numpy.random.uniform(-21, -19, size=(500, 3))
+        specgram = Spectrogram(values, epoch=0, dt=1, f0=0, df=1)
+        hist = histogram.SpectralHistogram.from_spectrogram(specgram)
+        hist.update(specgram)
+        bins = numpy.logspace(-22, -18, 5)
+        counts = hist.to_histogram(bins)
+        self.assertEqual(counts.shape, (3, 4))
+        self.assertListEqual(list(counts.sum(axis=1)), [500] * 3)
+        numpy.testing.assert_allclose(
+            counts, [numpy.histogram(v, bins)[0] for v in values.T], atol=5)
+        # check limits are within one bin of the data range
+        low, high = hist.limits()
+        numpy.testing.assert_allclose(
+            numpy.log10([low, high]), numpy.log10([values.min(),
+                                                   values.max()]),
+            atol=hist.resolution)
+        self.assertEqual(hist.dropped, 0)
+
     # -- test add/get methods -------------------
 
     def test_add_timeseries(self):
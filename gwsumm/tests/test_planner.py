@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Duncan Macleod (2016)
+#
+# This file is part of GWSumm.
+#
+# GWSumm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GWSumm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GWSumm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for `gwsumm.planner`
+
+"""
+
+from gwpy.segments import (Segment, SegmentList)
+
+from common import unittest
+from gwsumm.planner import DataPlan
+
+__author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
+
+
+class DataPlanTestCase(unittest.TestCase):
+    """`TestCase` for the `gwsumm.planner.DataPlan`
+    """
+    def test_add(self):
+        plan = DataPlan()
+        plan.add('timeseries', 'X1:TEST', [(0, 10)])
+        plan.add('timeseries', 'X1:TEST', [(5, 20), (30, 40)])
+        self.assertListEqual(plan.requests['timeseries']['X1:TEST'],
+                             SegmentList([Segment(0, 20), Segment(30, 40)]))
+
+    def test_groups(self):
+        plan = DataPlan()
+        plan.add('timeseries', 'X1:TEST-B', [(100, 200)])
+        plan.add('timeseries', 'X1:TEST-A', [(0, 100)])
+        plan.add('spectrogram', 'X1:TEST-C', [(0, 100)])
+        plan.add('spectrogram', 'X1:TEST-B', [(200, 300)])
+        plan.add('timeseries', 'X1:TEST-D', [])
+        groups = plan.groups('timeseries', 'spectrogram')
+        self.assertEqual(len(groups), 2)
+        self.assertListEqual(groups[0][0], SegmentList([Segment(0, 100)]))
+        self.assertListEqual(groups[0][1], ['X1:TEST-A', 'X1:TEST-C'])
+        self.assertListEqual(groups[1][0], SegmentList([Segment(100, 300)]))
+        self.assertListEqual(groups[1][1], ['X1:TEST-B'])
+
+    def test_split_fftparams(self):
+        plan = DataPlan()
+        plan.add('spectrogram', ('X1:TEST-A', 'a'), [(0, 100)])
+        plan.add('spectrogram', ('X1:TEST-B', 'b'), [(0, 100)])
+        plan.add('spectrogram', ('X1:TEST-C', 'a'), [(0, 100)])
+        groups = plan.groups('spectrogram')
+        self.assertEqual(len(groups), 1)
+        self.assertListEqual(plan._split_fftparams(groups[0][1]),
+                             [('a', ['X1:TEST-A', 'X1:TEST-C']),
+                              ('b', ['X1:TEST-B'])])
@@ -20,11 +20,19 @@
 
 """
 
+import warnings
+
 from matplotlib import use
 use('agg')
 
+import numpy
+
+from gwpy.spectrogram import Spectrogram
+
 from common import unittest
 from gwsumm import plot
+from gwsumm.plot import raster
+from gwsumm.data.histogram import SpectralHistogram
 
 __author__ = 'Duncan Macleod <duncan.macleod@ligo.org>'
 
@@ -49,3 +57,54 @@ class PlotTests(unittest.TestCase):
         self.assertIs(plot.get_plot('test'), TestPlot)
         plot.register_plot(TestPlot, name='test-with-name')
         self.assertIs(plot.get_plot('test-with-name'), TestPlot)
+
+    def test_rasterize_spectrograms(self):
+        values = numpy.random.random((100, 64))
+        specgram = Spectrogram(values, epoch=0, dt=1, f0=0, df=.5)
+        xedges = raster.pixel_edges((0, 200), 20)
+        yedges = raster.pixel_edges((0, 32), 8)
+        image = raster.rasterize_spectrograms([specgram], xedges, yedges,
+                                              method='nanmax')
+        self.assertEqual(image.shape, (8, 20))
+        self.assertEqual(image[0, 0], values[:10, :8].max())
+        self.assertTrue(numpy.isnan(image[:, 10:]).all())
+        image = raster.rasterize_spectrograms([specgram], xedges, yedges)
+        self.assertEqual(image[1, 2], numpy.median(
+            numpy.median(values[20:30, 8:16], axis=1)))
+        # check pixels smaller than cells are filled
+        image = raster.rasterize_spectrograms(
+            [specgram], raster.pixel_edges((0, 10), 40), yedges)
+        self.assertFalse(numpy.isnan(image).any())
+        self.assertRaises(ValueError, raster.rasterize_spectrograms,
+                          [specgram], xedges, yedges, method='blah')
+
+    def test_histogram_variance(self):
+        values = 10 ** numpy.random.uniform(-21, -19, size=(500, 3))
+        specgram = Spectrogram(values, epoch=0, dt=1, f0=0, df=1)
+        hist = SpectralHistogram.from_spectrogram(specgram)
+        hist.update(specgram)
+        variance = plot.get_plot('variance')._histogram_variance
+        # check default bins span the data, padded as Spectrogram.variance
+        out = variance(hist, log=True, nbins=20)
+        numpy.testing.assert_allclose(numpy.asarray(out.bins)[[0, -1]],
+                                      [values.min() / 2., values.max() * 2.],
+                                      rtol=.05)
+        numpy.testing.assert_allclose(out.value.sum(axis=1), 1)
+        # check norm and density
+        out = variance(hist, log=True, nbins=20, norm=True)
+        numpy.testing.assert_allclose(out.value.sum(axis=1), 1)
+        out = variance(hist, log=True, nbins=20, density=True)
+        numpy.testing.assert_allclose(
+            (out.value * numpy.diff(numpy.asarray(out.bins))).sum(axis=1), 1)
+        self.assertRaises(ValueError, variance, hist, norm=True,
+                          density=True)
+        # check amplitudes outside of the histogram window are kept
+        narrow = SpectralHistogram.from_spectrogram(specgram, nbins=50,
+                                                    maxbins=50)
+        narrow.update(specgram)
+        self.assertTrue(narrow.dropped)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            out = variance(narrow, log=True, nbins=20)
+        self.assertEqual(len(caught), 1)
+        numpy.testing.assert_allclose(out.value.sum(axis=1), 1)
@@ -45,6 +45,7 @@ from . import globalv
 from .utils import (re_cchar, vprint, count_free_cores, safe_eval)
 from .config import (GWSummConfigParser, NoSectionError, NoOptionError)
 from .channels import get_channel
+from .data.cache import IndexedCache
 
 TRIGFIND_FORMAT = {
     re.compile('omicron', re.I): 'sngl_burst',
@@ -213,6 +214,10 @@ def get_triggers(channel, etg, segments, config=GWSummConfigParser(),
             contenthandler = get_partial_contenthandler(TableClass)
             lsctables.use_in(contenthandler)
 
+        # index the cache once, rather than walking it for every segment
+        if isinstance(cache, Cache) and not isinstance(cache, IndexedCache):
+            cache = IndexedCache(cache)
+
         # loop over segments
         for segment in new:
             # find trigger files